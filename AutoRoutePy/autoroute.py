@@ -9,7 +9,10 @@
 
 import datetime
 import os
-from subprocess import Popen, PIPE
+
+#local imports
+from .executable import run_executable
+from .instrumentation import span
 #------------------------------------------------------------------------------
 #Main Dataset Manager Class
 #------------------------------------------------------------------------------
@@ -105,13 +108,10 @@ class AutoRoute(object):
         else:
             raise Exception("AutoRoute input file to update not found.")
     
-    def run_autoroute(self, autoroute_input_file=""):
+    def write_input_file(self, autoroute_input_file=""):
         """
-        Run AutoRoute program and generate file based on inputs
+        Generate the input file or update it if it exists
         """
-    
-        time_start = datetime.datetime.utcnow()
-    
         if not autoroute_input_file or not os.path.exists(autoroute_input_file):
             #generate input file if it does not exist
             if not autoroute_input_file:
@@ -120,18 +120,33 @@ class AutoRoute(object):
         else:
             #update existing file
             self.update_input_file(autoroute_input_file)
+        return autoroute_input_file
+
+    def run_autoroute(self, autoroute_input_file="", timeout=None):
+        """
+        Run AutoRoute program and generate file based on inputs
+
+        AutoRoute is killed if it runs longer than timeout (seconds).
+        Returns the wall time, cpu time and peak memory of the run.
+        """
+    
+        time_start = datetime.datetime.utcnow()
+    
+        autoroute_input_file = self.write_input_file(autoroute_input_file)
 
         #run AutoRoute
         print("Running AutoRoute ...")
-        process = Popen([self._autoroute_executable_location, autoroute_input_file], 
-                        stdout=PIPE, stderr=PIPE, shell=False)
-        out, err = process.communicate()
-        if err:
-            print(err)
-            raise
-        else:
-            print('AutoRoute output:')
-            for line in out.split(b'\n'):
-                print(line)
+        print('AutoRoute output:')
+        with span("autoroute_run",
+                  os.path.basename(os.path.dirname(os.path.abspath(autoroute_input_file)))) as stage_span:
+            executable_result = run_executable([self._autoroute_executable_location, autoroute_input_file],
+                                               timeout=timeout)
+            stage_span.set(cpu_time=executable_result.cpu_time,
+                           peak_memory=executable_result.peak_memory)
 
         print("Time to run AutoRoute: %s" % (datetime.datetime.utcnow()-time_start))
+        if executable_result.cpu_time is not None:
+            print("AutoRoute CPU time: %s" % datetime.timedelta(seconds=executable_result.cpu_time))
+        if executable_result.peak_memory is not None:
+            print("AutoRoute peak memory: %.2f GB" % (executable_result.peak_memory * 1e-9))
+        return executable_result
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+##
+##  checkpoint.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+from datetime import datetime
+import json
+import os
+
+from osgeo import gdal, ogr
+
+#local imports
+from .utilities import VALID_RASTER_EXTENSIONS, write_json_file_atomic
+
+#files that make up a shapefile
+SHAPEFILE_EXTENSION_LIST = ['.shp', '.shx', '.dbf']
+
+#----------------------------------------------------------------------------------------
+# HELPER FUNCTIONS
+#----------------------------------------------------------------------------------------
+def validate_output_file(output_file, expected_size=None):
+    """
+    Checks that the output file exists with the expected size and that
+    rasters and shapefiles can be read to the end (are not truncated)
+    """
+    if not os.path.isfile(output_file):
+        return False
+    output_size = os.path.getsize(output_file)
+    if output_size <= 0 or (expected_size is not None and output_size != expected_size):
+        return False
+
+    output_file_base, output_file_extension = os.path.splitext(output_file)
+    output_file_extension = output_file_extension.lower()
+    if output_file_extension[1:] in VALID_RASTER_EXTENSIONS.split("|"):
+        raster = gdal.Open(output_file)
+        if raster is None:
+            return False
+        band = raster.GetRasterBand(1)
+        #the last row is the end of the file for a complete raster
+        return band.ReadAsArray(0, raster.RasterYSize - 1, raster.RasterXSize, 1) is not None
+    elif output_file_extension == '.shp':
+        for shapefile_extension in SHAPEFILE_EXTENSION_LIST[1:]:
+            if not os.path.isfile("{0}{1}".format(output_file_base, shapefile_extension)):
+                return False
+        shapefile = ogr.Open(output_file)
+        if shapefile is None:
+            return False
+        layer = shapefile.GetLayer()
+        num_features = layer.GetFeatureCount()
+        return num_features <= 0 or layer.GetFeature(num_features - 1) is not None
+    return True
+
+#----------------------------------------------------------------------------------------
+# CHECKPOINT CLASS
+#----------------------------------------------------------------------------------------
+class JobCheckpoint(object):
+    """
+    Manifest of the jobs of a multiprocess run with their status and
+    outputs. It is written atomically as each job finishes so a run
+    that dies can be resumed with only the missing or failed jobs.
+    """
+    def __init__(self, checkpoint_file, resume=False):
+        self.checkpoint_file = checkpoint_file
+        self._job_entries = {}
+        if resume and os.path.exists(checkpoint_file):
+            with open(checkpoint_file) as checkpoint_handle:
+                self._job_entries = json.load(checkpoint_handle).get('jobs', {})
+
+    def is_job_complete(self, stage_name, job_name, output_file_list):
+        """
+        Checks that the job finished successfully and its outputs are
+        the same complete files as when it finished
+        """
+        job_entry = self._job_entries.get(stage_name, {}).get(job_name)
+        if not job_entry or job_entry['status'] != "success":
+            return False
+        output_file_sizes = job_entry['output_files']
+        output_file_list = [os.path.abspath(output_file) for output_file in output_file_list if output_file]
+        if sorted(output_file_list) != sorted(output_file_sizes):
+            return False
+        for output_file in output_file_list:
+            if not validate_output_file(output_file, output_file_sizes[output_file]):
+                print("Output {0} of {1} is incomplete ...".format(output_file, job_name))
+                return False
+        return True
+
+    def record_job(self, stage_name, job_name, status="success", output_file_list=(), error=""):
+        """
+        Records the finished job and writes the manifest
+        """
+        output_file_list = [os.path.abspath(output_file) for output_file in output_file_list if output_file]
+        self._job_entries.setdefault(stage_name, {})[job_name] = {
+            'status': status,
+            'time_finished': datetime.utcnow().isoformat(),
+            'output_files': dict((output_file, os.path.getsize(output_file) \
+                                  if os.path.isfile(output_file) else None) \
+                                 for output_file in output_file_list),
+            'error': error,
+        }
+        write_json_file_atomic(self.checkpoint_file, {'jobs': self._job_entries})
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+##
+##  executable.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+from collections import namedtuple
+import os
+import re
+from subprocess import Popen, PIPE
+import sys
+import threading
+from time import time
+
+try:
+    import resource
+except ImportError:
+    #not available on Windows
+    resource = None
+try:
+    from psutil import NoSuchProcess, Process
+except ImportError:
+    Process = None
+
+#progress printed by the executable (i.e. "45%" or "45.5 %")
+PROGRESS_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s*%')
+
+#result of running an executable
+#wall_time and cpu_time are in seconds and peak_memory in bytes
+#(None if it could not be measured)
+ExecutableResult = namedtuple('ExecutableResult',
+                              ['return_code', 'wall_time', 'cpu_time', 'peak_memory'])
+
+#----------------------------------------------------------------------------------------
+# HELPER FUNCTIONS
+#----------------------------------------------------------------------------------------
+def _get_children_cpu_time():
+    """
+    Returns the cpu time of the finished child processes
+    """
+    if resource is None:
+        return None
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return children_usage.ru_utime + children_usage.ru_stime
+
+def _get_process_tree(pid):
+    """
+    Returns the process and all of its child processes
+    """
+    process = Process(pid)
+    return [process] + process.children(recursive=True)
+
+def kill_process_tree(process):
+    """
+    Kills the process and the processes it started
+    """
+    if Process is not None:
+        try:
+            for child_process in reversed(_get_process_tree(process.pid)[1:]):
+                try:
+                    child_process.kill()
+                except NoSuchProcess:
+                    pass
+        except NoSuchProcess:
+            pass
+    try:
+        process.kill()
+    except OSError:
+        pass
+
+def _stream_output(pipe, output_prefix, output_line_list, progress_callback):
+    """
+    Prints the output of the executable line by line as it is written
+    """
+    for line in iter(pipe.readline, ''):
+        line = line.rstrip()
+        if not line:
+            continue
+        if output_line_list is not None:
+            output_line_list.append(line)
+        print("{0}{1}".format(output_prefix, line))
+        sys.stdout.flush()
+        if progress_callback is not None:
+            progress_match = PROGRESS_PATTERN.search(line)
+            if progress_match:
+                progress_callback(float(progress_match.group(1)), line)
+    pipe.close()
+
+#----------------------------------------------------------------------------------------
+# MAIN FUNCTION
+#----------------------------------------------------------------------------------------
+def run_executable(command_list, timeout=None, progress_callback=None,
+                   sample_interval=1.0):
+    """
+    Runs the executable streaming its output line by line to stdout
+    (the log in multiprocessing mode) instead of holding it in memory
+
+    The executable (and the processes it started) is killed if it runs
+    longer than timeout (seconds). progress_callback is called with the
+    percent complete and the line for each progress marker in the output.
+
+    Raises an exception if the executable writes to stderr, exits with
+    an error code or times out. Returns an ExecutableResult with the
+    wall time, cpu time and peak memory of the executable.
+    """
+    executable_name = os.path.basename(command_list[0])
+    time_start = time()
+    cpu_time_start = _get_children_cpu_time()
+    process = Popen(command_list, stdout=PIPE, stderr=PIPE,
+                    shell=False, universal_newlines=True)
+
+    error_line_list = []
+    output_thread_list = [threading.Thread(target=_stream_output,
+                                           args=(process.stdout, "", None, progress_callback)),
+                          threading.Thread(target=_stream_output,
+                                           args=(process.stderr, "ERROR OUTPUT: ", error_line_list, None))]
+    for output_thread in output_thread_list:
+        output_thread.daemon = True
+        output_thread.start()
+
+    process_finished = threading.Event()
+    def wait_for_process():
+        process.wait()
+        process_finished.set()
+    process_wait_thread = threading.Thread(target=wait_for_process)
+    process_wait_thread.daemon = True
+    process_wait_thread.start()
+
+    #sample the memory of the executable until it finishes or times out
+    timed_out = False
+    peak_memory = None
+    cpu_time = None
+    while not process_finished.is_set():
+        if Process is not None:
+            try:
+                tree_memory = 0
+                tree_cpu_time = 0
+                for tree_process in _get_process_tree(process.pid):
+                    try:
+                        tree_memory += tree_process.memory_info().rss
+                        tree_cpu_times = tree_process.cpu_times()
+                        tree_cpu_time += tree_cpu_times.user + tree_cpu_times.system
+                    except NoSuchProcess:
+                        pass
+                peak_memory = max(peak_memory or 0, tree_memory)
+                cpu_time = tree_cpu_time
+            except NoSuchProcess:
+                pass
+        wait_time = sample_interval
+        if timeout is not None:
+            wait_time = timeout - (time() - time_start)
+            if wait_time <= 0:
+                timed_out = True
+                kill_process_tree(process)
+                break
+            wait_time = min(wait_time, sample_interval)
+        process_finished.wait(wait_time)
+
+    process_wait_thread.join()
+    return_code = process.returncode
+    for output_thread in output_thread_list:
+        #processes left after a timeout may keep the output open
+        output_thread.join(5 if timed_out else None)
+
+    wall_time = time() - time_start
+    if cpu_time_start is not None:
+        cpu_time = _get_children_cpu_time() - cpu_time_start
+
+    if timed_out:
+        raise Exception("ERROR: {0} exceeded the timeout of {1} seconds and was killed ...".format(executable_name,
+                                                                                                 timeout))
+    if error_line_list or return_code != 0:
+        raise Exception("ERROR: {0} failed with exit code {1}:\n{2}".format(executable_name,
+                                                                           return_code,
+                                                                           "\n".join(error_line_list)))
+    return ExecutableResult(return_code, wall_time, cpu_time, peak_memory)
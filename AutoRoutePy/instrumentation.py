@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+##
+##  instrumentation.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+from collections import OrderedDict
+import json
+import os
+import socket
+import threading
+from time import time
+
+try:
+    from psutil import Process
+except ImportError:
+    Process = None
+
+#events file inherited by the worker processes
+INSTRUMENTATION_EVENTS_FILE_ENV = "AUTOROUTEPY_EVENTS_FILE"
+
+_events_file = os.environ.get(INSTRUMENTATION_EVENTS_FILE_ENV, "")
+_events_lock = threading.Lock()
+
+#----------------------------------------------------------------------------------------
+# HELPER FUNCTIONS
+#----------------------------------------------------------------------------------------
+def _get_process_usage():
+    """
+    Returns the bytes read, bytes written and RSS of this process
+    (None if they cannot be measured)
+    """
+    if Process is None:
+        return None, None, None
+    process = Process(os.getpid())
+    bytes_read = bytes_written = None
+    try:
+        io_counters = process.io_counters()
+        #chars include reads and writes served by the page cache
+        bytes_read = getattr(io_counters, 'read_chars', io_counters.read_bytes)
+        bytes_written = getattr(io_counters, 'write_chars', io_counters.write_bytes)
+    except (AttributeError, NotImplementedError):
+        #not available on Mac OS X
+        pass
+    return bytes_read, bytes_written, process.memory_info().rss
+
+def _write_event(event):
+    """
+    Appends the event to the events file as one JSON line
+    """
+    event_line = "{0}\n".format(json.dumps(event, default=str))
+    with _events_lock:
+        #one write per line in append mode so processes do not interleave
+        with open(_events_file, 'a') as events_handle:
+            events_handle.write(event_line)
+
+#----------------------------------------------------------------------------------------
+# SPAN CLASSES
+#----------------------------------------------------------------------------------------
+class _NoOpSpan(object):
+    """
+    Span used when the instrumentation is disabled
+    """
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        return False
+    def set(self, **attributes):
+        pass
+
+_NO_OP_SPAN = _NoOpSpan()
+
+class _Span(object):
+    """
+    Times a stage of the pipeline and writes an event with its duration,
+    bytes read and written and RSS to the events file when it ends
+    """
+    def __init__(self, stage, sub_basin, attributes):
+        self.stage = stage
+        self.sub_basin = sub_basin
+        self.attributes = attributes
+    def __enter__(self):
+        self._bytes_read, self._bytes_written, self._rss = _get_process_usage()
+        self._time_start = time()
+        return self
+    def __exit__(self, exception_type, exception_value, traceback):
+        time_end = time()
+        bytes_read, bytes_written, rss = _get_process_usage()
+        event = OrderedDict([
+                 ('stage', self.stage),
+                 ('sub_basin', self.sub_basin),
+                 ('time_start', self._time_start),
+                 ('duration', time_end - self._time_start),
+                 ('bytes_read', bytes_read - self._bytes_read if bytes_read is not None else None),
+                 ('bytes_written', bytes_written - self._bytes_written if bytes_written is not None else None),
+                 ('rss', rss),
+                 ('rss_change', rss - self._rss if rss is not None else None),
+                 ('status', "success" if exception_type is None else "failed"),
+                 ('error', str(exception_value) if exception_value is not None else ""),
+                 ('host', socket.gethostname()),
+                 ('pid', os.getpid()),
+                ])
+        event.update(self.attributes)
+        _write_event(event)
+        return False
+    def set(self, **attributes):
+        """
+        Adds attributes to the event (i.e. the peak memory of an executable)
+        """
+        self.attributes.update(attributes)
+
+#----------------------------------------------------------------------------------------
+# MAIN FUNCTIONS
+#----------------------------------------------------------------------------------------
+def enable_instrumentation(events_file):
+    """
+    Writes an event for each span to the JSON lines events file
+    (also in the worker processes started afterwards)
+
+    Returns the previous events file ("" if disabled) to pass to
+    restore_instrumentation when done.
+    """
+    global _events_file
+    previous_events_file = _events_file
+    _events_file = os.path.abspath(events_file)
+    os.environ[INSTRUMENTATION_EVENTS_FILE_ENV] = _events_file
+    return previous_events_file
+
+def disable_instrumentation():
+    """
+    Stops writing events
+    """
+    global _events_file
+    _events_file = ""
+    os.environ.pop(INSTRUMENTATION_EVENTS_FILE_ENV, None)
+
+def restore_instrumentation(previous_events_file):
+    """
+    Goes back to the events file returned by enable_instrumentation
+    (disabled if it was "")
+    """
+    if previous_events_file:
+        enable_instrumentation(previous_events_file)
+    else:
+        disable_instrumentation()
+
+def is_instrumentation_enabled():
+    """
+    Returns True if events are written
+    """
+    return bool(_events_file)
+
+def span(stage, sub_basin="", **attributes):
+    """
+    Context manager timing a stage of the pipeline for a sub-basin:
+
+    with span("rasterize_stream_shapefile", sub_basin="x-1") as stage_span:
+        ...
+        stage_span.set(num_streams=len(streams))
+
+    When the instrumentation is disabled, a shared span that does
+    nothing is returned so it can stay in production code.
+    """
+    if not _events_file:
+        return _NO_OP_SPAN
+    return _Span(stage, sub_basin, attributes)
+
+def read_events(events_file):
+    """
+    Returns the events in the JSON lines events file
+    """
+    event_list = []
+    with open(events_file) as events_handle:
+        for event_line in events_handle:
+            if event_line.strip():
+                event_list.append(json.loads(event_line))
+    return event_list
+
+def write_prometheus_textfile(events_file, prometheus_file):
+    """
+    Summarizes the events by stage in the Prometheus text format
+    for the node exporter textfile collector
+    """
+    stage_metrics = OrderedDict()
+    for event in read_events(events_file):
+        metrics = stage_metrics.setdefault(event['stage'], {'count': 0, 'failed': 0, 'duration': 0.0,
+                                                            'bytes_read': 0, 'bytes_written': 0,
+                                                            'rss': 0})
+        metrics['count'] += 1
+        metrics['failed'] += event['status'] != "success"
+        metrics['duration'] += event['duration']
+        metrics['bytes_read'] += event.get('bytes_read') or 0
+        metrics['bytes_written'] += event.get('bytes_written') or 0
+        metrics['rss'] = max(metrics['rss'], event.get('rss') or 0)
+
+    metric_definitions = [
+        ('autoroutepy_stage_runs_total', 'counter', 'count', "Number of runs of the stage"),
+        ('autoroutepy_stage_failures_total', 'counter', 'failed', "Number of failed runs of the stage"),
+        ('autoroutepy_stage_duration_seconds_total', 'counter', 'duration', "Time spent in the stage"),
+        ('autoroutepy_stage_read_bytes_total', 'counter', 'bytes_read', "Bytes read in the stage"),
+        ('autoroutepy_stage_written_bytes_total', 'counter', 'bytes_written', "Bytes written in the stage"),
+        ('autoroutepy_stage_rss_bytes_max', 'gauge', 'rss', "Largest RSS at the end of the stage"),
+    ]
+    prometheus_lines = []
+    for metric_name, metric_type, metric_key, metric_help in metric_definitions:
+        prometheus_lines.append("# HELP {0} {1}".format(metric_name, metric_help))
+        prometheus_lines.append("# TYPE {0} {1}".format(metric_name, metric_type))
+        for stage, metrics in stage_metrics.items():
+            prometheus_lines.append('{0}{{stage="{1}"}} {2}'.format(metric_name, stage,
+                                                                   metrics[metric_key]))
+
+    #the collector must never read a partial file
+    temp_prometheus_file = "{0}.{1}.tmp".format(prometheus_file, os.getpid())
+    with open(temp_prometheus_file, 'w') as prometheus_handle:
+        prometheus_handle.write("\n".join(prometheus_lines) + "\n")
+    os.rename(temp_prometheus_file, prometheus_file)
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+##
+##  ledger.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+from datetime import datetime
+import heapq
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+#local imports
+from .scheduling import get_job_cost_list
+
+#number of most recent successful runs of a job used for its history
+LEDGER_HISTORY_LENGTH = 5
+
+LEDGER_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS autoroute_job (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL,
+    stage_name TEXT NOT NULL,
+    job_name TEXT NOT NULL,
+    input_directory TEXT,
+    num_dem_cells INTEGER,
+    num_stream_cells INTEGER,
+    estimated_memory INTEGER,
+    parameters TEXT,
+    time_start REAL,
+    time_end REAL,
+    wall_time REAL,
+    cpu_time REAL,
+    peak_memory INTEGER,
+    output_bytes INTEGER,
+    status TEXT NOT NULL,
+    error TEXT
+)
+"""
+LEDGER_INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS autoroute_job_stage_name
+ON autoroute_job (stage_name, job_name, status)
+"""
+
+#----------------------------------------------------------------------------------------
+# HELPER FUNCTIONS
+#----------------------------------------------------------------------------------------
+def get_output_size(output_file_list):
+    """
+    Returns the size in bytes of the output files that exist
+    (a shapefile includes all of the files with its base name)
+    """
+    output_bytes = 0
+    for output_file in output_file_list:
+        if not output_file:
+            continue
+        output_file_base, output_file_extension = os.path.splitext(output_file)
+        related_file_list = [output_file]
+        if output_file_extension.lower() == ".shp":
+            related_file_list = ["{0}{1}".format(output_file_base, extension) \
+                                 for extension in (".shp", ".shx", ".dbf", ".prj")]
+        for related_file in related_file_list:
+            if os.path.exists(related_file):
+                output_bytes += os.path.getsize(related_file)
+    return output_bytes
+
+#----------------------------------------------------------------------------------------
+# LEDGER CLASS
+#----------------------------------------------------------------------------------------
+class JobLedger(object):
+    """
+    File based (SQLite) record of the prepare and run jobs with their
+    inputs, wall time, cpu time, peak memory, output size and status
+    for scheduling and capacity planning
+    """
+    def __init__(self, ledger_file):
+        self.ledger_file = ledger_file
+        self.run_id = datetime.utcnow().strftime("%Y%m%d%H%M%S%f")
+        self._connection = sqlite3.connect(ledger_file)
+        with self._connection:
+            self._connection.execute(LEDGER_TABLE_SQL)
+            self._connection.execute(LEDGER_INDEX_SQL)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Closes the connection to the ledger file
+        """
+        self._connection.close()
+
+    def record_job(self, stage_name, job_name, time_start, time_end,
+                   cpu_time=None, peak_memory=None, status="success",
+                   error="", input_directory="", num_dem_cells=None,
+                   num_stream_cells=None, estimated_memory=None,
+                   output_file_list=(), parameters=None):
+        """
+        Records a finished job
+        """
+        with self._connection:
+            self._connection.execute("INSERT INTO autoroute_job (run_id, stage_name, job_name, "
+                                     "input_directory, num_dem_cells, num_stream_cells, "
+                                     "estimated_memory, parameters, time_start, time_end, "
+                                     "wall_time, cpu_time, peak_memory, output_bytes, "
+                                     "status, error) "
+                                     "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                     (self.run_id, stage_name, job_name,
+                                      input_directory, num_dem_cells, num_stream_cells,
+                                      estimated_memory, json.dumps(parameters or {}, default=str),
+                                      time_start, time_end, time_end - time_start,
+                                      cpu_time, peak_memory, get_output_size(output_file_list),
+                                      status, error))
+
+    def _get_job_history(self, stage_name, column_name):
+        """
+        Returns the values of the column of the most recent successful
+        runs of each job in the stage by job name
+        """
+        job_history = {}
+        for job_name, value in self._connection.execute("SELECT job_name, {0} FROM autoroute_job "
+                                                        "WHERE stage_name = ? AND status = 'success' "
+                                                        "AND {0} IS NOT NULL "
+                                                        "ORDER BY id DESC".format(column_name),
+                                                        (stage_name,)):
+            job_value_list = job_history.setdefault(job_name, [])
+            if len(job_value_list) < LEDGER_HISTORY_LENGTH:
+                job_value_list.append(value)
+        return job_history
+
+    def get_job_runtime_history(self, stage_name):
+        """
+        Returns the median wall time in seconds of the recent successful
+        runs of each job in the stage by job name (job_runtime_history)
+        """
+        return dict((job_name, float(np.median(wall_time_list))) for job_name, wall_time_list \
+                    in self._get_job_history(stage_name, "wall_time").items())
+
+    def get_job_memory_history(self, stage_name):
+        """
+        Returns the largest peak memory in bytes of the recent successful
+        runs of each job in the stage by job name
+        """
+        return dict((job_name, max(peak_memory_list)) for job_name, peak_memory_list \
+                    in self._get_job_history(stage_name, "peak_memory").items())
+
+    def plan(self, stage_name, job_name_list, num_cpus, estimated_cost_list=None,
+             estimated_memory_list=None):
+        """
+        Predicts the wall time and memory of running the jobs on num_cpus
+        from previous runs. Jobs without history are scaled from their
+        estimated cost (or the median runtime if there is no cost).
+
+        Returns a dictionary with the predicted wall time and busy time
+        in seconds, the peak memory in bytes of the largest jobs running
+        together and the number of jobs with history.
+        """
+        runtime_history = self.get_job_runtime_history(stage_name)
+        memory_history = self.get_job_memory_history(stage_name)
+        if estimated_cost_list is not None and \
+            [job_name for job_name in job_name_list if job_name in runtime_history]:
+            job_runtime_list = get_job_cost_list(job_name_list, estimated_cost_list,
+                                                 runtime_history)
+        else:
+            median_runtime = 0
+            if runtime_history:
+                median_runtime = float(np.median(list(runtime_history.values())))
+            job_runtime_list = [runtime_history.get(job_name, median_runtime) \
+                                for job_name in job_name_list]
+
+        if estimated_memory_list is None:
+            estimated_memory_list = [0] * len(job_name_list)
+        job_memory_list = [memory_history.get(job_name, estimated_memory) for job_name, estimated_memory \
+                           in zip(job_name_list, estimated_memory_list)]
+
+        #longest jobs first to the cpu that is free first
+        cpu_time_heap = [0.0] * max(1, num_cpus)
+        for job_runtime in sorted(job_runtime_list, reverse=True):
+            heapq.heappush(cpu_time_heap, heapq.heappop(cpu_time_heap) + job_runtime)
+
+        return {
+                'wall_time': max(cpu_time_heap),
+                'busy_time': sum(job_runtime_list),
+                'peak_memory': sum(sorted(job_memory_list, reverse=True)[:max(1, num_cpus)]),
+                'num_jobs': len(job_name_list),
+                'num_jobs_with_history': len([job_name for job_name in job_name_list \
+                                              if job_name in runtime_history]),
+               }
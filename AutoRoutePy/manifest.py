@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+##
+##  manifest.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+from fnmatch import fnmatch
+from glob import glob
+import json
+import os
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+#local imports
+from .utilities import write_json_file_atomic
+
+#manifests written by run_autoroute_multiprocess in the output directory
+OUTPUT_MANIFEST_PATTERN = "output_manifest_*.json"
+
+#files that can make up a shapefile
+SHAPEFILE_PART_EXTENSION_LIST = ['.shp', '.shx', '.dbf', '.prj', '.cpg', '.qix']
+
+#----------------------------------------------------------------------------------------
+# HELPER FUNCTIONS
+#----------------------------------------------------------------------------------------
+def _get_projection_info(projection_wkt):
+    """
+    Returns the EPSG code (i.e. "EPSG:4326", None if unknown)
+    and WKT of the projection
+    """
+    if not projection_wkt:
+        return None, ""
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.ImportFromWkt(projection_wkt)
+    epsg_code = spatial_reference.GetAttrValue("AUTHORITY", 1)
+    return ("EPSG:%s" % epsg_code if epsg_code else None), projection_wkt
+
+def get_shapefile_part_list(shapefile):
+    """
+    Returns the files of the shapefile that exist
+    """
+    shapefile_base = os.path.splitext(shapefile)[0]
+    return [shapefile_base + extension for extension in SHAPEFILE_PART_EXTENSION_LIST \
+            if os.path.exists(shapefile_base + extension)]
+
+def get_raster_output_info(raster_file, block_rows=1024):
+    """
+    Returns the size, extent, projection and pixel counts of the raster
+    (the valid pixels are counted in blocks of rows)
+    """
+    raster = gdal.Open(raster_file)
+    x_size = raster.RasterXSize
+    y_size = raster.RasterYSize
+    geotransform = raster.GetGeoTransform()
+    band = raster.GetRasterBand(1)
+    no_data_value = band.GetNoDataValue()
+    num_valid_pixels = 0
+    for y_offset in range(0, y_size, block_rows):
+        block_array = band.ReadAsArray(0, y_offset, x_size, min(block_rows, y_size - y_offset))
+        if no_data_value is None:
+            num_valid_pixels += block_array.size
+        else:
+            num_valid_pixels += int(np.count_nonzero(block_array != no_data_value))
+    epsg_code, projection_wkt = _get_projection_info(raster.GetProjection())
+    raster = None
+    x_min = geotransform[0]
+    x_max = geotransform[0] + geotransform[1] * x_size
+    y_max = geotransform[3]
+    y_min = geotransform[3] + geotransform[5] * y_size
+    return {
+            'path': os.path.abspath(raster_file),
+            'size': os.path.getsize(raster_file),
+            'x_size': x_size,
+            'y_size': y_size,
+            'pixel_count': x_size * y_size,
+            'valid_pixel_count': num_valid_pixels,
+            'no_data_value': no_data_value,
+            'extent': [min(x_min, x_max), max(x_min, x_max), min(y_min, y_max), max(y_min, y_max)],
+            'epsg': epsg_code,
+            'projection': projection_wkt,
+           }
+
+def get_shapefile_output_info(shapefile):
+    """
+    Returns the files, size, extent, projection and feature
+    count of the shapefile
+    """
+    shapefile_part_list = get_shapefile_part_list(shapefile)
+    shapefile_ds = ogr.Open(shapefile)
+    layer = shapefile_ds.GetLayer()
+    num_features = layer.GetFeatureCount()
+    extent = list(layer.GetExtent()) if num_features > 0 else None
+    spatial_reference = layer.GetSpatialRef()
+    epsg_code, projection_wkt = _get_projection_info(spatial_reference.ExportToWkt() \
+                                                     if spatial_reference is not None else "")
+    shapefile_ds = None
+    return {
+            'path': os.path.abspath(shapefile),
+            'parts': [os.path.abspath(shapefile_part) for shapefile_part in shapefile_part_list],
+            'size': sum(os.path.getsize(shapefile_part) for shapefile_part in shapefile_part_list),
+            'feature_count': num_features,
+            'extent': extent,
+            'epsg': epsg_code,
+            'projection': projection_wkt,
+           }
+
+#----------------------------------------------------------------------------------------
+# MAIN FUNCTIONS
+#----------------------------------------------------------------------------------------
+def write_output_manifest(manifest_file, flood_map_raster="", flood_depth_raster="",
+                          shapefile="", **attributes):
+    """
+    Writes the paths, sizes, extents, projections and feature and pixel
+    counts of the outputs of an AutoRoute simulation to a JSON file so
+    post-processing and publishing do not need to search for or open them
+    """
+    outputs = {}
+    if flood_map_raster and os.path.exists(flood_map_raster):
+        outputs['flood_map'] = get_raster_output_info(flood_map_raster)
+    if flood_depth_raster and os.path.exists(flood_depth_raster):
+        outputs['flood_depth'] = get_raster_output_info(flood_depth_raster)
+    if shapefile and os.path.exists(shapefile):
+        outputs['shapefile'] = get_shapefile_output_info(shapefile)
+    output_manifest = dict(attributes)
+    output_manifest['outputs'] = outputs
+    write_json_file_atomic(manifest_file, output_manifest)
+    return output_manifest
+
+def read_output_manifest(manifest_file):
+    """
+    Reads the output manifest of an AutoRoute simulation
+    """
+    with open(manifest_file) as manifest_handle:
+        return json.load(manifest_handle)
+
+def find_output_manifests(directory):
+    """
+    Reads all of the output manifests in the directory
+    (one search instead of one per output type)
+    """
+    return [read_output_manifest(manifest_file) for manifest_file \
+            in sorted(glob(os.path.join(directory, OUTPUT_MANIFEST_PATTERN)))]
+
+def get_manifest_outputs(output_manifest_list, output_type, file_pattern="*"):
+    """
+    Returns the information of the outputs of a type ('flood_map',
+    'flood_depth' or 'shapefile') with a file name matching file_pattern
+    """
+    output_info_list = []
+    for output_manifest in output_manifest_list:
+        output_info = output_manifest['outputs'].get(output_type)
+        if output_info and fnmatch(os.path.basename(output_info['path']), file_pattern):
+            output_info_list.append(output_info)
+    return sorted(output_info_list, key=lambda output_info: output_info['path'])
@@ -7,109 +7,715 @@
 ##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
 ##  License BSD 3-Clause
 
+from collections import deque
 from glob import glob
+import multiprocessing
+import numpy as np
 import os
-from osgeo import ogr, osr
-from shutil import copy
+from osgeo import gdal, ogr, osr
+
+#local imports
+from ..instrumentation import span
+from ..manifest import get_manifest_outputs
+from ..prepare.tile_dem import read_dem_tile_index
+
+#output format by extension of the merged file
+VECTOR_DRIVER_NAMES = {
+    '.shp': 'ESRI Shapefile',
+    '.gpkg': 'GPKG',
+    '.fgb': 'FlatGeobuf',
+}
+
+#coordinate transformations of this process by source and output projection
+_coordinate_transformations = {}
+
+#sub-basin rasters written by run_autoroute_multiprocess
+FLOOD_RASTER_PATTERNS = {
+    'flood_map': "flood_map_raster_*.tif",
+    'flood_depth': "flood_depth_raster_*.tif",
+}
 
 #------------------------------------------------------------------------------
-#AutoRoute Post Processing Functions
+#Helper Functions
 #------------------------------------------------------------------------------
+def get_vector_driver_name(vector_file):
+    """
+    Returns the OGR driver name for the extension of the file
+    """
+    extension = os.path.splitext(vector_file)[1].lower()
+    if extension not in VECTOR_DRIVER_NAMES:
+        raise Exception("ERROR: Invalid output extension {0}. Only {1} allowed ...".format(extension,
+                                                                                         ", ".join(sorted(VECTOR_DRIVER_NAMES))))
+    return VECTOR_DRIVER_NAMES[extension]
 
-def merge_shapefiles(directory, out_shapefile_name, reproject=False, remove_old=False):
+def _get_spatial_reference(projection_wkt):
+    """
+    Returns the spatial reference in longitude/latitude order
+    """
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.ImportFromWkt(projection_wkt)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        #GDAL 3 uses latitude/longitude order for EPSG:4326
+        spatial_reference.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return spatial_reference
+
+def _get_coordinate_transformation(in_projection_wkt, out_projection_wkt):
+    """
+    Returns the transformation between the projections (None if they are
+    the same). Each transformation is only built once per process.
+    """
+    transformation_key = (in_projection_wkt, out_projection_wkt)
+    if transformation_key not in _coordinate_transformations:
+        coordinate_transformation = None
+        in_spatial_reference = _get_spatial_reference(in_projection_wkt)
+        out_spatial_reference = _get_spatial_reference(out_projection_wkt)
+        if not in_spatial_reference.IsSame(out_spatial_reference):
+            coordinate_transformation = osr.CoordinateTransformation(in_spatial_reference,
+                                                                     out_spatial_reference)
+        _coordinate_transformations[transformation_key] = coordinate_transformation
+    return _coordinate_transformations[transformation_key]
+
+def read_shapefile_geometries(args):
+    """
+    Reads the geometries of a shapefile as WKB in the output projection
+    (can run on one of multiple cores)
+    """
+    shapefile_path, out_projection_wkt = args
+    shapefile = ogr.Open(shapefile_path)
+    layer = shapefile.GetLayer()
+    coordinate_transformation = None
+    layer_spatial_reference = layer.GetSpatialRef()
+    if out_projection_wkt and layer_spatial_reference is not None:
+        coordinate_transformation = _get_coordinate_transformation(layer_spatial_reference.ExportToWkt(),
+                                                                   out_projection_wkt)
+    geometry_list = []
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        if coordinate_transformation is not None:
+            geometry.Transform(coordinate_transformation)
+        geometry_list.append(bytes(geometry.ExportToWkb()))
+    shapefile = None
+    return shapefile_path, geometry_list
+
+def get_overview_levels(raster_x_size, raster_y_size, block_size=512):
+    """
+    Returns the overview levels (2, 4, 8, ...) until the overview
+    fits in one block
+    """
+    overview_levels = []
+    overview_level = 2
+    while max(raster_x_size, raster_y_size) // (overview_level // 2) > block_size:
+        overview_levels.append(overview_level)
+        overview_level *= 2
+    return overview_levels
+
+def imap_bounded(pool, function, job_list, max_pending):
+    """
+    Yields the results of the jobs run in the pool in order with at
+    most max_pending jobs sent to the pool and not yet returned (so the
+    results waiting for this process to use them are bounded)
+    """
+    pending_results = deque()
+    for job in job_list:
+        if len(pending_results) >= max_pending:
+            yield pending_results.popleft().get()
+        pending_results.append(pool.apply_async(function, (job,)))
+    while pending_results:
+        yield pending_results.popleft().get()
+
+def read_raster_window(args):
+    """
+    Reads a window of the first band of the raster
+    (can run on one of multiple cores)
+    """
+    raster_file, x_offset, y_offset, x_size, y_size = args
+    raster = gdal.Open(raster_file)
+    window_array = raster.GetRasterBand(1).ReadAsArray(x_offset, y_offset, x_size, y_size)
+    raster = None
+    return x_offset, y_offset, window_array
+
+def read_tile_raster(args):
+    """
+    Reads the first band of the output raster of a DEM tile
+    (can run on one of multiple cores)
+    """
+    tile_name, raster_file = args
+    raster = gdal.Open(raster_file)
+    band = raster.GetRasterBand(1)
+    tile_array = band.ReadAsArray()
+    no_data_value = band.GetNoDataValue()
+    raster = None
+    return tile_name, tile_array, no_data_value
+
+def polygonize_raster_block(args):
+    """
+    Polygonizes a block of the raster (can run on one of multiple cores)
+
+    Returns the raster and the value, WKB and whether it touches another
+    block (seam) of each polygon with a value other than zero
+    """
+    raster_file, x_offset, y_offset, x_size, y_size = args
+    raster = gdal.Open(raster_file)
+    raster_x_size = raster.RasterXSize
+    raster_y_size = raster.RasterYSize
+    block_raster = gdal.Translate('', raster, format='MEM',
+                                  srcWin=[x_offset, y_offset, x_size, y_size])
+    raster = None
+    block_band = block_raster.GetRasterBand(1)
+    polygon_ds = ogr.GetDriverByName('Memory').CreateDataSource('')
+    polygon_layer = polygon_ds.CreateLayer('polygons', geom_type=ogr.wkbPolygon)
+    polygon_layer.CreateField(ogr.FieldDefn('value', ogr.OFTInteger))
+    gdal.Polygonize(block_band, block_band.GetMaskBand(), polygon_layer, 0, [], callback=None)
+
+    #edges of the block shared with other blocks
+    geo_transform = block_raster.GetGeoTransform()
+    half_cell_x = abs(geo_transform[1]) / 2.0
+    half_cell_y = abs(geo_transform[5]) / 2.0
+    block_x_min = geo_transform[0]
+    block_x_max = geo_transform[0] + x_size * geo_transform[1]
+    block_y_max = geo_transform[3]
+    block_y_min = geo_transform[3] + y_size * geo_transform[5]
+    polygon_list = []
+    for feature in polygon_layer:
+        value = feature.GetField('value')
+        if not value:
+            continue
+        geometry = feature.GetGeometryRef()
+        x_min, x_max, y_min, y_max = geometry.GetEnvelope()
+        on_seam = (x_offset > 0 and x_min <= block_x_min + half_cell_x) or \
+                  (x_offset + x_size < raster_x_size and x_max >= block_x_max - half_cell_x) or \
+                  (y_offset > 0 and y_max >= block_y_max - half_cell_y) or \
+                  (y_offset + y_size < raster_y_size and y_min <= block_y_min + half_cell_y)
+        polygon_list.append((value, bytes(geometry.ExportToWkb()), on_seam))
+    polygon_ds = None
+    block_raster = None
+    return raster_file, polygon_list
+
+def _dissolve_seam_polygons(seam_polygon_list):
+    """
+    Dissolves the polygons with the same value that were split by
+    block edges and returns the (value, geometry) of each part
+    """
+    seam_polygons_by_value = {}
+    for value, geometry_wkb in seam_polygon_list:
+        seam_polygons_by_value.setdefault(value, ogr.Geometry(ogr.wkbMultiPolygon)) \
+            .AddGeometry(ogr.CreateGeometryFromWkb(geometry_wkb))
+    for value, seam_polygons in sorted(seam_polygons_by_value.items()):
+        dissolved_geometry = seam_polygons.UnionCascaded()
+        if dissolved_geometry.GetGeometryType() == ogr.wkbPolygon:
+            yield value, dissolved_geometry
+        else:
+            for part_index in range(dissolved_geometry.GetGeometryCount()):
+                yield value, dissolved_geometry.GetGeometryRef(part_index).Clone()
+
+def _write_raster_polygons(raster_file, polygon_list, out_file, simplify_tolerance=0):
+    """
+    Writes the polygons of the blocks of a raster dissolving the
+    polygons across block seams
+    """
+    raster = gdal.Open(raster_file)
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.ImportFromWkt(raster.GetProjection())
+    raster = None
+
+    out_driver = ogr.GetDriverByName(get_vector_driver_name(out_file))
+    if os.path.exists(out_file):
+        out_driver.DeleteDataSource(out_file)
+    out_ds = out_driver.CreateDataSource(out_file)
+    out_layer = out_ds.CreateLayer(os.path.splitext(os.path.basename(out_file))[0],
+                                   spatial_reference, geom_type=ogr.wkbPolygon)
+    out_layer.CreateField(ogr.FieldDefn('value', ogr.OFTInteger))
+    out_layer_definition = out_layer.GetLayerDefn()
+
+    def block_polygons():
+        for value, geometry_wkb, on_seam in polygon_list:
+            if not on_seam:
+                yield value, ogr.CreateGeometryFromWkb(geometry_wkb)
+        for dissolved_polygon in _dissolve_seam_polygons([(value, geometry_wkb) for value, geometry_wkb, on_seam \
+                                                          in polygon_list if on_seam]):
+            yield dissolved_polygon
+
+    use_transactions = out_ds.TestCapability(ogr.ODsCTransactions)
+    if use_transactions:
+        out_ds.StartTransaction()
+    num_polygons = 0
+    for value, geometry in block_polygons():
+        if simplify_tolerance > 0:
+            geometry = geometry.SimplifyPreserveTopology(simplify_tolerance)
+        out_feat = ogr.Feature(out_layer_definition)
+        out_feat.SetField('value', value)
+        out_feat.SetGeometry(geometry)
+        out_layer.CreateFeature(out_feat)
+        out_feat = None
+        num_polygons += 1
+    if use_transactions:
+        out_ds.CommitTransaction()
+    out_ds = None
+    return num_polygons
+
+#------------------------------------------------------------------------------
+#AutoRoute Post Processing Functions
+#------------------------------------------------------------------------------
+def merge_shapefiles(directory, out_shapefile_name, reproject=False, remove_old=False,
+                     num_cpus=1, source_attributes=None, transaction_size=10000,
+                     output_manifest_list=None):
     """
     Merges all shapefiles in a directory
-    Options to reproject and remove old files
+    Options to reproject (to EPSG:4326) and remove old files
+
+    The output format is from the extension of out_shapefile_name
+    (.shp, .gpkg or .fgb). GeoPackage and FlatGeobuf outputs have a
+    spatial index. Each feature has the name of its shapefile in the
+    sub_basin field and the values in source_attributes
+    (i.e. {'return_per': 'return_period_20'}, 10 characters max for .shp).
+
+    The shapefiles are read on num_cpus cores and written in
+    transactions of transaction_size features (if the format supports
+    them). Returns the number of features merged.
+
+    If output_manifest_list is set (see find_output_manifests), the
+    shapefiles with features listed in the manifests are merged instead
+    of searching the directory.
     """
     print("Merging Shapefiles ...")
-    fileList = glob(os.path.join(directory, "*.shp"))
-    if fileList:
-        out_driver = ogr.GetDriverByName( 'ESRI Shapefile' )
-        if os.path.exists(out_shapefile_name):
-            out_driver.DeleteDataSource(out_shapefile_name)
-        out_ds = out_driver.CreateDataSource(out_shapefile_name)
-        out_layer = out_ds.CreateLayer(out_shapefile_name, geom_type=ogr.wkbPolygon)
-        
-        out_projection_file_name = "%s.prj" % os.path.splitext(out_shapefile_name)[0]
+    with span("merge_shapefiles", os.path.basename(os.path.abspath(directory))) as stage_span:
+        shapefile_info_list = None
+        if output_manifest_list is not None:
+            shapefile_info_list = [shapefile_info for shapefile_info \
+                                   in get_manifest_outputs(output_manifest_list, 'shapefile') \
+                                   if shapefile_info['feature_count'] > 0]
+            fileList = [shapefile_info['path'] for shapefile_info in shapefile_info_list]
+        else:
+            fileList = sorted(glob(os.path.join(directory, "*.shp")))
+        fileList = [file_path for file_path in fileList \
+                    if os.path.abspath(file_path) != os.path.abspath(out_shapefile_name)]
+        if not fileList:
+            print("No files found to merge ...")
+            return 0
+
+        #the output is in the projection of the first shapefile unless reprojected
         if reproject:
             out_spatial_reference = osr.SpatialReference()
             out_spatial_reference.ImportFromEPSG(4326) #gcs_wgs_1984
-            out_spatial_reference.MorphToESRI()
-            with open(out_projection_file_name, 'w') as prj_file:
-                prj_file.write(out_spatial_reference.ExportToWkt())
-          
+        elif shapefile_info_list is not None:
+            out_spatial_reference = None
+            if shapefile_info_list[0]['projection']:
+                out_spatial_reference = osr.SpatialReference()
+                out_spatial_reference.ImportFromWkt(shapefile_info_list[0]['projection'])
         else:
-            #create projection file
-            projection_file = glob(os.path.join(directory, "*.prj"))[0]
-            copy(projection_file, out_projection_file_name)
-        
-        for file_path in fileList:
-            ds = ogr.Open(file_path)
-            lyr = ds.GetLayer()
-
-            if reproject:
-                in_spatial_ref = lyr.GetSpatialRef()
-                coordinate_trans = osr.CoordinateTransformation(in_spatial_ref, 
-                                                                out_spatial_reference)
-
-            out_layer_definition = out_layer.GetLayerDefn()
-            for in_feat in lyr:
-                geom = in_feat.GetGeometryRef().Clone()
-                if reproject:
-                    geom.Transform(coordinate_trans)
-                out_feat = ogr.Feature(out_layer_definition)
-                out_feat.SetGeometry(geom)
-                out_layer.CreateFeature(out_feat)
-                out_layer.SyncToDisk()
-                out_feat.Destroy()
-                in_feat.Destroy()
-                
-            ds.Destroy() #close the shapefile
-            if remove_old:
-                out_driver.DeleteDataSource(file_path)
-                
-        #close the output shapefile
-        out_ds.Destroy()
-    else:
-        print("No files found to merge ...")
+            first_shapefile = ogr.Open(fileList[0])
+            out_spatial_reference = first_shapefile.GetLayer().GetSpatialRef()
+            first_shapefile = None
+        out_projection_wkt = out_spatial_reference.ExportToWkt() if out_spatial_reference is not None else ""
+
+        driver_name = get_vector_driver_name(out_shapefile_name)
+        out_driver = ogr.GetDriverByName(driver_name)
+        if out_driver is None:
+            raise Exception("ERROR: {0} driver not available in this version of GDAL ...".format(driver_name))
+        if os.path.exists(out_shapefile_name):
+            out_driver.DeleteDataSource(out_shapefile_name)
+        out_ds = out_driver.CreateDataSource(out_shapefile_name)
+        layer_options = []
+        geometry_type = ogr.wkbPolygon
+        if driver_name != 'ESRI Shapefile':
+            layer_options = ['SPATIAL_INDEX=YES']
+            #shapefile polygons can be single or multi part
+            geometry_type = ogr.wkbMultiPolygon
+        out_layer = out_ds.CreateLayer(os.path.splitext(os.path.basename(out_shapefile_name))[0],
+                                       out_spatial_reference, geom_type=geometry_type,
+                                       options=layer_options)
+        source_attributes = source_attributes or {}
+        attribute_field_types = {int: ogr.OFTInteger, float: ogr.OFTReal}
+        sub_basin_field = ogr.FieldDefn('sub_basin', ogr.OFTString)
+        sub_basin_field.SetWidth(254)
+        out_layer.CreateField(sub_basin_field)
+        for attribute_name, attribute_value in sorted(source_attributes.items()):
+            out_layer.CreateField(ogr.FieldDefn(attribute_name,
+                                                attribute_field_types.get(type(attribute_value),
+                                                                          ogr.OFTString)))
+        out_layer_definition = out_layer.GetLayerDefn()
+
+        job_list = [(file_path, out_projection_wkt) for file_path in fileList]
+        pool = None
+        if num_cpus > 1 and len(fileList) > 1:
+            pool = multiprocessing.Pool(min(num_cpus, len(fileList)))
+            shapefile_geometries = pool.imap(read_shapefile_geometries, job_list)
+        else:
+            shapefile_geometries = (read_shapefile_geometries(job) for job in job_list)
+
+        use_transactions = out_ds.TestCapability(ogr.ODsCTransactions)
+        if use_transactions:
+            out_ds.StartTransaction()
+        num_features = 0
+        try:
+            for file_path, geometry_list in shapefile_geometries:
+                sub_basin = os.path.splitext(os.path.basename(file_path))[0]
+                for geometry_wkb in geometry_list:
+                    geometry = ogr.CreateGeometryFromWkb(geometry_wkb)
+                    if geometry_type == ogr.wkbMultiPolygon:
+                        geometry = ogr.ForceToMultiPolygon(geometry)
+                    out_feat = ogr.Feature(out_layer_definition)
+                    out_feat.SetField('sub_basin', sub_basin)
+                    for attribute_name, attribute_value in source_attributes.items():
+                        out_feat.SetField(attribute_name, attribute_value)
+                    out_feat.SetGeometry(geometry)
+                    out_layer.CreateFeature(out_feat)
+                    out_feat = None
+                    num_features += 1
+                    if use_transactions and num_features % transaction_size == 0:
+                        out_ds.CommitTransaction()
+                        out_ds.StartTransaction()
+            if use_transactions:
+                out_ds.CommitTransaction()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        #close the output file
+        out_ds = None
+
+        if remove_old:
+            shapefile_driver = ogr.GetDriverByName('ESRI Shapefile')
+            for file_path in fileList:
+                shapefile_driver.DeleteDataSource(file_path)
+
+        stage_span.set(num_shapefiles=len(fileList), num_features=num_features)
+        return num_features
                 
-def rename_shapefiles(directory, out_shapefile_basename, startswith):
+def rename_shapefiles(directory, out_shapefile_basename, startswith, shapefile_parts=None):
     """
     Renames all shapefiles in a directory
+
+    If shapefile_parts is set (i.e. from the output manifest),
+    those files are renamed instead of searching the directory.
+    Returns the renamed files.
     """
 
     print("Renaming Shapefiles ...")
-    fileList = glob(os.path.join(directory, "%s*" % startswith))
+    if shapefile_parts is not None:
+        fileList = shapefile_parts
+    else:
+        fileList = glob(os.path.join(directory, "%s*" % startswith))
+    renamed_file_list = []
     for file_name in fileList:
         extension = os.path.splitext(file_name)[1]
-        os.rename(file_name, os.path.join(directory, "%s%s" % (out_shapefile_basename, extension)))
+        renamed_file_list.append(os.path.join(directory, "%s%s" % (out_shapefile_basename, extension)))
+        os.rename(file_name, renamed_file_list[-1])
+    return renamed_file_list
         
             
-def get_shapefile_layergroup_bounds(shapefile_paths):
+def get_shapefile_layergroup_bounds(shapefile_paths=(), shapefile_info_list=None):
     """
     Gets the extent of all of the shapefiles combined
+
+    If shapefile_info_list is set (from the output manifests), the
+    extents and EPSG codes in it are used instead of opening the files
+
+    The EPSG code returned is the one of the first shapefile (a warning
+    is printed if the others differ) and is "EPSG:None" if unknown
     """
     lon_min = 99999999
     lon_max = -99999999
     lat_min = 99999999
     lat_max = -99999999
-    inDriver = ogr.GetDriverByName("ESRI Shapefile")
+    if shapefile_info_list is None:
+        shapefile_info_list = []
+        inDriver = ogr.GetDriverByName("ESRI Shapefile")
+        for shapefile_path in shapefile_paths:
+            inDataSource = inDriver.Open(shapefile_path, 0)
+            inLayer = inDataSource.GetLayer()
+            spatialRef = inLayer.GetSpatialRef()
+            layer_epsg_code = spatialRef.GetAttrValue("AUTHORITY", 1) if spatialRef is not None else None
+            shapefile_info_list.append({'extent': inLayer.GetExtent(),
+                                        'epsg': "EPSG:%s" % layer_epsg_code if layer_epsg_code else None})
     epsg_code = None
-    for shapefile_path in shapefile_paths:
-        inDataSource = inDriver.Open(shapefile_path, 0)
-        inLayer = inDataSource.GetLayer()
-        extent = inLayer.GetExtent()
+    for shapefile_info in shapefile_info_list:
+        extent = shapefile_info['extent']
+        if extent is None:
+            #no features
+            continue
         lon_min = min(lon_min, extent[0])
         lon_max = max(lon_max, extent[1])
         lat_min = min(lat_min, extent[2])
         lat_max = max(lat_max, extent[3])
-        spatialRef = inLayer.GetSpatialRef()
-        layer_epsg = "EPSG:%s" % spatialRef.GetAttrValue("AUTHORITY", 1)
+        layer_epsg = shapefile_info['epsg'] or "EPSG:None"
         if epsg_code==None:
             epsg_code = layer_epsg
-        elif layer_epsg != layer_epsg:
-            raise Exception("Projection EPSG codes don't match!")
+        elif layer_epsg != epsg_code:
+            print("WARNING: Projection EPSG codes don't match ({0} and {1}) ...".format(epsg_code, layer_epsg))
         
     return [str(lon_min), str(lon_max), str(lat_min), str(lat_max), epsg_code]
-    
-    
+
+def mosaic_rasters(directory, out_vrt_file, raster_pattern=FLOOD_RASTER_PATTERNS['flood_map'],
+                   out_cog_file="", num_cpus=1, block_size=512, compression="DEFLATE",
+                   overview_resampling="NEAREST", overview_levels=None, output_manifest_list=None):
+    """
+    Builds a VRT over the sub-basin rasters in the directory matching
+    raster_pattern (i.e. FLOOD_RASTER_PATTERNS['flood_depth'])
+
+    If out_cog_file is set, the mosaic is also written as a Cloud
+    Optimized GeoTIFF: tiled (block_size), compressed and with internal
+    overviews. The blocks of the mosaic are read from the sub-basin
+    rasters on num_cpus cores. Returns the list of rasters in the mosaic.
+
+    If output_manifest_list is set, the rasters matching raster_pattern
+    in the manifests are used instead of searching the directory.
+    """
+    print("Building raster mosaic ...")
+    with span("mosaic_rasters", os.path.basename(os.path.abspath(directory))) as stage_span:
+        raster_info_list = None
+        if output_manifest_list is not None:
+            raster_info_list = get_manifest_outputs(output_manifest_list, 'flood_map', raster_pattern) + \
+                               get_manifest_outputs(output_manifest_list, 'flood_depth', raster_pattern)
+            raster_list = sorted(raster_info['path'] for raster_info in raster_info_list)
+        else:
+            raster_list = sorted(glob(os.path.join(directory, raster_pattern)))
+        if not raster_list:
+            print("No rasters found to mosaic ...")
+            return raster_list
+
+        if raster_info_list:
+            no_data_value = raster_info_list[0]['no_data_value']
+        else:
+            first_raster = gdal.Open(raster_list[0])
+            no_data_value = first_raster.GetRasterBand(1).GetNoDataValue()
+            first_raster = None
+        vrt_options = None
+        if no_data_value is not None:
+            vrt_options = gdal.BuildVRTOptions(srcNodata=no_data_value, VRTNodata=no_data_value)
+        mosaic_vrt = gdal.BuildVRT(out_vrt_file, raster_list, options=vrt_options)
+        mosaic_vrt = None
+        stage_span.set(num_rasters=len(raster_list))
+        if not out_cog_file:
+            return raster_list
+
+        #tiled copy of the mosaic filled block row by block row
+        mosaic_vrt = gdal.Open(out_vrt_file)
+        x_size = mosaic_vrt.RasterXSize
+        y_size = mosaic_vrt.RasterYSize
+        data_type = mosaic_vrt.GetRasterBand(1).DataType
+        tiled_options = ['TILED=YES',
+                         'BLOCKXSIZE={0}'.format(block_size),
+                         'BLOCKYSIZE={0}'.format(block_size),
+                         'COMPRESS={0}'.format(compression),
+                         'NUM_THREADS={0}'.format(max(1, num_cpus)),
+                         'BIGTIFF=IF_SAFER']
+        temp_tiled_file = "{0}.tiled.tif".format(os.path.splitext(out_cog_file)[0])
+        tiled_raster = gdal.GetDriverByName('GTiff').Create(temp_tiled_file, x_size, y_size,
+                                                            1, data_type, options=tiled_options)
+        tiled_raster.SetGeoTransform(mosaic_vrt.GetGeoTransform())
+        tiled_raster.SetProjection(mosaic_vrt.GetProjection())
+        tiled_band = tiled_raster.GetRasterBand(1)
+        if no_data_value is not None:
+            tiled_band.SetNoDataValue(no_data_value)
+            tiled_band.Fill(no_data_value)
+        mosaic_vrt = None
+
+        window_list = [(out_vrt_file, 0, y_offset, x_size, min(block_size, y_size - y_offset)) \
+                       for y_offset in range(0, y_size, block_size)]
+        pool = None
+        if num_cpus > 1 and len(window_list) > 1:
+            pool = multiprocessing.Pool(min(num_cpus, len(window_list)))
+            #only a few full width windows are in memory at once
+            window_arrays = imap_bounded(pool, read_raster_window, window_list, num_cpus * 2)
+        else:
+            window_arrays = (read_raster_window(window) for window in window_list)
+        try:
+            #GeoTIFF blocks are only written from this process
+            for x_offset, y_offset, window_array in window_arrays:
+                tiled_band.WriteArray(window_array, x_offset, y_offset)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if overview_levels is None:
+            overview_levels = get_overview_levels(x_size, y_size, block_size)
+        if overview_levels:
+            gdal.SetConfigOption('COMPRESS_OVERVIEW', compression)
+            tiled_raster.BuildOverviews(overview_resampling, overview_levels)
+            gdal.SetConfigOption('COMPRESS_OVERVIEW', None)
+        tiled_band = None
+        tiled_raster = None
+
+        #copy with the overviews before the full resolution blocks
+        gdal.Translate(out_cog_file, temp_tiled_file,
+                       creationOptions=tiled_options + ['COPY_SRC_OVERVIEWS=YES'])
+        os.remove(temp_tiled_file)
+        stage_span.set(num_overviews=len(overview_levels))
+        return raster_list
+
+def polygonize_rasters(directory, out_directory="", raster_pattern=FLOOD_RASTER_PATTERNS['flood_map'],
+                       num_cpus=1, block_size=2048, simplify_tolerance=0, out_extension=".shp",
+                       output_manifest_list=None):
+    """
+    Polygonizes the sub-basin rasters in the directory matching
+    raster_pattern instead of generating shapefiles with AutoRoute
+
+    Each raster is split into blocks of block_size cells polygonized on
+    num_cpus cores, and the polygons split by block edges are dissolved.
+    If simplify_tolerance (map units) is set, the polygons are simplified
+    preserving topology to control their complexity.
+
+    The output of flood_map_raster_{name}.tif is {name}{out_extension}
+    (.shp, .gpkg or .fgb) in out_directory (default is directory), the
+    same name as the shapefile from run_autoroute_multiprocess.
+    Returns the list of output files.
+
+    If output_manifest_list is set, the rasters matching raster_pattern
+    in the manifests are polygonized instead of searching the directory
+    (and their sizes are not read from the files).
+    """
+    print("Polygonizing rasters ...")
+    if not out_directory:
+        out_directory = directory
+    with span("polygonize_rasters", os.path.basename(os.path.abspath(directory))) as stage_span:
+        raster_sizes = {}
+        if output_manifest_list is not None:
+            for output_type in ('flood_map', 'flood_depth'):
+                for raster_info in get_manifest_outputs(output_manifest_list, output_type, raster_pattern):
+                    raster_sizes[raster_info['path']] = (raster_info['x_size'], raster_info['y_size'])
+            raster_list = sorted(raster_sizes)
+        else:
+            raster_list = sorted(glob(os.path.join(directory, raster_pattern)))
+        if not raster_list:
+            print("No rasters found to polygonize ...")
+            return []
+
+        block_job_list = []
+        num_raster_blocks = {}
+        for raster_file in raster_list:
+            if raster_file in raster_sizes:
+                x_size, y_size = raster_sizes[raster_file]
+            else:
+                raster = gdal.Open(raster_file)
+                x_size = raster.RasterXSize
+                y_size = raster.RasterYSize
+                raster = None
+            for y_offset in range(0, y_size, block_size):
+                for x_offset in range(0, x_size, block_size):
+                    block_job_list.append((raster_file, x_offset, y_offset,
+                                           min(block_size, x_size - x_offset),
+                                           min(block_size, y_size - y_offset)))
+            num_raster_blocks[raster_file] = len(block_job_list) - sum(num_raster_blocks.values())
+
+        pool = None
+        if num_cpus > 1 and len(block_job_list) > 1:
+            pool = multiprocessing.Pool(min(num_cpus, len(block_job_list)))
+            block_polygons = pool.imap_unordered(polygonize_raster_block, block_job_list)
+        else:
+            block_polygons = (polygonize_raster_block(block_job) for block_job in block_job_list)
+
+        out_file_list = []
+        raster_polygons = {}
+        num_polygons = 0
+        try:
+            for raster_file, polygon_list in block_polygons:
+                raster_polygons.setdefault(raster_file, []).extend(polygon_list)
+                num_raster_blocks[raster_file] -= 1
+                if num_raster_blocks[raster_file] > 0:
+                    continue
+                #all blocks of the raster are done
+                out_name = os.path.splitext(os.path.basename(raster_file))[0]
+                if out_name.startswith("flood_map_raster_"):
+                    out_name = out_name[len("flood_map_raster_"):]
+                out_file = os.path.join(out_directory, "{0}{1}".format(out_name, out_extension))
+                num_polygons += _write_raster_polygons(raster_file, raster_polygons.pop(raster_file),
+                                                       out_file, simplify_tolerance)
+                out_file_list.append(out_file)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        stage_span.set(num_rasters=len(raster_list), num_blocks=len(block_job_list),
+                       num_polygons=num_polygons)
+        return sorted(out_file_list)
+
+def stitch_tile_rasters(tile_index_file, raster_directory, out_raster_file,
+                        raster_type='flood_map', num_cpus=1, output_manifest_list=None):
+    """
+    Recombines the flood map or depth rasters (raster_type 'flood_map' or
+    'flood_depth') of the tiles of a DEM split with tile_dem into one
+    raster on the grid of the DEM. Where the halos of the tiles overlap
+    the largest value is kept so there are no seams at the tile edges.
+
+    The rasters of the tiles are found by name in raster_directory or in
+    the output manifests (output_manifest_list) and read on num_cpus
+    cores. Returns the number of tiles stitched.
+    """
+    print("Stitching tile rasters ...")
+    with span("stitch_tile_rasters", os.path.basename(os.path.abspath(raster_directory))) as stage_span:
+        tile_index = read_dem_tile_index(tile_index_file)
+        tile_rasters = {}
+        if output_manifest_list is not None:
+            for output_manifest in output_manifest_list:
+                raster_info = output_manifest['outputs'].get(raster_type)
+                tile_name = os.path.basename(output_manifest.get('input_directory', ""))
+                if raster_info and tile_name in tile_index['tiles']:
+                    tile_rasters[tile_name] = raster_info['path']
+        else:
+            raster_prefix = FLOOD_RASTER_PATTERNS[raster_type].split("*")[0]
+            for tile_name in tile_index['tiles']:
+                raster_file = os.path.join(raster_directory, "{0}{1}_{2}.tif".format(raster_prefix,
+                                                                                    tile_index['watershed'],
+                                                                                    tile_name))
+                if os.path.exists(raster_file):
+                    tile_rasters[tile_name] = raster_file
+        if not tile_rasters:
+            print("No tile rasters found to stitch ...")
+            return 0
+
+        first_raster = gdal.Open(tile_rasters[sorted(tile_rasters)[0]])
+        data_type = first_raster.GetRasterBand(1).DataType
+        out_no_data_value = first_raster.GetRasterBand(1).GetNoDataValue()
+        first_raster = None
+        out_raster = gdal.GetDriverByName('GTiff').Create(out_raster_file,
+                                                          tile_index['x_size'],
+                                                          tile_index['y_size'],
+                                                          1, data_type,
+                                                          options=['TILED=YES',
+                                                                   'COMPRESS=DEFLATE',
+                                                                   'BIGTIFF=IF_SAFER'])
+        out_raster.SetGeoTransform(tile_index['geotransform'])
+        out_raster.SetProjection(tile_index['projection'])
+        out_band = out_raster.GetRasterBand(1)
+        if out_no_data_value is not None:
+            out_band.SetNoDataValue(out_no_data_value)
+            out_band.Fill(out_no_data_value)
+
+        tile_job_list = sorted(tile_rasters.items())
+        pool = None
+        if num_cpus > 1 and len(tile_job_list) > 1:
+            pool = multiprocessing.Pool(min(num_cpus, len(tile_job_list)))
+            tile_arrays = pool.imap_unordered(read_tile_raster, tile_job_list)
+        else:
+            tile_arrays = (read_tile_raster(tile_job) for tile_job in tile_job_list)
+        try:
+            #the output raster is only written from this process
+            for tile_name, tile_array, no_data_value in tile_arrays:
+                x_offset, y_offset, x_size, y_size = tile_index['tiles'][tile_name]['halo_window']
+                if tile_array.shape != (y_size, x_size):
+                    raise Exception("ERROR: Raster of {0} does not match the tile ({1} instead of {2}) ...".format(tile_name,
+                                                                                                                 tile_array.shape,
+                                                                                                                 (y_size, x_size)))
+                out_array = out_band.ReadAsArray(x_offset, y_offset, x_size, y_size)
+                if no_data_value is not None:
+                    tile_valid_index = tile_array != no_data_value
+                else:
+                    tile_valid_index = np.ones(tile_array.shape, dtype=bool)
+                replace_index = tile_valid_index & (tile_array > out_array)
+                if out_no_data_value is not None:
+                    replace_index |= tile_valid_index & (out_array == out_no_data_value)
+                out_array[replace_index] = tile_array[replace_index]
+                out_band.WriteArray(out_array, x_offset, y_offset)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        out_band = None
+        out_raster = None
+        stage_span.set(num_tiles=len(tile_job_list))
+        return len(tile_job_list)
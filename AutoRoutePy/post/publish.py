@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+##
+##  publish.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+from base64 import b64encode
+from io import BytesIO
+import os
+import threading
+from time import sleep, time
+from zipfile import ZipFile
+
+try:
+    from queue import Queue
+    from urllib.request import Request, urlopen
+except ImportError:
+    #python 2
+    from Queue import Queue
+    from urllib2 import Request, urlopen
+
+#local imports
+from ..instrumentation import span
+
+#------------------------------------------------------------------------------
+#Upload Functions
+#------------------------------------------------------------------------------
+def upload_shapefile_rest(geoserver_url, workspace, resource_name, shapefile_list,
+                          username="", password="", timeout=60):
+    """
+    Uploads the parts of a shapefile (.shp, .shx, .dbf, .prj) as a zip
+    file to the GeoServer REST API (creates or replaces the store)
+    """
+    zip_buffer = BytesIO()
+    with ZipFile(zip_buffer, 'w') as shapefile_zip:
+        for shapefile_part in shapefile_list:
+            shapefile_zip.write(shapefile_part,
+                                "{0}{1}".format(resource_name, os.path.splitext(shapefile_part)[1]))
+    request = Request("{0}/rest/workspaces/{1}/datastores/{2}/file.shp?update=overwrite" \
+                      .format(geoserver_url.rstrip("/"), workspace, resource_name),
+                      data=zip_buffer.getvalue(),
+                      headers={'Content-type': 'application/zip'})
+    request.get_method = lambda: 'PUT'
+    if username:
+        request.add_header('Authorization',
+                           "Basic {0}".format(b64encode("{0}:{1}".format(username, password).encode('utf-8')) \
+                                              .decode('ascii')))
+    response = urlopen(request, timeout=timeout)
+    response.read()
+    response.close()
+
+#------------------------------------------------------------------------------
+#Publisher Class
+#------------------------------------------------------------------------------
+class ShapefilePublisher(object):
+    """
+    Uploads shapefiles with a pool of threads as they are submitted
+    (i.e. while the simulations of other watersheds still run)
+
+    upload_function(resource_name, shapefile_list) uploads one shapefile
+    and is retried max_retries times with exponential backoff if it
+    raises an exception (as is group_function). At most max_queue_size uploads wait in the queue
+    (submit blocks when it is full).
+
+    Uploads belong to a group (i.e. a watershed and return period). Once
+    a group is finished and all of its uploads are done,
+    group_function(group_name, upload_list) is called with the
+    (resource name, shapefile) of each successful upload.
+    """
+    def __init__(self, upload_function, group_function=None, num_threads=4,
+                 max_queue_size=16, max_retries=3, retry_delay=1.0):
+        self.upload_function = upload_function
+        self.group_function = group_function
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.failed_upload_list = []
+        self.num_uploads = 0
+        self.num_retries = 0
+        self._upload_queue = Queue(max_queue_size)
+        self._group_lock = threading.Lock()
+        self._groups = {}
+        self._time_start = time()
+        self._upload_thread_list = []
+        for thread_index in range(max(1, num_threads)):
+            upload_thread = threading.Thread(target=self._upload_worker)
+            upload_thread.daemon = True
+            upload_thread.start()
+            self._upload_thread_list.append(upload_thread)
+
+    def _get_group(self, group_name):
+        """
+        Returns the uploads of the group (call with the group lock)
+        """
+        return self._groups.setdefault(group_name, {'num_pending': 0,
+                                                    'finished': False,
+                                                    'upload_list': []})
+
+    def _finish_group_if_done(self, group_name):
+        """
+        Calls group_function if the group is finished and has no
+        pending uploads (only once per group)
+        """
+        with self._group_lock:
+            group = self._groups[group_name]
+            if not group['finished'] or group['num_pending'] > 0 or group.get('done'):
+                return
+            group['done'] = True
+        if self.group_function is not None:
+            group_error = self._call_with_retry("publish_layer_group", group_name,
+                                                self.group_function, group_name,
+                                                list(group['upload_list']))
+            if group_error is not None:
+                print("ERROR: Group {0} failed: {1}".format(group_name, group_error))
+                with self._group_lock:
+                    self.failed_upload_list.append((group_name, group_error))
+
+    def _call_with_retry(self, stage, name, function, *args):
+        """
+        Calls the function retrying with exponential backoff and
+        returns the error of the last attempt (None if it succeeded)
+        """
+        with span(stage, sub_basin=name) as publish_span:
+            for attempt in range(self.max_retries + 1):
+                publish_span.set(attempts=attempt + 1)
+                try:
+                    function(*args)
+                    return None
+                except Exception as ex:
+                    if attempt >= self.max_retries:
+                        return str(ex)
+                    with self._group_lock:
+                        self.num_retries += 1
+                    print("{0} failed ({1}). Retrying ...".format(name, ex))
+                    sleep(self.retry_delay * 2 ** attempt)
+
+    def _upload_worker(self):
+        """
+        Uploads the shapefiles in the queue until it gets None
+        """
+        while True:
+            upload_job = self._upload_queue.get()
+            if upload_job is None:
+                self._upload_queue.task_done()
+                return
+            group_name, resource_name, upload_shapefile, shapefile_list = upload_job
+            upload_error = self._call_with_retry("publish_shapefile", resource_name,
+                                                 self.upload_function, resource_name,
+                                                 shapefile_list)
+            with self._group_lock:
+                group = self._groups[group_name]
+                group['num_pending'] -= 1
+                if upload_error is None:
+                    self.num_uploads += 1
+                    group['upload_list'].append((resource_name, upload_shapefile))
+                else:
+                    print("ERROR: Upload of {0} failed: {1}".format(resource_name, upload_error))
+                    self.failed_upload_list.append((resource_name, upload_error))
+            self._finish_group_if_done(group_name)
+            self._upload_queue.task_done()
+
+    def submit(self, group_name, resource_name, upload_shapefile, shapefile_list=None):
+        """
+        Queues the shapefile for upload (shapefile_list is all of the
+        parts of the shapefile, default is upload_shapefile with .shx,
+        .dbf and .prj)
+        """
+        if shapefile_list is None:
+            shapefile_base = os.path.splitext(upload_shapefile)[0]
+            shapefile_list = ["{0}{1}".format(shapefile_base, extension) \
+                              for extension in ('.shp', '.shx', '.dbf', '.prj') \
+                              if os.path.exists("{0}{1}".format(shapefile_base, extension))]
+        with self._group_lock:
+            self._get_group(group_name)['num_pending'] += 1
+        self._upload_queue.put((group_name, resource_name, upload_shapefile, shapefile_list))
+
+    def finish_group(self, group_name):
+        """
+        Marks that all of the uploads of the group were submitted
+        """
+        with self._group_lock:
+            self._get_group(group_name)['finished'] = True
+        self._finish_group_if_done(group_name)
+
+    def close(self):
+        """
+        Waits for the queued uploads to finish and stops the threads.
+        Returns the (resource name, error) of the failed uploads.
+        """
+        for upload_thread in self._upload_thread_list:
+            self._upload_queue.put(None)
+        for upload_thread in self._upload_thread_list:
+            upload_thread.join()
+        print("Uploaded {0} shapefiles in {1:.1f} seconds ({2} retries, {3} failed) ...".format(self.num_uploads,
+                                                                                               time() - self._time_start,
+                                                                                               self.num_retries,
+                                                                                               len(self.failed_upload_list)))
+        return self.failed_upload_list
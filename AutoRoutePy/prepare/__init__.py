@@ -4,3 +4,4 @@ from .prepare_multiprocess import (prepare_autoroute_streamflow_single_folder,
                                    prepare_autoroute_single_folder,
                                    prepare_autoroute_multiprocess)
 from .reproject_raster import reproject_lu_raster
+from .tile_dem import tile_dem
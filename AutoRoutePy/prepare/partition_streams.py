@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+##
+##  partition_streams.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License BSD 3-Clause
+
+from glob import glob
+import os
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+try:
+    from rtree import index as rtree_index
+except ImportError:
+    #the bounding boxes are searched with numpy instead
+    rtree_index = None
+
+#stream network of the sub-basin written in each folder
+STREAM_NETWORK_SUBSET_NAME = "stream_network_subset.shp"
+
+#points per edge of the DEM transformed to the stream network projection
+EXTENT_EDGE_POINTS = 5
+
+#------------------------------------------------------------------------------
+#Stream Network Index Class
+#------------------------------------------------------------------------------
+class StreamNetworkIndex(object):
+    """
+    Spatial index of the bounding boxes of the reaches of a stream network
+    (an R-tree if rtree is installed, otherwise arrays searched with numpy)
+    """
+    def __init__(self, fid_array, envelope_array, use_rtree=True):
+        #envelopes are (min x, max x, min y, max y) as from OGR
+        self.fid_array = np.asarray(fid_array, dtype=np.int64)
+        self.envelope_array = np.asarray(envelope_array, dtype=np.float64).reshape((-1, 4))
+        self._rtree = None
+        if use_rtree and rtree_index is not None and len(self.fid_array) > 0:
+            self._rtree = rtree_index.Index((feature_index, (envelope[0], envelope[2], envelope[1], envelope[3]), None) \
+                                            for feature_index, envelope in enumerate(self.envelope_array))
+
+    @classmethod
+    def from_layer(cls, layer, use_rtree=True):
+        """
+        Reads the bounding box of each feature of the layer
+        (the geometries are not kept)
+        """
+        fid_list = []
+        envelope_list = []
+        layer.ResetReading()
+        for feature in layer:
+            geometry = feature.GetGeometryRef()
+            if geometry is None:
+                continue
+            fid_list.append(feature.GetFID())
+            envelope_list.append(geometry.GetEnvelope())
+        layer.ResetReading()
+        return cls(fid_list, envelope_list, use_rtree)
+
+    def query(self, extent):
+        """
+        Returns the FIDs of the features with a bounding box
+        intersecting the extent (min x, max x, min y, max y)
+        """
+        if self._rtree is not None:
+            feature_index_array = np.array(sorted(self._rtree.intersection((extent[0], extent[2],
+                                                                             extent[1], extent[3]))),
+                                           dtype=np.int64)
+        else:
+            envelope_array = self.envelope_array
+            feature_index_array = np.where((envelope_array[:, 0] <= extent[1]) &
+                                           (envelope_array[:, 1] >= extent[0]) &
+                                           (envelope_array[:, 2] <= extent[3]) &
+                                           (envelope_array[:, 3] >= extent[2]))[0]
+        return self.fid_array[feature_index_array]
+
+#------------------------------------------------------------------------------
+#Helper Functions
+#------------------------------------------------------------------------------
+def _get_spatial_reference(projection_wkt):
+    """
+    Returns the spatial reference in longitude/latitude order
+    """
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.ImportFromWkt(projection_wkt)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        #GDAL 3 uses latitude/longitude order for EPSG:4326
+        spatial_reference.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return spatial_reference
+
+def find_sub_folder_dem(sub_folder, dem_extension='img'):
+    """
+    Returns the DEM of the folder before or after it is renamed
+    to elevation (None if not found)
+    """
+    elevation_dem_file = os.path.join(sub_folder, 'elevation.{0}'.format(dem_extension))
+    if os.path.exists(elevation_dem_file):
+        return elevation_dem_file
+    dem_file_list = sorted(glob(os.path.join(sub_folder, '*.{0}'.format(dem_extension))))
+    if dem_file_list:
+        return dem_file_list[0]
+    return None
+
+def get_dem_polygon(dem_file, out_projection_wkt=""):
+    """
+    Returns the outline of the DEM as a polygon in the output
+    projection (the edges are densified so the outline stays
+    correct when the projection bends them)
+    """
+    dem_raster = gdal.Open(dem_file)
+    geotransform = dem_raster.GetGeoTransform()
+    x_size = dem_raster.RasterXSize
+    y_size = dem_raster.RasterYSize
+    dem_projection_wkt = dem_raster.GetProjection()
+    dem_raster = None
+
+    pixel_list = []
+    for edge_point in range(EXTENT_EDGE_POINTS):
+        pixel_list.append((x_size * edge_point / float(EXTENT_EDGE_POINTS), 0))
+    for edge_point in range(EXTENT_EDGE_POINTS):
+        pixel_list.append((x_size, y_size * edge_point / float(EXTENT_EDGE_POINTS)))
+    for edge_point in range(EXTENT_EDGE_POINTS):
+        pixel_list.append((x_size * (1 - edge_point / float(EXTENT_EDGE_POINTS)), y_size))
+    for edge_point in range(EXTENT_EDGE_POINTS):
+        pixel_list.append((0, y_size * (1 - edge_point / float(EXTENT_EDGE_POINTS))))
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for pixel_x, pixel_y in pixel_list + pixel_list[:1]:
+        ring.AddPoint_2D(geotransform[0] + pixel_x * geotransform[1] + pixel_y * geotransform[2],
+                         geotransform[3] + pixel_x * geotransform[4] + pixel_y * geotransform[5])
+    dem_polygon = ogr.Geometry(ogr.wkbPolygon)
+    dem_polygon.AddGeometry(ring)
+
+    if out_projection_wkt and dem_projection_wkt:
+        dem_spatial_reference = _get_spatial_reference(dem_projection_wkt)
+        out_spatial_reference = _get_spatial_reference(out_projection_wkt)
+        if not dem_spatial_reference.IsSame(out_spatial_reference):
+            dem_polygon.Transform(osr.CoordinateTransformation(dem_spatial_reference,
+                                                               out_spatial_reference))
+    return dem_polygon
+
+def write_stream_network_subset(layer, fid_list, dem_polygon, out_shapefile):
+    """
+    Writes the features of the layer in fid_list that intersect the
+    DEM to a shapefile (whole reaches so their attributes still apply)
+    """
+    shapefile_driver = ogr.GetDriverByName('ESRI Shapefile')
+    if os.path.exists(out_shapefile):
+        shapefile_driver.DeleteDataSource(out_shapefile)
+    out_ds = shapefile_driver.CreateDataSource(out_shapefile)
+    out_layer = out_ds.CreateLayer(os.path.splitext(os.path.basename(out_shapefile))[0],
+                                   layer.GetSpatialRef(), geom_type=layer.GetGeomType())
+    layer_definition = layer.GetLayerDefn()
+    for field_index in range(layer_definition.GetFieldCount()):
+        out_layer.CreateField(layer_definition.GetFieldDefn(field_index))
+    out_layer_definition = out_layer.GetLayerDefn()
+    num_features = 0
+    for fid in fid_list:
+        feature = layer.GetFeature(int(fid))
+        geometry = feature.GetGeometryRef()
+        if geometry is None or not geometry.Intersects(dem_polygon):
+            continue
+        out_feature = ogr.Feature(out_layer_definition)
+        out_feature.SetFrom(feature)
+        out_layer.CreateFeature(out_feature)
+        out_feature = None
+        num_features += 1
+    out_ds = None
+    return num_features
+
+#------------------------------------------------------------------------------
+#Main Function
+#------------------------------------------------------------------------------
+def partition_stream_network(stream_network_shapefile, sub_folder_list, dem_extension='img',
+                             use_rtree=True):
+    """
+    Writes the reaches of the stream network that intersect the DEM of
+    each sub folder to stream_network_subset.shp in the folder so each
+    sub-basin only reads its own reaches. The bounding boxes of the
+    reaches are indexed once (see StreamNetworkIndex).
+
+    Returns the subset shapefile of each sub folder (folders without a
+    DEM are left out).
+    """
+    print("Partitioning the stream network ...")
+    stream_network = ogr.Open(stream_network_shapefile)
+    layer = stream_network.GetLayer()
+    layer_spatial_reference = layer.GetSpatialRef()
+    layer_projection_wkt = layer_spatial_reference.ExportToWkt() \
+                           if layer_spatial_reference is not None else ""
+    stream_network_index = StreamNetworkIndex.from_layer(layer, use_rtree)
+
+    stream_network_subsets = {}
+    for sub_folder in sub_folder_list:
+        dem_file = find_sub_folder_dem(sub_folder, dem_extension)
+        if dem_file is None:
+            print("No DEM found in {0}. Skipping ...".format(sub_folder))
+            continue
+        dem_polygon = get_dem_polygon(dem_file, layer_projection_wkt)
+        fid_list = stream_network_index.query(dem_polygon.GetEnvelope())
+        out_shapefile = os.path.join(sub_folder, STREAM_NETWORK_SUBSET_NAME)
+        num_features = write_stream_network_subset(layer, fid_list, dem_polygon, out_shapefile)
+        print("{0}: {1} reaches".format(os.path.basename(sub_folder), num_features))
+        stream_network_subsets[sub_folder] = out_shapefile
+    stream_network = None
+    return stream_network_subsets
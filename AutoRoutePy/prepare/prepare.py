@@ -7,17 +7,25 @@
 ##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
 ##  License BSD 3-Clause
 
-import csv
 import datetime
-from io import open
 import os
-from subprocess import Popen, PIPE
 
-from netCDF4 import Dataset
 import numpy as np
 from osgeo import gdal, ogr, osr
-from RAPIDpy.dataset import RAPIDDataset
-from RAPIDpy.helper_functions import csv_to_list, open_csv
+
+from ..executable import run_executable
+from ..instrumentation import span
+from .partition_streams import get_dem_polygon
+from .stream_info import (read_stream_info_table,
+                          remove_stream_info_cache,
+                          write_stream_info_table)
+from .streamflow import (DEFAULT_MAX_MEMORY_BYTES,
+                         get_ecmwf_prediction_files,
+                         get_ecmwf_streamflow,
+                         get_peak_flow,
+                         get_return_period_flow,
+                         get_river_index_list,
+                         read_return_period_flow)
 
 
 #------------------------------------------------------------------------------
@@ -66,6 +74,57 @@ def ReprojectCoords(coords,src_srs,tgt_srs):
         trans_coords.append([x,y])
     return trans_coords
     
+class StreamIDIndex(object):
+    """
+    Groups the rows of a stream info table by StreamID so that a value
+    for each river can be assigned to all of its raster cells at once
+    """
+    def __init__(self, streamid_list_full):
+        streamid_list_full = np.asarray(streamid_list_full)
+        #stable sort keeps the original row order within each river
+        self.row_order = np.argsort(streamid_list_full, kind='mergesort')
+        self.streamid_list_unique, self.row_start, self.row_count = \
+            np.unique(streamid_list_full[self.row_order],
+                      return_index=True, return_counts=True)
+        #index of the unique stream id for each row
+        self.row_unique_index = np.empty(len(streamid_list_full), dtype=np.int64)
+        self.row_unique_index[self.row_order] = np.repeat(np.arange(len(self.row_count)),
+                                                          self.row_count)
+
+    def get_unique_index(self, streamid_list):
+        """
+        Returns the index of each stream id in the unique stream id list
+        (-1 where the stream id is not in the stream info table)
+        """
+        streamid_list = np.asarray(streamid_list)
+        unique_index = np.searchsorted(self.streamid_list_unique, streamid_list)
+        unique_index[unique_index >= len(self.streamid_list_unique)] = 0
+        if len(self.streamid_list_unique) > 0:
+            unique_index[self.streamid_list_unique[unique_index] != streamid_list] = -1
+        else:
+            unique_index[:] = -1
+        return unique_index
+
+    def get_rows_for_streamids(self, streamid_list):
+        """
+        Returns the stream info row indices for each stream id in the list,
+        in list order, along with the position in the list each row came from
+        """
+        unique_index = self.get_unique_index(streamid_list)
+        valid_index = np.where(unique_index >= 0)[0]
+        row_count = self.row_count[unique_index[valid_index]]
+        row_start = self.row_start[unique_index[valid_index]]
+        block_start = np.cumsum(row_count) - row_count
+        sorted_position = np.repeat(row_start - block_start, row_count) + \
+                          np.arange(row_count.sum())
+        return self.row_order[sorted_position], np.repeat(valid_index, row_count)
+
+    def expand(self, unique_values):
+        """
+        Assigns one value per unique stream id to each of its rows
+        """
+        return np.asarray(unique_values)[self.row_unique_index]
+
 #------------------------------------------------------------------------------
 #Main Dataset Manager Class
 #------------------------------------------------------------------------------
@@ -76,14 +135,29 @@ class AutoRoutePrepare(object):
     """
 
     def __init__(self, autoroute_executable_location, elevation_dem_path, 
-                 stream_info_file, stream_shapefile_path=""):
+                 stream_info_file, stream_shapefile_path="",
+                 write_stream_info_text=True):
         """
         Initialize the class with variables given by the user
+
+        If write_stream_info_text is False, appended attributes are only
+        stored in the binary stream info cache until write_stream_info_file
+        is called (or the run stage syncs the text file)
         """
         self.autoroute_executable_location = autoroute_executable_location
         self.elevation_dem_path = elevation_dem_path
         self.stream_info_file = stream_info_file
         self.stream_shapefile_path = stream_shapefile_path
+        self.write_stream_info_text = write_stream_info_text
+        self._stream_info_table = None
+
+    def _span(self, stage, **attributes):
+        """
+        Returns the instrumentation span of the stage for the sub-basin
+        """
+        return span(stage,
+                    os.path.basename(os.path.dirname(os.path.abspath(self.stream_info_file))),
+                    **attributes)
     
     def generate_raster_from_dem(self, raster_path, dtype=gdal.GDT_Int32):
         """
@@ -112,15 +186,18 @@ class AutoRoutePrepare(object):
         Convert stream shapefile to raster with stream ids/slope
         """
         print("Converting stream shapefile to raster ...")
-        # Open the data source
-        stream_shapefile = ogr.Open(self.stream_shapefile_path)
-        source_layer = stream_shapefile.GetLayer(0)
-
-        target_ds = self.generate_raster_from_dem(streamid_raster_path, dtype=input_dtype)
-        # Rasterize
-        err = gdal.RasterizeLayer(target_ds, [1], source_layer, options=["ATTRIBUTE=%s" % stream_id])
-        if err != 0:
-            raise Exception("error rasterizing layer: %s" % err)
+        with self._span("rasterize_stream_shapefile"):
+            # Open the data source
+            stream_shapefile = ogr.Open(self.stream_shapefile_path)
+            source_layer = stream_shapefile.GetLayer(0)
+            #only burn the reaches on the DEM
+            self.spatially_filter_streamfile_layer_by_elevation_dem(source_layer)
+
+            target_ds = self.generate_raster_from_dem(streamid_raster_path, dtype=input_dtype)
+            # Rasterize
+            err = gdal.RasterizeLayer(target_ds, [1], source_layer, options=["ATTRIBUTE=%s" % stream_id])
+            if err != 0:
+                raise Exception("error rasterizing layer: %s" % err)
             
     def spatially_filter_streamfile_layer_by_elevation_dem(self, stream_shp_layer):
         """
@@ -130,51 +207,44 @@ class AutoRoutePrepare(object):
         #get extent from elevation raster to filter data
         try:
             print("Attempting to filter ...")
-            elevation_raster = gdal.Open(self.elevation_dem_path)
-
-            gt=elevation_raster.GetGeoTransform()
-            cols = elevation_raster.RasterXSize
-            rows = elevation_raster.RasterYSize
-            raster_ext = GetExtent(gt,cols,rows)
-
-            src_srs=osr.SpatialReference()
-            src_srs.ImportFromWkt(elevation_raster.GetProjection())
             tgt_srs = stream_shp_layer.GetSpatialRef()
-
-            raster_ext = ReprojectCoords(raster_ext,src_srs,tgt_srs)
-            
-            #read in the shapefile and get the data for slope
-            string_rast_ext = ["{0} {1}".format(x,y) for x,y in raster_ext]
-            wkt = "POLYGON (({0},{1}))".format(",".join(string_rast_ext), string_rast_ext[0])
-            stream_shp_layer.SetSpatialFilter(ogr.CreateGeometryFromWkt(wkt))
+            #outline of the DEM in the stream network projection
+            #(longitude/latitude order with GDAL 3)
+            dem_polygon = get_dem_polygon(self.elevation_dem_path,
+                                          tgt_srs.ExportToWkt() if tgt_srs is not None else "")
+            stream_shp_layer.SetSpatialFilter(dem_polygon)
         except Exception as ex:
             print(ex)
             print("Skipping filter. This may take longer ...")
             pass
 
     def generate_stream_info_file_with_direction(self, stream_raster_file_name,
-                                                 search_radius):
+                                                 search_radius,
+                                                 timeout=None):
         """
         Generate stream info input file for AutoRoute starter with stream direction
+
+        AutoRoute is killed if it runs longer than timeout (seconds)
         """
                 
         time_start = datetime.datetime.utcnow()
                         
 
+        #the stream info file is regenerated, so the cache is out of date
+        remove_stream_info_cache(self.stream_info_file)
+        self._stream_info_table = None
+
         #run AutoRoute
         print("Running AutoRoute prepare ...")
-        process = Popen([self.autoroute_executable_location,
-                         stream_raster_file_name,
-                         self.stream_info_file,
-                         str(search_radius)],
-                        stdout=PIPE, stderr=PIPE, shell=False)
-        out, err = process.communicate()
-        if err:
-            raise Exception(err)
-        else:
-            print('AutoRoute output:')
-            for line in out.split(b'\n'):
-                print(line)
+        print('AutoRoute output:')
+        with self._span("generate_stream_info_file") as stage_span:
+            executable_result = run_executable([self.autoroute_executable_location,
+                                                stream_raster_file_name,
+                                                self.stream_info_file,
+                                                str(search_radius)],
+                                               timeout=timeout)
+            stage_span.set(cpu_time=executable_result.cpu_time,
+                           peak_memory=executable_result.peak_memory)
 
         print("Time to run: %s" % (datetime.datetime.utcnow()-time_start))
 
@@ -182,9 +252,12 @@ class AutoRoutePrepare(object):
     def generate_manning_n_raster(self, land_use_raster,
                                   input_manning_n_table,
                                   output_manning_n_raster,
-                                  default_manning_n):
+                                  default_manning_n,
+                                  timeout=None):
         """
         Generate stream info input file for AutoRoute starter with stream direction
+
+        AutoRoute is killed if it runs longer than timeout (seconds)
         """
                 
         time_start = datetime.datetime.utcnow()
@@ -192,51 +265,223 @@ class AutoRoutePrepare(object):
 
         #run AutoRoute
         print("Running AutoRoute prepare ...")
-        process = Popen([self.autoroute_executable_location,
-                         land_use_raster,
-                         self.elevation_dem_path,
-                         input_manning_n_table,
-                         output_manning_n_raster,
-                         str(default_manning_n)],
-                        stdout=PIPE, stderr=PIPE, shell=False)
-        out, err = process.communicate()
-        if err:
-            raise Exception(err)
-        else:
-            print('AutoRoute output:')
-            for line in out.split(b'\n'):
-                print(line)
+        print('AutoRoute output:')
+        with self._span("generate_manning_n_raster") as stage_span:
+            executable_result = run_executable([self.autoroute_executable_location,
+                                                land_use_raster,
+                                                self.elevation_dem_path,
+                                                input_manning_n_table,
+                                                output_manning_n_raster,
+                                                str(default_manning_n)],
+                                               timeout=timeout)
+            stage_span.set(cpu_time=executable_result.cpu_time,
+                           peak_memory=executable_result.peak_memory)
 
         print("Time to run: %s" % (datetime.datetime.utcnow()-time_start))
 
-    def append_slope_to_stream_info_file(self, stream_id_field="COMID", slope_field="slope"):
+    def _read_stream_info_table(self):
         """
-        Add the slope attribute to the stream direction file
+        Reads in the stream info table and indexes the rows by StreamID
+        """
+        if self._stream_info_table is None:
+            self._stream_info_table = read_stream_info_table(self.stream_info_file)
+        return self._stream_info_table, StreamIDIndex(self._stream_info_table['StreamID'])
+
+    def _write_stream_info_table(self, stream_info_table, out_stream_info_file=""):
+        """
+        Stores the stream info table in the cache and the text file
+        (if write_stream_info_text is set)
+
+        If out_stream_info_file is set, the table is written there and
+        the stream info file is left unchanged
+        """
+        if out_stream_info_file:
+            write_stream_info_table(out_stream_info_file, stream_info_table,
+                                    write_text=self.write_stream_info_text)
+            return
+        write_stream_info_table(self.stream_info_file, stream_info_table,
+                                write_text=self.write_stream_info_text)
+        self._stream_info_table = stream_info_table
+
+    def write_stream_info_file(self):
+        """
+        Writes the AutoRoute stream info text file from the stream info table
+        """
+        stream_info_table = self._read_stream_info_table()[0]
+        write_stream_info_table(self.stream_info_file, stream_info_table)
+
+    def _get_stream_shapefile_values(self, stream_id_field, value_field_list):
+        """
+        Reads the stream ids and the values of the fields from the stream
+        shapefile in feature order
         """
         stream_shapefile = ogr.Open(self.stream_shapefile_path)
         stream_shp_layer = stream_shapefile.GetLayer()
 
         self.spatially_filter_streamfile_layer_by_elevation_dem(stream_shp_layer)
 
-        print("Writing output to file ...")
-        stream_info_table = csv_to_list(self.stream_info_file, ", ")[1:]
-        #Columns: DEM_1D_Index Row Col StreamID StreamDirection
-        stream_id_list = np.array([row[3] for row in stream_info_table], dtype=np.int32)
+        feature_stream_id_list = []
+        feature_value_lists = [[] for value_field in value_field_list]
+        for feature in stream_shp_layer:
+            feature_stream_id_list.append(int(float(feature.GetField(stream_id_field))))
+            for value_field, feature_value_list in zip(value_field_list, feature_value_lists):
+                feature_value_list.append(feature.GetField(value_field))
+
+        return (np.array(feature_stream_id_list, dtype=np.int64),
+                [np.array(feature_value_list, dtype=np.float64)
+                 for feature_value_list in feature_value_lists])
+
+    def _get_ecmwf_streamflow(self, streamid_list_unique, prediction_folder,
+                              method_x, method_y):
+        """
+        Calculates the streamflow for each stream id from the ECMWF
+        ensemble predicitons
+     
+        method_x = the first axis - it produces the max, min, mean, mean_plus_std, mean_minus_std hydrograph data for the 52 ensembles
+        method_y = the second axis - it calculates the max, min, mean, mean_plus_std, mean_minus_std value from method_x
+        """
+        if len(streamid_list_unique) <= 0:
+            raise Exception("ERROR: No stream id values found in stream info file.")
         
-        temp_stream_info_file = "{0}_temp.txt".format(os.path.splitext(self.stream_info_file)[0])
-        with open_csv(temp_stream_info_file, 'w') as outfile:
-            writer = csv.writer(outfile, delimiter=" ")
-            writer.writerow([u"DEM_1D_Index", u"Row", u"Col", u"StreamID", u"StreamDirection", u"Slope"])
-            for feature in stream_shp_layer:
-                #find all raster indices associates with the comid
-                raster_index_list = np.where(stream_id_list==int(float(feature.GetField(stream_id_field))))[0]
-                #add slope associated with comid    
-                slope = feature.GetField(slope_field)
-                for raster_index in raster_index_list:
-                    writer.writerow(stream_info_table[raster_index][:5] + [slope] + stream_info_table[raster_index][6:])
-
-        os.remove(self.stream_info_file)
-        os.rename(temp_stream_info_file, self.stream_info_file)
+        #Get list of prediciton files
+        prediction_files = get_ecmwf_prediction_files(prediction_folder)
+     
+        print("Extracting and analyzing data ...")
+        return get_ecmwf_streamflow(prediction_files, streamid_list_unique,
+                                    method_x, method_y)
+
+    def _get_rapid_output_peak_flow(self, streamid_list_unique, rapid_output_file,
+                                    date_peak_search_start=None,
+                                    date_peak_search_end=None,
+                                    max_memory_bytes=DEFAULT_MAX_MEMORY_BYTES):
+        """
+        Finds the peak flow for each stream id in a single RAPID output
+        """
+        if len(streamid_list_unique) <= 0:
+            raise IndexError("Invalid stream info file {0}." \
+                             " No stream ID's found ...".format(self.stream_info_file))
+
+        print("Analyzing data and appending to list ...")
+        #flow is zero for stream ids missing from the RAPID output
+        return get_peak_flow(rapid_output_file,
+                             streamid_list_unique,
+                             date_peak_search_start=date_peak_search_start,
+                             date_peak_search_end=date_peak_search_end,
+                             max_memory_bytes=max_memory_bytes)
+
+    def _get_return_period_flow(self, streamid_list_unique, return_period_file,
+                                return_period):
+        """
+        Looks up the return period flow for each stream id
+        """
+        print("Extracting Return Period Data ...")
+        return_period_river_id_array, return_period_flow_array = \
+            read_return_period_flow(return_period_file, return_period)
+        
+        print("Analyzing data and appending to list ...")
+        return get_return_period_flow(streamid_list_unique,
+                                      return_period_river_id_array,
+                                      return_period_flow_array)
+
+    def _get_lookup_value(self, streamid_list_unique, river_id_list, value_list):
+        """
+        Looks up the value for each stream id from values already
+        calculated for a list of river ids (zero if not found)
+        """
+        river_index_list = get_river_index_list(river_id_list, streamid_list_unique)
+        value_list_unique = np.zeros(len(streamid_list_unique))
+        valid_index = river_index_list >= 0
+        value_list_unique[valid_index] = np.asarray(value_list)[river_index_list[valid_index]]
+        return value_list_unique
+
+    def append_to_stream_info_file(self, attribute_sources, stream_id_field="COMID",
+                                   out_stream_info_file=""):
+        """
+        Appends multiple attributes to the stream info file in one pass
+
+        attribute_sources is a list of dictionaries with the stream info
+        column ("Slope" or "Flow"), the source and the source arguments:
+
+        {'column': 'Slope', 'source': 'shapefile', 'field': 'SLOPE'}
+        {'column': 'Flow', 'source': 'return_period',
+         'return_period_file': '/path/to/return_periods.nc',
+         'return_period': 'return_period_20'}
+        {'column': 'Flow', 'source': 'rapid_output',
+         'rapid_output_file': '/path/to/Qout.nc',
+         'date_peak_search_start': None, 'date_peak_search_end': None,
+         'max_memory_bytes': 512 * 1024**2}
+        {'column': 'Flow', 'source': 'ecmwf',
+         'prediction_folder': '/path/to/ecmwf/forecast',
+         'method_x': 'mean_plus_std', 'method_y': 'max'}
+        {'column': 'Flow', 'source': 'lookup',
+         'river_id_list': [...], 'value_list': [...]}
+
+        The stream shapefile is read once for all shapefile fields. As in
+        the single attribute methods, shapefile fields keep only the raster
+        cells of the streams in the shapefile (in feature order).
+
+        If out_stream_info_file is set, the result is written there instead
+        (i.e. one stream info file per streamflow scenario).
+        """
+        value_functions = {
+            'return_period': self._get_return_period_flow,
+            'rapid_output': self._get_rapid_output_peak_flow,
+            'ecmwf': self._get_ecmwf_streamflow,
+            'lookup': self._get_lookup_value,
+        }
+        for attribute_source in attribute_sources:
+            if attribute_source.get('column') not in ('Slope', 'Flow'):
+                raise Exception("Invalid stream info column {0}.".format(attribute_source.get('column')))
+            if attribute_source.get('source') != 'shapefile' \
+                and attribute_source.get('source') not in value_functions:
+                raise Exception("Invalid attribute source {0}.".format(attribute_source.get('source')))
+
+        column_set = set(attribute_source['column'] for attribute_source in attribute_sources)
+        stage = "append_stream_info"
+        if column_set == set(['Slope']):
+            stage = "append_slope"
+        elif column_set == set(['Flow']):
+            stage = "append_streamflow"
+        with self._span(stage, sources=[attribute_source['source'] for attribute_source in attribute_sources]):
+            stream_info_table, streamid_index = self._read_stream_info_table()
+
+            shapefile_sources = [attribute_source for attribute_source in attribute_sources \
+                                 if attribute_source['source'] == 'shapefile']
+            if shapefile_sources:
+                print("Reading stream shapefile ...")
+                feature_stream_id_list, feature_value_lists = \
+                    self._get_stream_shapefile_values(stream_id_field,
+                                                      [shapefile_source['field'] \
+                                                       for shapefile_source in shapefile_sources])
+                row_index_list, feature_index_list = \
+                    streamid_index.get_rows_for_streamids(feature_stream_id_list)
+                stream_info_table = stream_info_table[row_index_list]
+                for shapefile_source, feature_value_list in zip(shapefile_sources, feature_value_lists):
+                    stream_info_table[shapefile_source['column']] = feature_value_list[feature_index_list]
+                streamid_index = StreamIDIndex(stream_info_table['StreamID'])
+            else:
+                stream_info_table = stream_info_table.copy()
+
+            for attribute_source in attribute_sources:
+                if attribute_source['source'] == 'shapefile':
+                    continue
+                source_kwargs = dict((key, value) for key, value in attribute_source.items() \
+                                     if key not in ('column', 'source'))
+                value_list_unique = value_functions[attribute_source['source']](streamid_index.streamid_list_unique,
+                                                                                **source_kwargs)
+                stream_info_table[attribute_source['column']] = streamid_index.expand(value_list_unique)
+
+            print("Writing output to file ...")
+            self._write_stream_info_table(stream_info_table, out_stream_info_file)
+
+    def append_slope_to_stream_info_file(self, stream_id_field="COMID", slope_field="slope"):
+        """
+        Add the slope attribute to the stream direction file
+        """
+        self.append_to_stream_info_file([{'column': 'Slope',
+                                          'source': 'shapefile',
+                                          'field': slope_field}],
+                                        stream_id_field)
 
     def append_streamflow_from_ecmwf_rapid_output(self, prediction_folder,
                                                   method_x, method_y):
@@ -247,295 +492,47 @@ class AutoRoutePrepare(object):
         method_x = the first axis - it produces the max, min, mean, mean_plus_std, mean_minus_std hydrograph data for the 52 ensembles
         method_y = the second axis - it calculates the max, min, mean, mean_plus_std, mean_minus_std value from method_x
         """
-     
         print("Generating Streamflow Raster ...")
-        #get list of streamidS
-        stream_info_table = csv_to_list(self.stream_info_file, ", ")[1:]
+        self.append_to_stream_info_file([{'column': 'Flow',
+                                          'source': 'ecmwf',
+                                          'prediction_folder': prediction_folder,
+                                          'method_x': method_x,
+                                          'method_y': method_y}])
 
-        #Columns: DEM_1D_Index Row Col StreamID StreamDirection
-        streamid_list_full = np.array([row[3] for row in stream_info_table], dtype=np.int32)
-        streamid_list_unique = np.unique(streamid_list_full)
-        if not streamid_list_unique:
-            raise Exception("ERROR: No stream id values found in stream info file.")
-        
-        #Get list of prediciton files
-        prediction_files = sorted([os.path.join(prediction_folder,f) for f in os.listdir(prediction_folder) \
-                                  if not os.path.isdir(os.path.join(prediction_folder, f)) and f.lower().endswith('.nc')],
-                                  reverse=True)
-     
-     
-        print("Finding streamid indices ...")
-        with RAPIDDataset(prediction_files[0]) as data_nc:
-            reordered_streamid_index_list = data_nc.get_subset_riverid_index_list(streamid_list_unique)[0]
-
-            first_half_size = 40
-            if data_nc.size_time == 41 or data_nc.size_time == 61:
-                first_half_size = 41
-            elif data_nc.size_time == 85 or data_nc.size_time == 125:
-                #run at full resolution for all
-                first_half_size = 65
-        
-        print("Extracting Data ...")
-        reach_prediciton_array_first_half = np.zeros((len(streamid_list_unique),len(prediction_files),first_half_size))
-        reach_prediciton_array_second_half = np.zeros((len(streamid_list_unique),len(prediction_files),20))
-        #get information from datasets
-        for file_index, prediction_file in enumerate(prediction_files):
-            data_values_2d_array = []
-            try:
-                ensemble_index = int(os.path.basename(prediction_file)[:-3].split("_")[-1])
-                #Get hydrograph data from ECMWF Ensemble
-                with RAPIDDataset(prediction_file) as data_nc:
-                    data_values_2d_array = data_nc.get_qout_index(reordered_streamid_index_list)
-    
-                    #add data to main arrays and order in order of interim comids
-                    if len(data_values_2d_array) > 0:
-                        for comid_index in range(len(streamid_list_unique)):
-                            if(ensemble_index < 52):
-                                reach_prediciton_array_first_half[comid_index][file_index] = data_values_2d_array[comid_index][:first_half_size]
-                                reach_prediciton_array_second_half[comid_index][file_index] = data_values_2d_array[comid_index][first_half_size:]
-                            if(ensemble_index == 52):
-                                if first_half_size == 65:
-                                    #convert to 3hr-6hr
-                                    streamflow_1hr = data_values_2d_array[comid_index][:90:3]
-                                    # get the time series of 3 hr/6 hr data
-                                    streamflow_3hr_6hr = data_values_2d_array[comid_index][90:]
-                                    # concatenate all time series
-                                    reach_prediciton_array_first_half[comid_index][file_index] = np.concatenate([streamflow_1hr, streamflow_3hr_6hr])
-                                elif data_nc.size_time == 125:
-                                    #convert to 6hr
-                                    streamflow_1hr = data_values_2d_array[comid_index][:90:6]
-                                    # calculate time series of 6 hr data from 3 hr data
-                                    streamflow_3hr = data_values_2d_array[comid_index][90:109:2]
-                                    # get the time series of 6 hr data
-                                    streamflow_6hr = data_values_2d_array[comid_index][109:]
-                                    # concatenate all time series
-                                    reach_prediciton_array_first_half[comid_index][file_index] = np.concatenate([streamflow_1hr, streamflow_3hr, streamflow_6hr])
-                                else:
-                                    reach_prediciton_array_first_half[comid_index][file_index] = data_values_2d_array[comid_index][:]
-                                
-            except Exception as e:
-                print(e)
-                #pass
-     
-        print("Analyzing data and writing output ...")
-        temp_stream_info_file = "{0}_temp.txt".format(os.path.splitext(self.stream_info_file)[0])
-        with open(temp_stream_info_file, 'w', newline='') as outfile:
-            writer = csv.writer(outfile, delimiter=" ")
-            writer.writerow([u"DEM_1D_Index", u"Row", u"Col", u"StreamID", u"StreamDirection", u"Slope", "uFlow"])
-
-            for streamid_index, streamid in enumerate(streamid_list_unique):
-                #perform analysis on datasets
-                all_data_first = reach_prediciton_array_first_half[streamid_index]
-                all_data_second = reach_prediciton_array_second_half[streamid_index]
-         
-                series = []
-         
-                if "mean" in method_x:
-                    #get mean
-                    mean_data_first = np.mean(all_data_first, axis=0)
-                    mean_data_second = np.mean(all_data_second, axis=0)
-                    series = np.concatenate([mean_data_first,mean_data_second])
-                    if "std" in method_x:
-                        #get std dev
-                        std_dev_first = np.std(all_data_first, axis=0)
-                        std_dev_second = np.std(all_data_second, axis=0)
-                        std_dev = np.concatenate([std_dev_first,std_dev_second])
-                        if method_x == "mean_plus_std":
-                            #mean plus std
-                            series += std_dev
-                        elif method_x == "mean_minus_std":
-                            #mean minus std
-                            series -= std_dev
-         
-                elif method_x == "max":
-                    #get max
-                    max_data_first = np.amax(all_data_first, axis=0)
-                    max_data_second = np.amax(all_data_second, axis=0)
-                    series = np.concatenate([max_data_first,max_data_second])
-                elif method_x == "min":
-                    #get min
-                    min_data_first = np.amin(all_data_first, axis=0)
-                    min_data_second = np.amin(all_data_second, axis=0)
-                    series = np.concatenate([min_data_first,min_data_second])
-         
-                data_val = 0
-                if "mean" in method_y:
-                    #get mean
-                    data_val = np.mean(series)
-                    if "std" in method_y:
-                        #get std dev
-                        std_dev = np.std(series)
-                        if method_y == "mean_plus_std":
-                            #mean plus std
-                            data_val += std_dev
-                        elif method_y == "mean_minus_std":
-                            #mean minus std
-                            data_val -= std_dev
-         
-                elif method_y == "max":
-                    #get max
-                    data_val = np.amax(series)
-                elif method_y == "min":
-                    #get min
-                    data_val = np.amin(series)
-         
-                #get where streamids are in the lookup grid id table
-                raster_index_list = np.where(streamid_list_full==streamid)[0]
-                for raster_index in raster_index_list:
-                    writer.writerow(stream_info_table[raster_index][:6] + [data_val])
-
-        os.remove(self.stream_info_file)
-        os.rename(temp_stream_info_file, self.stream_info_file)
-    
     def append_streamflow_from_rapid_output(self, rapid_output_file,
                                             date_peak_search_start=None,
-                                            date_peak_search_end=None):
+                                            date_peak_search_end=None,
+                                            max_memory_bytes=DEFAULT_MAX_MEMORY_BYTES):
         """
         Generate StreamFlow raster
         Create AutoRAPID INPUT from single RAPID output
+
+        The streamflow is read in blocks using at most max_memory_bytes
         """
         print("Appending streamflow for:", self.stream_info_file)
-        #get information from datasets
-        #get list of streamids
-        stream_info_table = csv_to_list(self.stream_info_file, ", ")[1:]
-        #Columns: DEM_1D_Index Row Col StreamID StreamDirection
-        streamid_list_full = np.array([row[3] for row in stream_info_table], dtype=np.int32)
-        streamid_list_unique = np.unique(streamid_list_full)
-        
-        temp_stream_info_file = "{0}_temp.txt".format(os.path.splitext(self.stream_info_file)[0])
-        print("Analyzing data and appending to list ...")
-        with open_csv(temp_stream_info_file, 'w') as outfile:
-            writer = csv.writer(outfile)
-            writer.writerow([u"DEM_1D_Index", u"Row", u"Col", u"StreamID", u"StreamDirection", u"Slope", u"Flow"])
-            
-            with RAPIDDataset(rapid_output_file) as data_nc:
-                
-                time_range = data_nc.get_time_index_range(date_search_start=date_peak_search_start,
-                                                          date_search_end=date_peak_search_end)
-                #perform operation in max chunk size of 4,000
-                max_chunk_size = 8*365*5*4000 #5 years of 3hr data (8/day) with 4000 comids at a time
-                time_length = 8*365*5 #assume 5 years of 3hr data
-                if time_range is not None:
-                    time_length = len(time_range)
-                else:
-                    time_length = data_nc.size_time
-
-                streamid_list_length = len(streamid_list_unique)
-                if streamid_list_length <=0:
-                    raise IndexError("Invalid stream info file {0}." \
-                                     " No stream ID's found ...".format(self.stream_info_file))
-                
-                step_size = min(max_chunk_size/time_length, streamid_list_length)
-                for list_index_start in range(0, streamid_list_length, step_size):
-                    list_index_end = min(list_index_start+step_size, streamid_list_length)
-                    print("River ID subset range {0} to {1} of {2} ...".format(list_index_start,
-                                                                               list_index_end,
-                                                                               streamid_list_length))
-                    print("Extracting data ...")
-                    valid_stream_indices, valid_stream_ids, missing_stream_ids = \
-                        data_nc.get_subset_riverid_index_list(streamid_list_unique[list_index_start:list_index_end])
-                        
-                    streamflow_array = data_nc.get_qout_index(valid_stream_indices,
-                                                              time_index_array=time_range)
-                    
-                    print("Calculating peakflow and writing to file ...")
-                    for streamid_index, streamid in enumerate(valid_stream_ids):
-                        #get where streamids are in the lookup grid id table
-                        peak_flow = max(streamflow_array[streamid_index])
-                        raster_index_list = np.where(streamid_list_full==streamid)[0]
-                        for raster_index in raster_index_list:
-                            writer.writerow(stream_info_table[raster_index][:6] + [peak_flow])
-
-                    for missing_streamid in missing_stream_ids:
-                        #set flow to zero for missing stream ids
-                        raster_index_list = np.where(streamid_list_full==missing_streamid)[0]
-                        for raster_index in raster_index_list:
-                            writer.writerow(stream_info_table[raster_index][:6] + [0])
-
-
-         
-        os.remove(self.stream_info_file)
-        os.rename(temp_stream_info_file, self.stream_info_file)
-
+        self.append_to_stream_info_file([{'column': 'Flow',
+                                          'source': 'rapid_output',
+                                          'rapid_output_file': rapid_output_file,
+                                          'date_peak_search_start': date_peak_search_start,
+                                          'date_peak_search_end': date_peak_search_end,
+                                          'max_memory_bytes': max_memory_bytes}])
         print("Appending streamflow complete for:", self.stream_info_file)
 
-
     def append_streamflow_from_return_period_file(self, return_period_file, 
                                                   return_period):
         """
         Generates return period raster from return period file
         """
-        print("Extracting Return Period Data ...")
-        return_period_nc = Dataset(return_period_file, mode="r")
-        if return_period == "return_period_20": 
-            return_period_data = return_period_nc.variables['return_period_20'][:]
-        elif return_period == "return_period_10": 
-            return_period_data = return_period_nc.variables['return_period_10'][:]
-        elif return_period == "return_period_2": 
-            return_period_data = return_period_nc.variables['return_period_2'][:]
-        elif return_period == "max_flow": 
-            return_period_data = return_period_nc.variables['return_period_2'][:]
-        else:
-            raise Exception("Invalid return period definition.")
-        rivid_var = 'COMID'
-        if 'rivid' in return_period_nc.variables:
-            rivid_var = 'rivid'
-        return_period_comids = return_period_nc.variables[rivid_var][:]
-        return_period_nc.close()
-        
-        #get where streamids are in the lookup grid id table
-        stream_info_table = csv_to_list(self.stream_info_file, ", ")[1:]
-        streamid_list_full = np.array([row[3] for row in stream_info_table], dtype=np.int32)
-        streamid_list_unique = np.unique(streamid_list_full)
-        print("Analyzing data and appending to list ...")
-        
-        temp_stream_info_file = "{0}_temp.txt".format(os.path.splitext(self.stream_info_file)[0])
-        with open_csv(temp_stream_info_file, 'w') as outfile:
-            writer = csv.writer(outfile, delimiter=" ")
-            writer.writerow([u"DEM_1D_Index", u"Row", u"Col", u"StreamID", u"StreamDirection", u"Slope", u"Flow"])
-            for streamid in streamid_list_unique:
-                try:
-                    #get where streamids are in netcdf file
-                    streamid_index = np.where(return_period_comids==streamid)[0][0]
-                    peak_flow = return_period_data[streamid_index]
-                except IndexError:
-                    print( "ReachID", streamid, "not found in netCDF dataset. Setting value to zero ...")
-                    peak_flow = 0
-                    pass
-                    
-                #get where streamids are in the lookup grid id table
-                raster_index_list = np.where(streamid_list_full==streamid)[0]
-                for raster_index in raster_index_list:
-                    writer.writerow(stream_info_table[raster_index][:6] + [peak_flow])
-                    
-        os.remove(self.stream_info_file)
-        os.rename(temp_stream_info_file, self.stream_info_file)
+        self.append_to_stream_info_file([{'column': 'Flow',
+                                          'source': 'return_period',
+                                          'return_period_file': return_period_file,
+                                          'return_period': return_period}])
                     
     def append_streamflow_from_stream_shapefile(self, stream_id_field, streamflow_field):
         """
         Appends streamflow from values in shapefile 
         """
-        stream_shapefile = ogr.Open(self.stream_shapefile_path)
-        stream_shp_layer = stream_shapefile.GetLayer()
-
-        self.spatially_filter_streamfile_layer_by_elevation_dem(stream_shp_layer)
-
-        print("Writing output to file ...")
-        stream_info_table = csv_to_list(self.stream_info_file, ", ")[1:]
-        #Columns: DEM_1D_Index Row Col StreamID StreamDirection
-        stream_id_list = np.array([row[3] for row in stream_info_table], dtype=np.int32)
-        
-        temp_stream_info_file = "{0}_temp.txt".format(os.path.splitext(self.stream_info_file)[0])
-        with open_csv(temp_stream_info_file, 'w') as outfile:
-            writer = csv.writer(outfile, delimiter=" ")
-            writer.writerow([u"DEM_1D_Index", u"Row", u"Col", u"StreamID", u"StreamDirection", u"Slope", u"Flow"])
-            for feature in stream_shp_layer:
-                #find all raster indices associates with the comid
-                raster_index_list = np.where(stream_id_list==int(float(feature.GetField(stream_id_field))))[0]
-                #add streamflow associated with comid    
-                streamflow = feature.GetField(streamflow_field)
-                for raster_index in raster_index_list:
-                    writer.writerow(stream_info_table[raster_index][:6] + [streamflow])
-
-        os.remove(self.stream_info_file)
-        os.rename(temp_stream_info_file, self.stream_info_file)
+        self.append_to_stream_info_file([{'column': 'Flow',
+                                          'source': 'shapefile',
+                                          'field': streamflow_field}],
+                                        stream_id_field)
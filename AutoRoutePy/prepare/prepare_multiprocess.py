@@ -12,13 +12,47 @@ from datetime import datetime
 import multiprocessing
 import os
 
+import numpy as np
+
 #local imports
 from ..prepare import AutoRoutePrepare
-from ..utilities import CaptureStdOutToLog, get_valid_num_cpus
+from .partition_streams import partition_stream_network
+from .stream_info import get_stream_info_scenario_file, read_stream_info_table
+from .streamflow import (DEFAULT_MAX_MEMORY_BYTES,
+                         get_ecmwf_prediction_files,
+                         get_ecmwf_streamflow,
+                         get_return_period_flow,
+                         read_return_period_flows)
+from ..checkpoint import JobCheckpoint
+from ..instrumentation import (enable_instrumentation,
+                               restore_instrumentation,
+                               write_prometheus_textfile)
+from ..ledger import JobLedger
+from ..scheduling import (MultiprocessPipeline,
+                          estimate_autoroute_job_cost,
+                          estimate_autoroute_job_memory,
+                          get_autoroute_job_size,
+                          get_job_cost_list,
+                          get_job_memory_budget,
+                          get_job_order)
+from ..utilities import CaptureStdOutToLog
+
+#ensemble statistics used to generate streamflow from the ECMWF forecasts
+ECMWF_METHOD_X = "mean_plus_std"
+ECMWF_METHOD_Y = "max"
 
 #----------------------------------------------------------------------------------
 #MULTIPROCESSING FUNCTIONS
 #----------------------------------------------------------------------------------
+def get_return_period_list(return_period):
+    """
+    Returns the return period as a list
+    (a list of return periods generates one stream info file for each)
+    """
+    if isinstance(return_period, (list, tuple)):
+        return list(return_period)
+    return [return_period]
+
 def get_valid_streamflow_prepare_mode(autoroute_input_directory,
                                       rapid_output_directory,
                                       return_period,
@@ -52,9 +86,10 @@ def get_valid_streamflow_prepare_mode(autoroute_input_directory,
 
         PREPARE_MODE = 2
         valid_return_period_list = ['max_flow', 'return_period_20', 'return_period_10', 'return_period_2']
-        if return_period not in valid_return_period_list:
-            raise Exception("ERROR: AutoRoute watershed {0} has invalid return period ({1}) ...".format(autoroute_input_directory,
-                                                                                                        return_period))
+        for scenario_return_period in get_return_period_list(return_period):
+            if scenario_return_period not in valid_return_period_list:
+                raise Exception("ERROR: AutoRoute watershed {0} has invalid return period ({1}) ...".format(autoroute_input_directory,
+                                                                                                            scenario_return_period))
         
         if not return_period_file or not os.path.exists(return_period_file):
             raise Exception("ERROR: AutoRoute watershed {0} is missing return period file ...".format(autoroute_input_directory))
@@ -85,6 +120,132 @@ def get_valid_streamflow_prepare_mode(autoroute_input_directory,
 
     return PREPARE_MODE
     
+def get_streamflow_attribute_source(PREPARE_MODE,
+                                    rapid_output_directory,
+                                    return_period_file,
+                                    return_period,
+                                    rapid_output_file,
+                                    date_peak_search_start,
+                                    date_peak_search_end,
+                                    streamflow_id,
+                                    rapid_output_max_memory_bytes=DEFAULT_MAX_MEMORY_BYTES,
+                                    streamflow_lookup=None,
+                                    ):
+    """
+    Returns the stream info attribute source for the streamflow prepare mode
+    (None if streamflow is not prepared)
+
+    If streamflow_lookup (river ids, streamflow) is given, the streamflow
+    was already calculated and is looked up instead
+    """
+    if PREPARE_MODE > 0 and streamflow_lookup is not None:
+        return {'column': 'Flow',
+                'source': 'lookup',
+                'river_id_list': streamflow_lookup[0],
+                'value_list': streamflow_lookup[1]}
+    elif PREPARE_MODE == 1:
+        return {'column': 'Flow',
+                'source': 'ecmwf',
+                'prediction_folder': rapid_output_directory,
+                'method_x': ECMWF_METHOD_X,
+                'method_y': ECMWF_METHOD_Y}
+    elif PREPARE_MODE == 2:
+        return {'column': 'Flow',
+                'source': 'return_period',
+                'return_period_file': return_period_file,
+                'return_period': return_period}
+    elif PREPARE_MODE == 3:
+        return {'column': 'Flow',
+                'source': 'rapid_output',
+                'rapid_output_file': rapid_output_file,
+                'date_peak_search_start': date_peak_search_start,
+                'date_peak_search_end': date_peak_search_end,
+                'max_memory_bytes': rapid_output_max_memory_bytes}
+    elif PREPARE_MODE == 4:
+        return {'column': 'Flow',
+                'source': 'shapefile',
+                'field': streamflow_id}
+    return None
+
+def _get_stream_info_streamid_lists(stream_info_file_list):
+    """
+    Returns the unique stream ids of each stream info file and
+    of all of the stream info files
+    """
+    streamid_list_list = [np.unique(read_stream_info_table(stream_info_file)['StreamID'])
+                          for stream_info_file in stream_info_file_list]
+    streamid_list_all = np.unique(np.concatenate(streamid_list_list))
+    if len(streamid_list_all) <= 0:
+        raise Exception("ERROR: No stream id values found in stream info files.")
+    return streamid_list_list, streamid_list_all
+
+def _split_streamflow_lookup(streamid_list_list, streamid_list_all, streamflow_list_all):
+    """
+    Returns the stream ids and streamflow for each stream info file
+    """
+    return [(streamid_list, streamflow_list_all[np.searchsorted(streamid_list_all, streamid_list)])
+            for streamid_list in streamid_list_list]
+
+def get_ecmwf_streamflow_lookup_list(stream_info_file_list,
+                                     rapid_output_directory,
+                                     pool=None,
+                                     max_memory_bytes=DEFAULT_MAX_MEMORY_BYTES,
+                                     ):
+    """
+    Reads the ECMWF ensemble forecast once for the stream ids of all of the
+    stream info files and calculates the streamflow of each stream id
+
+    Returns the stream ids and streamflow for each stream info file
+    """
+    if not stream_info_file_list:
+        return []
+    streamid_list_list, streamid_list_all = _get_stream_info_streamid_lists(stream_info_file_list)
+
+    print("Extracting and analyzing ECMWF data for {0} stream ids ...".format(len(streamid_list_all)))
+    streamflow_list_all = get_ecmwf_streamflow(get_ecmwf_prediction_files(rapid_output_directory),
+                                               streamid_list_all,
+                                               ECMWF_METHOD_X,
+                                               ECMWF_METHOD_Y,
+                                               pool=pool,
+                                               max_memory_bytes=max_memory_bytes)
+
+    return _split_streamflow_lookup(streamid_list_list, streamid_list_all, streamflow_list_all)
+
+def get_return_period_streamflow_lookup_list(stream_info_file_list,
+                                             return_period_file,
+                                             return_period,
+                                             ):
+    """
+    Reads the return period file once for the stream ids of all of the
+    stream info files
+
+    Returns the stream ids and streamflow for each stream info file. If
+    return_period is a list, the lookup of each stream info file is a
+    dictionary by return period.
+    """
+    if not stream_info_file_list:
+        return []
+    streamid_list_list, streamid_list_all = _get_stream_info_streamid_lists(stream_info_file_list)
+
+    print("Extracting return period data for {0} stream ids ...".format(len(streamid_list_all)))
+    return_period_list = get_return_period_list(return_period)
+    return_period_river_id_array, return_period_flow_arrays = \
+        read_return_period_flows(return_period_file, return_period_list)
+
+    scenario_lookup_lists = []
+    for return_period_flow_array in return_period_flow_arrays:
+        streamflow_list_all = get_return_period_flow(streamid_list_all,
+                                                     return_period_river_id_array,
+                                                     return_period_flow_array)
+        scenario_lookup_lists.append(_split_streamflow_lookup(streamid_list_list,
+                                                              streamid_list_all,
+                                                              streamflow_list_all))
+
+    if not isinstance(return_period, (list, tuple)):
+        return scenario_lookup_lists[0]
+    return [dict(zip(return_period_list, streamflow_lookups))
+            for streamflow_lookups in zip(*scenario_lookup_lists)]
+
 def prepare_autoroute_streamflow_single_folder(PREPARE_MODE,
                                                autoroute_input_directory,
                                                stream_info_file,
@@ -97,30 +258,72 @@ def prepare_autoroute_streamflow_single_folder(PREPARE_MODE,
                                                river_id,
                                                streamflow_id,
                                                stream_network_shapefile,
+                                               write_stream_info_text=True,
+                                               rapid_output_max_memory_bytes=DEFAULT_MAX_MEMORY_BYTES,
+                                               streamflow_lookup=None,
                                                ):
     """
     This function prepares streamflow inputs in single directory for AutoRoute
+
+    If write_stream_info_text is False, the streamflow is only stored in the
+    binary stream info cache and the text file is written by the run stage
+
+    If streamflow_lookup (river ids, streamflow) is given, the streamflow
+    already calculated for the watershed is used
+
+    If return_period is a list, a stream info file is written for each
+    return period (i.e. stream_info_return_period_20.txt) and
+    streamflow_lookup is a dictionary by return period
     """
     os.chdir(autoroute_input_directory)
     
+    if PREPARE_MODE == 2 and isinstance(return_period, (list, tuple)):
+        if streamflow_lookup is None:
+            streamflow_lookup = get_return_period_streamflow_lookup_list([stream_info_file],
+                                                                         return_period_file,
+                                                                         return_period)[0]
+        arp = AutoRoutePrepare("", "", stream_info_file, stream_network_shapefile,
+                               write_stream_info_text=write_stream_info_text)
+        for scenario_return_period in return_period:
+            print("Preparing streamflow for {0} ...".format(scenario_return_period))
+            streamflow_source = get_streamflow_attribute_source(PREPARE_MODE,
+                                                                rapid_output_directory,
+                                                                return_period_file,
+                                                                scenario_return_period,
+                                                                rapid_output_file,
+                                                                date_peak_search_start,
+                                                                date_peak_search_end,
+                                                                streamflow_id,
+                                                                rapid_output_max_memory_bytes,
+                                                                streamflow_lookup[scenario_return_period])
+            arp.append_to_stream_info_file([streamflow_source], river_id,
+                                           out_stream_info_file=get_stream_info_scenario_file(stream_info_file,
+                                                                                              scenario_return_period))
+        return
+
+    streamflow_source = get_streamflow_attribute_source(PREPARE_MODE,
+                                                        rapid_output_directory,
+                                                        return_period_file,
+                                                        return_period,
+                                                        rapid_output_file,
+                                                        date_peak_search_start,
+                                                        date_peak_search_end,
+                                                        streamflow_id,
+                                                        rapid_output_max_memory_bytes,
+                                                        streamflow_lookup)
+    if streamflow_source is None:
+        return
+
     #create input streamflow raster for AutoRoute
-    arp = AutoRoutePrepare("", "", stream_info_file, stream_network_shapefile)
-    if PREPARE_MODE == 1:
-        arp.append_streamflow_from_ecmwf_rapid_output(prediction_folder=rapid_output_directory,
-                                                      method_x="mean_plus_std", method_y="max")
-    elif PREPARE_MODE == 2:
-        arp.append_streamflow_from_return_period_file(return_period_file=return_period_file,
-                                                      return_period=return_period)
-    elif PREPARE_MODE == 3:
-        arp.append_streamflow_from_rapid_output(rapid_output_file=rapid_output_file,
-                                                date_peak_search_start=date_peak_search_start,
-                                                date_peak_search_end=date_peak_search_end)
-    elif PREPARE_MODE == 4:
-        arp.append_streamflow_from_stream_shapefile(river_id, streamflow_id)
+    arp = AutoRoutePrepare("", "", stream_info_file, stream_network_shapefile,
+                           write_stream_info_text=write_stream_info_text)
+    arp.append_to_stream_info_file([streamflow_source], river_id)
 
 def prepare_autoroute_streamflow_multiprocess_worker(args):
     """
     Prepare streamflow for AutoRoute simulation on one of multiple cores
+    (the stream info text file is only written if args[16] is set,
+    otherwise the run stage writes it from the binary cache)
     """
     job_name = args[12]
     log_directory = args[13]
@@ -138,9 +341,42 @@ def prepare_autoroute_streamflow_multiprocess_worker(args):
                                                    args[9],
                                                    args[10],
                                                    args[11],
+                                                   write_stream_info_text=args[16],
+                                                   rapid_output_max_memory_bytes=args[14],
+                                                   streamflow_lookup=args[15],
                                                    )
     return job_name
 
+def rename_elevation_dem(sub_folder, dem_extension='img'):
+    """
+    Renames the DEM and its associated files (i.e. .prj, .aux.xml)
+    in the folder to elevation for running AutoRoute
+
+    The DEM itself is renamed last so a rename that was interrupted is
+    finished when this runs again
+    """
+    elevation_dem_file = os.path.join(sub_folder, 'elevation.{0}'.format(dem_extension))
+    original_elevation_dem_file_list = [dem_file for dem_file in \
+                                        glob(os.path.join(sub_folder, '*.{0}'.format(dem_extension))) \
+                                        if os.path.basename(dem_file) != os.path.basename(elevation_dem_file)]
+    if not original_elevation_dem_file_list:
+        if not os.path.exists(elevation_dem_file):
+            raise Exception("ERROR: No DEM with extension {0} found in {1} ...".format(dem_extension,
+                                                                                      sub_folder))
+        return elevation_dem_file
+
+    original_elevation_dem_file = original_elevation_dem_file_list[0]
+    original_dem_name = os.path.basename(original_elevation_dem_file).split(".")[0]
+    for assocated_dem_file in glob(os.path.join(sub_folder, "{0}.*".format(original_dem_name))):
+        if assocated_dem_file != original_elevation_dem_file:
+            renamed_file = os.path.join(sub_folder,
+                                        'elevation.{0}'.format(".".join(os.path.basename(assocated_dem_file).split(".")[1:])))
+            if os.path.exists(renamed_file):
+                os.remove(renamed_file)
+            os.rename(assocated_dem_file, renamed_file)
+    os.rename(original_elevation_dem_file, elevation_dem_file)
+    return elevation_dem_file
+
 def prepare_autoroute_single_folder(sub_folder,
                                     autoroute_executable_location,
                                     stream_network_shapefile,
@@ -152,11 +388,13 @@ def prepare_autoroute_single_folder(sub_folder,
                                     streamflow_id="",
                                     default_manning_n=0.035,
                                     rapid_output_directory="", #path to ECMWF RAPID input/output directory
-                                    return_period="", # return period name in return period file
+                                    return_period="", # return period name in return period file (or list of names for a stream info file each)
                                     return_period_file="", # return period file generated from RAPID historical run
                                     rapid_output_file="", #path to RAPID output file to be used
                                     date_peak_search_start=None, #datetime of start of search for peakflow
                                     date_peak_search_end=None, #datetime of end of search for peakflow
+                                    rapid_output_max_memory_bytes=DEFAULT_MAX_MEMORY_BYTES, #memory limit for reading RAPID output
+                                    autoroute_timeout=None, #seconds before the AutoRoute executable is killed
                                     ):
     """
     Worker process for multiprocessing that manages one folders preparation
@@ -176,12 +414,7 @@ def prepare_autoroute_single_folder(sub_folder,
         stream_info_file = os.path.join(sub_folder,'stream_info.txt')
         
         #rename elevation file for running autoroute
-        original_elevation_dem_file = glob(os.path.join(sub_folder, '*.{0}'.format(dem_extension)))[0]
-
-        elevation_dem_file = os.path.join(sub_folder, 'elevation.{0}'.format(dem_extension))
-        for assocated_dem_file in glob("{}*".format(original_elevation_dem_file.split(".")[0])):
-            renamed_file = os.path.join(sub_folder, 'elevation.{0}'.format(".".join(assocated_dem_file.split(".")[1:])))
-            os.rename(assocated_dem_file, renamed_file)
+        elevation_dem_file = rename_elevation_dem(sub_folder, dem_extension)
         
         #----------------------------------------------------------------------
         # Prepare stream info file
@@ -194,10 +427,9 @@ def prepare_autoroute_single_folder(sub_folder,
         arp.rasterize_stream_shapefile(out_rasterized_streamfile, river_id)
            
         arp.generate_stream_info_file_with_direction(out_rasterized_streamfile,
-                                                     search_radius=1)
+                                                     search_radius=1,
+                                                     timeout=autoroute_timeout)
        
-        arp.append_slope_to_stream_info_file(river_id, slope_id)
-
         #----------------------------------------------------------------------
         # Method to generate streamflow for AutoRoute simulation (Optional)
         #----------------------------------------------------------------------
@@ -216,7 +448,26 @@ def prepare_autoroute_single_folder(sub_folder,
             PREPARE_MODE = 0
             pass
         
-        if PREPARE_MODE > 0:
+        #append slope and streamflow reading the stream shapefile once
+        attribute_sources = [{'column': 'Slope', 'source': 'shapefile', 'field': slope_id}]
+        scenario_streamflow = PREPARE_MODE == 2 and isinstance(return_period, (list, tuple))
+        if not scenario_streamflow:
+            streamflow_source = get_streamflow_attribute_source(PREPARE_MODE,
+                                                                rapid_output_directory,
+                                                                return_period_file,
+                                                                return_period,
+                                                                rapid_output_file,
+                                                                date_peak_search_start,
+                                                                date_peak_search_end,
+                                                                streamflow_id,
+                                                                rapid_output_max_memory_bytes)
+            if streamflow_source is not None:
+                attribute_sources.append(streamflow_source)
+
+        arp.append_to_stream_info_file(attribute_sources, river_id)
+
+        if scenario_streamflow:
+            #one stream info file with the slope for each return period
             prepare_autoroute_streamflow_single_folder(PREPARE_MODE,
                                                        sub_folder,
                                                        stream_info_file,
@@ -229,7 +480,7 @@ def prepare_autoroute_single_folder(sub_folder,
                                                        river_id,
                                                        streamflow_id,
                                                        stream_network_shapefile,
-                                                       )
+                                                       rapid_output_max_memory_bytes=rapid_output_max_memory_bytes)
        
         #----------------------------------------------------------------------
         # Method to generate manning_n file from DEM, Land Use Raster, 
@@ -242,7 +493,8 @@ def prepare_autoroute_single_folder(sub_folder,
             arp.generate_manning_n_raster(land_use_raster,
                                           manning_n_table,
                                           os.path.join(sub_folder, 'manning_n.tif'),
-                                          default_manning_n
+                                          default_manning_n,
+                                          timeout=autoroute_timeout
                                           )
 
         try:
@@ -275,13 +527,27 @@ def prepare_autoroute_multiprocess_worker(args):
                                         args[12],
                                         args[13],
                                         args[14],
-                                        args[15]
+                                        args[15],
+                                        args[18],
+                                        args[19]
                                         )
     return job_name
 
 #----------------------------------------------------------------------------------------
 # MAIN PROCESS
 #----------------------------------------------------------------------------------------
+def _get_prepare_job_output_file_list(job_input):
+    """
+    Returns the files the AutoRoute prepare job generates
+    """
+    output_file_list = [os.path.join(job_input[0], 'stream_info.txt')]
+    if isinstance(job_input[11], (list, tuple)):
+        output_file_list += [get_stream_info_scenario_file(output_file_list[0], scenario_return_period) \
+                             for scenario_return_period in job_input[11]]
+    if job_input[3] and job_input[4]:
+        output_file_list.append(os.path.join(job_input[0], 'manning_n.tif'))
+    return output_file_list
+
 def prepare_autoroute_multiprocess(watershed_folder,
                                    autoroute_executable_location,
                                    stream_network_shapefile,
@@ -294,57 +560,174 @@ def prepare_autoroute_multiprocess(watershed_folder,
                                    streamflow_id="",
                                    default_manning_n=0.035,
                                    rapid_output_directory="", #path to ECMWF RAPID input/output directory
-                                   return_period="", # return period name in return period file
+                                   return_period="", # return period name in return period file (or list of names for a stream info file each)
                                    return_period_file="", # return period file generated from RAPID historical run
                                    rapid_output_file="", #path to RAPID output file to be used
                                    date_peak_search_start=None, #datetime of start of search for peakflow
                                    date_peak_search_end=None, #datetime of end of search for peakflow
-                                   num_cpus=-17
+                                   num_cpus=-17,
+                                   rapid_output_max_memory_bytes=DEFAULT_MAX_MEMORY_BYTES, #memory limit per process for reading RAPID output
+                                   job_order="directory", #order to submit jobs (directory or largest_first)
+                                   job_runtime_history=None, #historical runtime in seconds by job name for job_order
+                                   job_memory_budget=None, #memory in bytes for running jobs (None for 80% of memory, 0 for 3 GB per cpu)
+                                   job_ledger_file="", #SQLite file to record the jobs in and read the job history from
+                                   resume=False, #only prepare the folders not completed in the last run
+                                   autoroute_timeout=None, #seconds before the AutoRoute executable of a job is killed
+                                   instrumentation_events_file="", #JSON lines file to write the timing and resources of each stage to
+                                   prometheus_textfile="", #Prometheus textfile collector file summarizing the events when finished
+                                   partition_streams=True, #write the reaches of each folder to its own stream network first
                                    ):
     """
     Function to prepare AutoRoute input using multiprocessing with the same folder 
     structure as running multiprocessing
+
+    The status and outputs of each folder are written to
+    autoroute_prepare_manifest.json in the watershed folder as it
+    finishes. If resume is True, the folders with complete outputs in
+    the manifest are not prepared again.
+
+    If instrumentation_events_file is set, the timing and resources of
+    each stage of each folder are written to it as JSON lines.
+
+    If partition_streams is True, the stream network is indexed once and
+    the reaches intersecting the DEM of each folder are written to
+    stream_network_subset.shp in the folder before the jobs start so
+    each job only reads its own reaches (see partition_stream_network).
     """
-    #initialize multiprocess log directory
-    prepare_log_directory = os.path.join(log_directory, "prepare")
+    if prometheus_textfile and not instrumentation_events_file:
+        raise Exception("ERROR: prometheus_textfile requires instrumentation_events_file ...")
+    #the events file of the caller is restored when done
+    previous_events_file = None
+    if instrumentation_events_file:
+        previous_events_file = enable_instrumentation(instrumentation_events_file)
     try:
-        os.makedirs(prepare_log_directory)
-    except OSError:
-        pass
+
+        #initialize multiprocess log directory
+        prepare_log_directory = os.path.join(log_directory, "prepare")
+        try:
+            os.makedirs(prepare_log_directory)
+        except OSError:
+            pass
     
-    print("Preparing input for AutoRoute ...")
-    print("Logs can be found here: {0}".format(prepare_log_directory))
-
-    watershed_name = os.path.basename(watershed_folder)
-    multiprocessing_input = [(os.path.join(watershed_folder, sub_folder),
-                              autoroute_executable_location,
-                              stream_network_shapefile,
-                              land_use_raster,
-                              manning_n_table,
-                              dem_extension,
-                              river_id,
-                              slope_id,
-                              streamflow_id,
-                              default_manning_n,
-                              rapid_output_directory,
-                              return_period,
-                              return_period_file,
-                              rapid_output_file,
-                              date_peak_search_start,
-                              date_peak_search_end,
-                              "{0}-{1}".format(watershed_name, sub_folder),
-                              prepare_log_directory
-                             ) 
-                             for sub_folder in os.listdir(watershed_folder) \
-                             if os.path.isdir(os.path.join(watershed_folder, sub_folder))]
-    pool = multiprocessing.Pool(get_valid_num_cpus(num_cpus))
-
-    mp_worker_list = pool.imap_unordered(prepare_autoroute_multiprocess_worker,
-                                         multiprocessing_input,
-                                         chunksize=1)
-                                         
-    for multi_job_output in mp_worker_list:
-        print("JOB FINISHED: {0}".format(multi_job_output))
-
-    pool.close()
-    pool.join()
+        print("Preparing input for AutoRoute ...")
+        print("Logs can be found here: {0}".format(prepare_log_directory))
+
+        watershed_name = os.path.basename(watershed_folder)
+        multiprocessing_input = [(os.path.join(watershed_folder, sub_folder),
+                                  autoroute_executable_location,
+                                  stream_network_shapefile,
+                                  land_use_raster,
+                                  manning_n_table,
+                                  dem_extension,
+                                  river_id,
+                                  slope_id,
+                                  streamflow_id,
+                                  default_manning_n,
+                                  rapid_output_directory,
+                                  return_period,
+                                  return_period_file,
+                                  rapid_output_file,
+                                  date_peak_search_start,
+                                  date_peak_search_end,
+                                  "{0}-{1}".format(watershed_name, sub_folder),
+                                  prepare_log_directory,
+                                  rapid_output_max_memory_bytes,
+                                  autoroute_timeout,
+                                 ) 
+                                 for sub_folder in os.listdir(watershed_folder) \
+                                 if os.path.isdir(os.path.join(watershed_folder, sub_folder))]
+
+        #skip the folders prepared in a previous run
+        job_checkpoint = JobCheckpoint(os.path.join(watershed_folder, "autoroute_prepare_manifest.json"),
+                                       resume)
+        if resume:
+            num_jobs = len(multiprocessing_input)
+            multiprocessing_input = [job_input for job_input in multiprocessing_input \
+                                     if not job_checkpoint.is_job_complete("AutoRoute prepare",
+                                                                           job_input[16],
+                                                                           _get_prepare_job_output_file_list(job_input))]
+            print("Resuming prepare: {0} of {1} folders already complete ...".format(num_jobs - len(multiprocessing_input),
+                                                                                    num_jobs))
+
+        #give each folder only the reaches on its DEM
+        if partition_streams and multiprocessing_input:
+            stream_network_subsets = partition_stream_network(stream_network_shapefile,
+                                                              [job_input[0] for job_input in multiprocessing_input],
+                                                              dem_extension)
+            multiprocessing_input = [job_input[:2] + (stream_network_subsets.get(job_input[0], job_input[2]),) + job_input[3:] \
+                                     for job_input in multiprocessing_input]
+
+        num_cpus, job_memory_budget = get_job_memory_budget(num_cpus, job_memory_budget)
+
+        job_ledger = None
+        job_memory_history = {}
+        if job_ledger_file:
+            job_ledger = JobLedger(job_ledger_file)
+            if job_runtime_history is None:
+                job_runtime_history = job_ledger.get_job_runtime_history("AutoRoute prepare")
+            job_memory_history = job_ledger.get_job_memory_history("AutoRoute prepare")
+
+        #order the jobs by the size of the DEM
+        job_size_list = [None] * len(multiprocessing_input)
+        if job_order != "directory" or job_memory_budget > 0 or job_ledger is not None:
+            job_size_list = [get_autoroute_job_size(job_input[0], dem_extension) \
+                             for job_input in multiprocessing_input]
+        job_cost_list = [0] * len(multiprocessing_input)
+        if job_order != "directory":
+            job_cost_list = get_job_cost_list([job_input[16] for job_input in multiprocessing_input],
+                                              [estimate_autoroute_job_cost(job_input[0], job_size=job_size) \
+                                               for job_input, job_size in zip(multiprocessing_input, job_size_list)],
+                                              job_runtime_history)
+
+        pool = multiprocessing.Pool(num_cpus)
+        pipeline = MultiprocessPipeline(pool, num_cpus, job_memory_budget, job_ledger,
+                                        job_checkpoint)
+        for job_index in get_job_order(job_cost_list, job_order):
+            job_input = multiprocessing_input[job_index]
+            job_memory = 0
+            if job_memory_budget > 0:
+                #use the measured memory of previous runs if available
+                job_memory = job_memory_history.get(job_input[16],
+                                                    estimate_autoroute_job_memory(job_input[0],
+                                                                                  job_size=job_size_list[job_index]))
+            job_info = {
+                        'job_name': job_input[16],
+                        'output_file_list': _get_prepare_job_output_file_list(job_input),
+                       }
+            if job_ledger is not None:
+                job_info.update({
+                                 'input_directory': job_input[0],
+                                 'num_dem_cells': job_size_list[job_index][0],
+                                 'num_stream_cells': job_size_list[job_index][1],
+                                 'estimated_memory': job_memory,
+                                 'stream_network_shapefile': job_input[2],
+                                 'land_use_raster': job_input[3],
+                                 'return_period': job_input[11],
+                                 'rapid_output_file': job_input[13],
+                                })
+            pipeline.submit("AutoRoute prepare",
+                            prepare_autoroute_multiprocess_worker,
+                            job_input,
+                            job_memory=job_memory,
+                            job_info=job_info)
+
+        finished = False
+        try:
+            for stage_name, multi_job_output in pipeline.results():
+                print("JOB FINISHED: {0}".format(multi_job_output))
+            finished = True
+        finally:
+            #stop the jobs still running if one failed
+            if finished:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+            if job_ledger is not None:
+                job_ledger.close()
+        pipeline.print_report()
+        if prometheus_textfile:
+            write_prometheus_textfile(instrumentation_events_file, prometheus_textfile)
+    finally:
+        if previous_events_file is not None:
+            restore_instrumentation(previous_events_file)
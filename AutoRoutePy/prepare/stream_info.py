@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+##
+##  stream_info.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License BSD 3-Clause
+
+import os
+
+import numpy as np
+from RAPIDpy.helper_functions import open_csv
+
+#Columns: DEM_1D_Index Row Col StreamID StreamDirection Slope Flow
+STREAM_INFO_DTYPE = np.dtype([('DEM_1D_Index', np.int64),
+                              ('Row', np.int32),
+                              ('Col', np.int32),
+                              ('StreamID', np.int64),
+                              ('StreamDirection', np.float64),
+                              ('Slope', np.float64),
+                              ('Flow', np.float64)])
+
+#------------------------------------------------------------------------------
+#Stream Info Table Functions
+#------------------------------------------------------------------------------
+def get_stream_info_cache_file(stream_info_file):
+    """
+    Returns the path to the binary cache of the stream info file
+    """
+    return "{0}.npz".format(os.path.splitext(stream_info_file)[0])
+
+def get_stream_info_scenario_file(stream_info_file, scenario_name):
+    """
+    Returns the path to the stream info file of a streamflow scenario
+    (i.e. stream_info_return_period_20.txt)
+    """
+    return "{0}_{1}.txt".format(os.path.splitext(stream_info_file)[0], scenario_name)
+
+def _get_text_file_stat(stream_info_file):
+    """
+    Returns the modification time and size of the stream info text file
+    """
+    try:
+        file_stat = os.stat(stream_info_file)
+    except OSError:
+        return np.array([-1.0, -1.0])
+    return np.array([file_stat.st_mtime, file_stat.st_size], dtype=np.float64)
+
+def _load_stream_info_cache(stream_info_file):
+    """
+    Loads the binary cache if it was written against the current
+    version of the stream info text file
+
+    Returns the stream info table and whether the text file is in sync
+    with it (None, False if the cache is missing or out of date)
+    """
+    stream_info_cache_file = get_stream_info_cache_file(stream_info_file)
+    if not os.path.exists(stream_info_cache_file):
+        return None, False
+    with np.load(stream_info_cache_file) as stream_info_cache:
+        if not np.array_equal(stream_info_cache['text_file_stat'],
+                              _get_text_file_stat(stream_info_file)):
+            return None, False
+        return stream_info_cache['stream_info'], bool(stream_info_cache['text_synced'])
+
+def remove_stream_info_cache(stream_info_file):
+    """
+    Removes the binary cache of the stream info file if it exists
+    """
+    try:
+        os.remove(get_stream_info_cache_file(stream_info_file))
+    except OSError:
+        pass
+
+def create_stream_info_table(num_rows):
+    """
+    Creates an empty stream info table with slope and flow unset (NaN)
+    """
+    stream_info_table = np.zeros(num_rows, dtype=STREAM_INFO_DTYPE)
+    stream_info_table['Slope'] = np.nan
+    stream_info_table['Flow'] = np.nan
+    return stream_info_table
+
+def read_stream_info_text_file(stream_info_file):
+    """
+    Reads the AutoRoute stream info text file into a stream info table
+    """
+    with open_csv(stream_info_file) as stream_info:
+        header = stream_info.readline()
+        delimiter = None
+        if "," in header:
+            delimiter = ","
+        stream_info_array = np.loadtxt(stream_info, delimiter=delimiter,
+                                       dtype=np.float64, ndmin=2)
+
+    stream_info_table = create_stream_info_table(stream_info_array.shape[0])
+    for column_index, column_name in enumerate(STREAM_INFO_DTYPE.names[:stream_info_array.shape[1]]):
+        stream_info_table[column_name] = stream_info_array[:, column_index]
+    return stream_info_table
+
+def _format_stream_info_column(column):
+    """
+    Converts a stream info column to a list of strings
+    """
+    if column.dtype.kind in 'iu':
+        return list(map(str, column.tolist()))
+    #slope, flow and direction repeat often, so format each value once
+    unique_values, unique_inverse = np.unique(column, return_inverse=True)
+    unique_strings = np.array([str(value) for value in unique_values.tolist()], dtype=object)
+    return unique_strings[unique_inverse.ravel()].tolist()
+
+def write_stream_info_text_file(stream_info_file, stream_info_table):
+    """
+    Writes the stream info table to the AutoRoute stream info text file
+    """
+    column_names = list(STREAM_INFO_DTYPE.names[:5])
+    has_flow = not np.isnan(stream_info_table['Flow']).all()
+    if has_flow or not np.isnan(stream_info_table['Slope']).all():
+        column_names.append('Slope')
+    if has_flow:
+        column_names.append('Flow')
+
+    temp_stream_info_file = "{0}_temp.txt".format(os.path.splitext(stream_info_file)[0])
+    with open_csv(temp_stream_info_file, 'w') as outfile:
+        outfile.write(" ".join(column_names) + "\r\n")
+        if len(stream_info_table) > 0:
+            column_strings = [_format_stream_info_column(stream_info_table[column_name])
+                              for column_name in column_names]
+            outfile.write("\r\n".join(map(" ".join, zip(*column_strings))) + "\r\n")
+
+    try:
+        os.remove(stream_info_file)
+    except OSError:
+        pass
+    os.rename(temp_stream_info_file, stream_info_file)
+
+def read_stream_info_table(stream_info_file):
+    """
+    Reads the stream info table from the binary cache if it is up to date,
+    otherwise from the stream info text file
+    """
+    stream_info_table = _load_stream_info_cache(stream_info_file)[0]
+    if stream_info_table is None:
+        stream_info_table = read_stream_info_text_file(stream_info_file)
+    return stream_info_table
+
+def write_stream_info_table(stream_info_file, stream_info_table, write_text=True):
+    """
+    Writes the stream info table to the binary cache and optionally
+    the stream info text file
+    """
+    if write_text:
+        write_stream_info_text_file(stream_info_file, stream_info_table)
+
+    stream_info_cache_file = get_stream_info_cache_file(stream_info_file)
+    temp_stream_info_cache_file = "{0}_temp.npz".format(os.path.splitext(stream_info_cache_file)[0])
+    np.savez(temp_stream_info_cache_file,
+             stream_info=stream_info_table,
+             text_file_stat=_get_text_file_stat(stream_info_file),
+             text_synced=write_text)
+    try:
+        os.remove(stream_info_cache_file)
+    except OSError:
+        pass
+    os.rename(temp_stream_info_cache_file, stream_info_cache_file)
+
+def sync_stream_info_text_file(stream_info_file):
+    """
+    Regenerates the stream info text file from the binary cache
+    if the cache contains newer data
+    """
+    stream_info_table, text_synced = _load_stream_info_cache(stream_info_file)
+    if stream_info_table is not None and not text_synced:
+        print("Writing stream info file from cache ...")
+        write_stream_info_table(stream_info_file, stream_info_table)
@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+##
+##  streamflow.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License BSD 3-Clause
+
+import os
+import warnings
+
+from netCDF4 import Dataset
+import numpy as np
+from RAPIDpy.dataset import RAPIDDataset
+
+#default memory limit for reading streamflow (512 MB)
+DEFAULT_MAX_MEMORY_BYTES = 512 * 1024**2
+
+#------------------------------------------------------------------------------
+#Streamflow Helper Functions
+#------------------------------------------------------------------------------
+def get_river_index_list(river_id_array, river_id_list):
+    """
+    Returns the index of each river id of river_id_list in river_id_array
+    (-1 where the river id is not in river_id_array)
+    """
+    river_id_array = np.asarray(river_id_array)
+    river_id_list = np.asarray(river_id_list)
+    river_index_list = np.empty(len(river_id_list), dtype=np.int64)
+    river_index_list.fill(-1)
+    if len(river_id_array) <= 0 or len(river_id_list) <= 0:
+        return river_index_list
+
+    sorted_index = np.argsort(river_id_array, kind='mergesort')
+    sorted_river_id_array = river_id_array[sorted_index]
+    sorted_position = np.searchsorted(sorted_river_id_array, river_id_list)
+    sorted_position[sorted_position >= len(sorted_river_id_array)] = 0
+    found = sorted_river_id_array[sorted_position] == river_id_list
+    river_index_list[found] = sorted_index[sorted_position[found]]
+    return river_index_list
+
+def _get_time_blocks(time_index_array, block_size):
+    """
+    Splits the time indices into blocks of at most block_size, returning
+    a slice for contiguous blocks and the index array otherwise
+    """
+    for block_start in range(0, len(time_index_array), block_size):
+        time_block = time_index_array[block_start:block_start+block_size]
+        if time_block[-1] - time_block[0] + 1 == len(time_block):
+            yield slice(int(time_block[0]), int(time_block[-1]) + 1), time_block
+        else:
+            yield time_block, time_block
+
+def _get_river_groups(river_index_list, max_span):
+    """
+    Groups the sorted river indices so that each group spans
+    at most max_span indices in the file
+    """
+    group_start = 0
+    for list_index in range(1, len(river_index_list) + 1):
+        if list_index == len(river_index_list) or \
+            river_index_list[list_index] - river_index_list[group_start] >= max_span:
+            yield river_index_list[group_start:list_index]
+            group_start = list_index
+
+def get_peak_flow(rapid_output_file, river_id_list,
+                  date_peak_search_start=None,
+                  date_peak_search_end=None,
+                  max_memory_bytes=DEFAULT_MAX_MEMORY_BYTES,
+                  return_peak_time_index=False):
+    """
+    Finds the peak flow for each river id in a RAPID Qout file
+
+    The Qout variable is streamed in contiguous time blocks keeping a
+    running maximum (and time index of the maximum) per river, so that
+    the memory used to hold streamflow stays below max_memory_bytes.
+    Rivers missing from the file have a peak flow of zero and a peak
+    time index of -1.
+    """
+    river_id_list = np.asarray(river_id_list)
+    peak_flow_list = np.empty(len(river_id_list))
+    peak_flow_list.fill(-np.inf)
+    peak_time_index_list = np.empty(len(river_id_list), dtype=np.int64)
+    peak_time_index_list.fill(-1)
+
+    with RAPIDDataset(rapid_output_file) as data_nc:
+        time_index_array = data_nc.get_time_index_range(date_search_start=date_peak_search_start,
+                                                        date_search_end=date_peak_search_end)
+        if time_index_array is None:
+            time_index_array = np.arange(data_nc.size_time)
+        time_index_array = np.asarray(time_index_array, dtype=np.int64)
+
+        river_index_list = get_river_index_list(data_nc.get_river_id_array(), river_id_list)
+        print("{0} of {1} river IDs found in {2} ...".format(np.count_nonzero(river_index_list >= 0),
+                                                            len(river_id_list),
+                                                            rapid_output_file))
+
+        #read rivers in file order to keep reads contiguous
+        valid_list_index = np.where(river_index_list >= 0)[0]
+        valid_list_index = valid_list_index[np.argsort(river_index_list[valid_list_index],
+                                                       kind='mergesort')]
+        sorted_river_index_list = river_index_list[valid_list_index]
+
+        qout_variable = data_nc.qout_nc.variables[data_nc.q_var_name]
+        time_first = qout_variable.dimensions[0].lower() == 'time'
+        #the block read from file, the float copy and the selected rivers
+        bytes_per_value = qout_variable.dtype.itemsize + 2 * 8
+        max_values = max(1, int(max_memory_bytes // bytes_per_value))
+
+        if len(time_index_array) > 0 and len(sorted_river_index_list) > 0:
+            group_start = 0
+            for river_group in _get_river_groups(sorted_river_index_list, max_values):
+                group_list_index = valid_list_index[group_start:group_start+len(river_group)]
+                group_start += len(river_group)
+
+                #read the whole span of rivers if it is mostly needed
+                river_span = int(river_group[-1] - river_group[0] + 1)
+                if river_span <= 4 * len(river_group):
+                    river_selection = slice(int(river_group[0]), int(river_group[-1]) + 1)
+                    river_subset = river_group - river_group[0]
+                    num_rivers_read = river_span
+                else:
+                    river_selection = river_group
+                    river_subset = None
+                    num_rivers_read = len(river_group)
+
+                time_block_size = min(max(1, max_values // num_rivers_read),
+                                      len(time_index_array))
+                print("Reading rivers {0} to {1} in blocks of {2} time steps ...".format(river_group[0],
+                                                                                         river_group[-1],
+                                                                                         time_block_size))
+                for time_selection, time_block in _get_time_blocks(time_index_array, time_block_size):
+                    if time_first:
+                        streamflow_block = qout_variable[time_selection, river_selection]
+                    else:
+                        streamflow_block = qout_variable[river_selection, time_selection].T
+                    #time x river
+                    streamflow_block = np.ma.filled(np.ma.masked_invalid(streamflow_block),
+                                                    -np.inf).astype(np.float64, copy=False)
+                    streamflow_block = streamflow_block.reshape(len(time_block), -1)
+                    if river_subset is not None:
+                        streamflow_block = streamflow_block[:, river_subset]
+
+                    block_peak_time_index = np.argmax(streamflow_block, axis=0)
+                    block_peak_flow = streamflow_block[block_peak_time_index,
+                                                       np.arange(streamflow_block.shape[1])]
+                    new_peak = block_peak_flow > peak_flow_list[group_list_index]
+                    peak_flow_list[group_list_index[new_peak]] = block_peak_flow[new_peak]
+                    peak_time_index_list[group_list_index[new_peak]] = time_block[block_peak_time_index[new_peak]]
+
+    #flow is zero for rivers missing from the file or without valid data
+    peak_flow_list[np.isinf(peak_flow_list)] = 0
+
+    if return_peak_time_index:
+        return peak_flow_list, peak_time_index_list
+    return peak_flow_list
+
+#------------------------------------------------------------------------------
+#Return Period Functions
+#------------------------------------------------------------------------------
+def read_return_period_flows(return_period_file, return_period_list):
+    """
+    Reads the river ids and the flow of each return period in the list
+    from the return period file
+    """
+    return_period_variables = {
+        'return_period_20': 'return_period_20',
+        'return_period_10': 'return_period_10',
+        'return_period_2': 'return_period_2',
+        'max_flow': 'return_period_2',
+    }
+    with Dataset(return_period_file, mode="r") as return_period_nc:
+        return_period_flow_arrays = []
+        for return_period in return_period_list:
+            if return_period not in return_period_variables:
+                raise Exception("Invalid return period definition.")
+            return_period_data = return_period_nc.variables[return_period_variables[return_period]][:]
+            return_period_flow_arrays.append(np.ma.filled(return_period_data, 0).astype(np.float64))
+        rivid_var = 'COMID'
+        if 'rivid' in return_period_nc.variables:
+            rivid_var = 'rivid'
+        return_period_river_id_array = return_period_nc.variables[rivid_var][:]
+
+    return np.ma.getdata(return_period_river_id_array), return_period_flow_arrays
+
+def read_return_period_flow(return_period_file, return_period):
+    """
+    Reads the river ids and the return period flow from the return period file
+    """
+    return_period_river_id_array, return_period_flow_arrays = \
+        read_return_period_flows(return_period_file, [return_period])
+    return return_period_river_id_array, return_period_flow_arrays[0]
+
+def get_return_period_flow(river_id_list, return_period_river_id_array,
+                           return_period_flow_array):
+    """
+    Looks up the return period flow for each river id
+    (zero if the river id is not in the return period data)
+    """
+    river_index_list = get_river_index_list(return_period_river_id_array, river_id_list)
+    return_period_flow_list = np.zeros(len(river_index_list))
+    valid_index = river_index_list >= 0
+    return_period_flow_list[valid_index] = return_period_flow_array[river_index_list[valid_index]]
+
+    num_missing = len(river_index_list) - np.count_nonzero(valid_index)
+    if num_missing > 0:
+        print("{0} of {1} reach IDs not found in return period dataset. "
+              "Setting values to zero ...".format(num_missing, len(river_index_list)))
+    return return_period_flow_list
+
+#------------------------------------------------------------------------------
+#ECMWF Ensemble Functions
+#------------------------------------------------------------------------------
+def get_ecmwf_prediction_files(prediction_folder):
+    """
+    Returns the list of ECMWF ensemble prediction files in the folder
+    """
+    return sorted([os.path.join(prediction_folder,f) for f in os.listdir(prediction_folder) \
+                   if not os.path.isdir(os.path.join(prediction_folder, f)) and f.lower().endswith('.nc')],
+                  reverse=True)
+
+def get_ecmwf_ensemble_index(prediction_file):
+    """
+    Returns the ensemble member number from the prediction file name
+    (i.e. Qout_watershed_subbasin_52.nc is 52)
+    """
+    return int(os.path.splitext(os.path.basename(prediction_file))[0].split("_")[-1])
+
+def get_ecmwf_first_half_size(size_time):
+    """
+    Returns the number of time steps in the first (higher resolution)
+    part of the forecast for the low resolution ensembles
+    """
+    if size_time == 41 or size_time == 61:
+        return 41
+    elif size_time == 85 or size_time == 125:
+        #run at full resolution for all
+        return 65
+    return 40
+
+def read_ecmwf_ensemble_member(prediction_file, river_id_list):
+    """
+    Reads the streamflow of one ensemble member for the river ids
+
+    Returns the size of the time dimension and the streamflow
+    (river x time) with NaN for rivers missing from the file
+    """
+    with RAPIDDataset(prediction_file) as data_nc:
+        river_index_list = get_river_index_list(data_nc.get_river_id_array(), river_id_list)
+        streamflow_array = np.empty((len(river_id_list), data_nc.size_time))
+        streamflow_array.fill(np.nan)
+
+        valid_list_index = np.where(river_index_list >= 0)[0]
+        if len(valid_list_index) > 0:
+            valid_list_index = valid_list_index[np.argsort(river_index_list[valid_list_index],
+                                                           kind='mergesort')]
+            valid_streamflow_array = data_nc.get_qout_index(river_index_list[valid_list_index])
+            streamflow_array[valid_list_index] = \
+                np.ma.filled(np.ma.masked_invalid(valid_streamflow_array), np.nan) \
+                  .reshape(len(valid_list_index), -1)
+
+        return data_nc.size_time, streamflow_array
+
+def resample_ecmwf_high_res_member(streamflow_array, size_time, first_half_size):
+    """
+    Resamples the high resolution ensemble member (river x time)
+    to the time steps of the first part of the low resolution members
+    """
+    if first_half_size == 65:
+        #convert to 3hr-6hr
+        streamflow_1hr = streamflow_array[:, :90:3]
+        # get the time series of 3 hr/6 hr data
+        streamflow_3hr_6hr = streamflow_array[:, 90:]
+        # concatenate all time series
+        return np.concatenate([streamflow_1hr, streamflow_3hr_6hr], axis=1)
+    elif size_time == 125:
+        #convert to 6hr
+        streamflow_1hr = streamflow_array[:, :90:6]
+        # calculate time series of 6 hr data from 3 hr data
+        streamflow_3hr = streamflow_array[:, 90:109:2]
+        # get the time series of 6 hr data
+        streamflow_6hr = streamflow_array[:, 109:]
+        # concatenate all time series
+        return np.concatenate([streamflow_1hr, streamflow_3hr, streamflow_6hr], axis=1)
+    return streamflow_array
+
+def _read_ecmwf_ensemble_member_worker(args):
+    """
+    Reads one ensemble member for the river ids on one of multiple cores
+
+    Returns None if the member could not be read
+    """
+    prediction_file, river_id_list = args
+    try:
+        ensemble_index = get_ecmwf_ensemble_index(prediction_file)
+        size_time, streamflow_array = read_ecmwf_ensemble_member(prediction_file,
+                                                                 river_id_list)
+    except Exception as ex:
+        print(ex)
+        return None
+    return ensemble_index, size_time, streamflow_array
+
+def read_ecmwf_ensemble(prediction_files, river_id_list, pool=None):
+    """
+    Reads the ECMWF ensemble predictions into one array (river x ensemble x time)
+
+    Missing ensemble members, missing rivers and the time steps not
+    forecast by the high resolution member are NaN
+
+    If a multiprocessing pool is given, the ensemble members are read in parallel
+    """
+    with RAPIDDataset(prediction_files[0]) as data_nc:
+        first_half_size = get_ecmwf_first_half_size(data_nc.size_time)
+    num_time_steps = first_half_size + 20
+
+    ensemble_array = np.empty((len(river_id_list), len(prediction_files), num_time_steps))
+    ensemble_array.fill(np.nan)
+    job_list = [(prediction_file, river_id_list) for prediction_file in prediction_files]
+    if pool is None:
+        member_list = map(_read_ecmwf_ensemble_member_worker, job_list)
+    else:
+        member_list = pool.imap(_read_ecmwf_ensemble_member_worker, job_list)
+
+    for file_index, member in enumerate(member_list):
+        if member is None:
+            continue
+        ensemble_index, size_time, streamflow_array = member
+        if ensemble_index == 52:
+            streamflow_array = resample_ecmwf_high_res_member(streamflow_array,
+                                                              size_time,
+                                                              first_half_size)[:, :first_half_size]
+        elif ensemble_index > 52:
+            continue
+        streamflow_array = streamflow_array[:, :num_time_steps]
+        ensemble_array[:, file_index, :streamflow_array.shape[1]] = streamflow_array
+
+    return ensemble_array
+
+def _reduce_ensemble_axis(data_array, method, axis):
+    """
+    Reduces the array along the axis with the max, min, mean,
+    mean_plus_std or mean_minus_std method ignoring NaN values
+    """
+    if "mean" in method:
+        #get mean
+        reduced_array = np.nanmean(data_array, axis=axis)
+        if "std" in method:
+            #get std dev
+            std_dev = np.nanstd(data_array, axis=axis)
+            if method == "mean_plus_std":
+                #mean plus std
+                reduced_array = reduced_array + std_dev
+            elif method == "mean_minus_std":
+                #mean minus std
+                reduced_array = reduced_array - std_dev
+        return reduced_array
+    elif method == "max":
+        return np.nanmax(data_array, axis=axis)
+    elif method == "min":
+        return np.nanmin(data_array, axis=axis)
+    raise Exception("Invalid ensemble statistic method {0}.".format(method))
+
+def get_ensemble_statistic(ensemble_array, method_x, method_y):
+    """
+    Calculates the streamflow for each river from the ensemble array
+    (river x ensemble x time)
+     
+    method_x = the first axis - it produces the max, min, mean, mean_plus_std, mean_minus_std hydrograph data for the ensembles
+    method_y = the second axis - it calculates the max, min, mean, mean_plus_std, mean_minus_std value from method_x
+
+    Rivers without data have a streamflow of zero
+    """
+    with warnings.catch_warnings():
+        #rivers or time steps without any data are all NaN
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        series_array = _reduce_ensemble_axis(ensemble_array, method_x, axis=1)
+        streamflow_list = _reduce_ensemble_axis(series_array, method_y, axis=1)
+    streamflow_list[np.isnan(streamflow_list)] = 0
+    return streamflow_list
+
+def get_ecmwf_streamflow(prediction_files, river_id_list, method_x, method_y,
+                         pool=None, max_memory_bytes=DEFAULT_MAX_MEMORY_BYTES):
+    """
+    Calculates the streamflow for each river id from the ECMWF ensemble
+    predictions (see get_ensemble_statistic)
+
+    The rivers are processed in blocks so that the ensemble array
+    stays within max_memory_bytes. If a multiprocessing pool is given,
+    the ensemble members are read in parallel.
+    """
+    river_id_list = np.asarray(river_id_list)
+    with RAPIDDataset(prediction_files[0]) as data_nc:
+        num_time_steps = get_ecmwf_first_half_size(data_nc.size_time) + 20
+    river_block_size = max(1, int(max_memory_bytes // \
+                                  (np.dtype(np.float64).itemsize * len(prediction_files) * num_time_steps)))
+
+    streamflow_list = np.zeros(len(river_id_list))
+    for river_block_start in range(0, len(river_id_list), river_block_size):
+        river_block = slice(river_block_start, river_block_start + river_block_size)
+        ensemble_array = read_ecmwf_ensemble(prediction_files,
+                                             river_id_list[river_block],
+                                             pool=pool)
+        streamflow_list[river_block] = get_ensemble_statistic(ensemble_array,
+                                                              method_x,
+                                                              method_y)
+    return streamflow_list
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+##
+##  tile_dem.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License BSD 3-Clause
+
+import json
+from math import ceil, cos, radians, sqrt
+import multiprocessing
+import os
+from shutil import rmtree
+
+import numpy as np
+from osgeo import gdal, osr
+
+#local imports
+from ..utilities import write_json_file_atomic
+
+#file with the grid of the DEM and the windows of the tiles
+DEM_TILE_INDEX_FILE = "dem_tile_index.json"
+
+#about 4096 x 4096 cells per tile
+DEFAULT_TARGET_TILE_CELLS = 16777216
+
+#meters in a degree of latitude
+METERS_PER_DEGREE = 111320.0
+
+#------------------------------------------------------------------------------
+#Helper Functions
+#------------------------------------------------------------------------------
+def get_tile_windows(x_size, y_size, target_tile_cells=DEFAULT_TARGET_TILE_CELLS, halo_cells=0):
+    """
+    Splits a grid into tiles of about target_tile_cells cells (without
+    the halo) with the same size within a cell. Returns a list of
+    (tile row, tile column, core window, halo window) where a window is
+    (x offset, y offset, x size, y size) and the halo window is the core
+    window grown by halo_cells on each side (within the grid).
+    """
+    tile_side = max(1, int(sqrt(target_tile_cells)))
+    num_tile_cols = max(1, int(ceil(float(x_size) / tile_side)))
+    num_tile_rows = max(1, int(ceil(float(y_size) / tile_side)))
+    x_offsets = [x_size * tile_col // num_tile_cols for tile_col in range(num_tile_cols + 1)]
+    y_offsets = [y_size * tile_row // num_tile_rows for tile_row in range(num_tile_rows + 1)]
+    tile_window_list = []
+    for tile_row in range(num_tile_rows):
+        for tile_col in range(num_tile_cols):
+            x_start, x_end = x_offsets[tile_col], x_offsets[tile_col + 1]
+            y_start, y_end = y_offsets[tile_row], y_offsets[tile_row + 1]
+            halo_x_start = max(0, x_start - halo_cells)
+            halo_y_start = max(0, y_start - halo_cells)
+            halo_x_end = min(x_size, x_end + halo_cells)
+            halo_y_end = min(y_size, y_end + halo_cells)
+            tile_window_list.append((tile_row, tile_col,
+                                     (x_start, y_start, x_end - x_start, y_end - y_start),
+                                     (halo_x_start, halo_y_start,
+                                      halo_x_end - halo_x_start, halo_y_end - halo_y_start)))
+    return tile_window_list
+
+def get_halo_cells(dem_raster, x_section_dist):
+    """
+    Returns the number of cells the cross sections of AutoRoute
+    (x_section_dist in meters) can reach past the edge of a tile
+    """
+    if not x_section_dist:
+        return 0
+    geotransform = dem_raster.GetGeoTransform()
+    cell_size_x = abs(geotransform[1])
+    cell_size_y = abs(geotransform[5])
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.ImportFromWkt(dem_raster.GetProjection())
+    if spatial_reference.IsGeographic():
+        center_latitude = geotransform[3] + geotransform[5] * dem_raster.RasterYSize / 2.0
+        cell_size_x *= METERS_PER_DEGREE * cos(radians(center_latitude))
+        cell_size_y *= METERS_PER_DEGREE
+    else:
+        cell_size_x *= spatial_reference.GetLinearUnits()
+        cell_size_y *= spatial_reference.GetLinearUnits()
+    return int(ceil(float(x_section_dist) / min(cell_size_x, cell_size_y)))
+
+def write_dem_tile(args):
+    """
+    Writes the halo window of the DEM to the tile folder
+    (can run on one of multiple cores). Returns None if the tile only
+    has no data cells and skip_empty is set.
+    """
+    dem_file, tile_folder, tile_file, halo_window, driver_name, creation_options, skip_empty = args
+    try:
+        os.makedirs(tile_folder)
+    except OSError:
+        pass
+    tile_raster = gdal.Translate(tile_file, dem_file, format=driver_name,
+                                 srcWin=list(halo_window), creationOptions=creation_options)
+    if skip_empty:
+        tile_band = tile_raster.GetRasterBand(1)
+        no_data_value = tile_band.GetNoDataValue()
+        if no_data_value is not None and \
+            not np.any(tile_band.ReadAsArray() != no_data_value):
+            tile_raster = None
+            rmtree(tile_folder)
+            return None
+    tile_raster = None
+    return tile_folder
+
+def read_dem_tile_index(tile_index_file):
+    """
+    Reads the tile index written by tile_dem
+    """
+    with open(tile_index_file) as tile_index_handle:
+        return json.load(tile_index_handle)
+
+#------------------------------------------------------------------------------
+#Main Functions
+#------------------------------------------------------------------------------
+def tile_dem(dem_file, watershed_folder, target_tile_cells=DEFAULT_TARGET_TILE_CELLS,
+             x_section_dist=None, halo_cells=None, dem_extension='img',
+             num_cpus=1, skip_empty=True):
+    """
+    Splits a DEM of any size into tiles of about target_tile_cells cells
+    in their own folder of the watershed folder (the structure
+    prepare_autoroute_multiprocess expects) instead of using the
+    tiles the DEM came in (see organize_dem).
+
+    Each tile has a halo of halo_cells (default is the cells the cross
+    sections can reach from x_section_dist in meters) shared with its
+    neighbors so the flood maps do not stop at the tile edges
+    (see stitch_tile_rasters). The tiles are written on num_cpus cores
+    and tiles with only no data cells are skipped if skip_empty is set.
+
+    The tiles are written with dem_extension (img or tif), which must
+    match the dem_extension given to prepare_autoroute_multiprocess.
+
+    The grid of the DEM and the windows of the tiles are written to
+    dem_tile_index.json in the watershed folder. Returns the tile folders.
+    """
+    dem_raster = gdal.Open(dem_file)
+    x_size = dem_raster.RasterXSize
+    y_size = dem_raster.RasterYSize
+    if halo_cells is None:
+        halo_cells = get_halo_cells(dem_raster, x_section_dist)
+    tile_index = {
+                  'dem_file': os.path.abspath(dem_file),
+                  'watershed': os.path.basename(os.path.abspath(watershed_folder)),
+                  'x_size': x_size,
+                  'y_size': y_size,
+                  'geotransform': list(dem_raster.GetGeoTransform()),
+                  'projection': dem_raster.GetProjection(),
+                  'no_data_value': dem_raster.GetRasterBand(1).GetNoDataValue(),
+                  'halo_cells': halo_cells,
+                  'tiles': {},
+                 }
+    dem_raster = None
+
+    driver_name = {'tif': 'GTiff', 'img': 'HFA'}.get(dem_extension.lower(), 'GTiff')
+    creation_options = ['TILED=YES', 'COMPRESS=DEFLATE'] if driver_name == 'GTiff' else []
+    tile_job_list = []
+    tile_window_list = get_tile_windows(x_size, y_size, target_tile_cells, halo_cells)
+    for tile_row, tile_col, core_window, halo_window in tile_window_list:
+        tile_name = "tile_{0}_{1}".format(tile_row, tile_col)
+        tile_folder = os.path.join(watershed_folder, tile_name)
+        tile_index['tiles'][tile_name] = {'core_window': core_window,
+                                          'halo_window': halo_window}
+        tile_job_list.append((dem_file, tile_folder,
+                              os.path.join(tile_folder, "{0}.{1}".format(tile_name, dem_extension)),
+                              halo_window, driver_name, creation_options, skip_empty))
+
+    print("Tiling DEM into {0} tiles with a halo of {1} cells ...".format(len(tile_job_list), halo_cells))
+    try:
+        os.makedirs(watershed_folder)
+    except OSError:
+        pass
+    if num_cpus > 1 and len(tile_job_list) > 1:
+        pool = multiprocessing.Pool(min(num_cpus, len(tile_job_list)))
+        tile_folder_list = pool.map(write_dem_tile, tile_job_list)
+        pool.close()
+        pool.join()
+    else:
+        tile_folder_list = [write_dem_tile(tile_job) for tile_job in tile_job_list]
+
+    #only the tiles with data are in the index
+    for tile_job, tile_folder in zip(tile_job_list, tile_folder_list):
+        if tile_folder is None:
+            tile_index['tiles'].pop(os.path.basename(tile_job[1]))
+    write_json_file_atomic(os.path.join(watershed_folder, DEM_TILE_INDEX_FILE), tile_index)
+    return [tile_folder for tile_folder in tile_folder_list if tile_folder is not None]
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+##
+##  run_async.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+##
+##  NOTE: Python 3 only (asyncio)
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from datetime import datetime
+import os
+import sys
+import threading
+from time import time
+
+#local imports
+from ..executable import kill_process_tree
+from ..instrumentation import span
+from ..scheduling import JobResourceMonitor
+from .worker_multiprocess import (AutoRouteRun,
+                                  get_run_job_output,
+                                  get_run_job_output_file_list)
+
+#----------------------------------------------------------------------------------------
+# HELPER FUNCTIONS
+#----------------------------------------------------------------------------------------
+class _ThreadStdOut(object):
+    """
+    Standard output that writes to the log file of the job run in the
+    current thread if set, otherwise to the original standard output
+    (the jobs are prepared in threads at the same time)
+
+    It only replaces sys.stdout while a thread writes to a log file,
+    so the output of the caller is not changed between jobs.
+    """
+    def __init__(self):
+        self._stdout = sys.stdout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._num_log_files = 0
+
+    def start_log_file(self, log_file):
+        """
+        Writes the output of the current thread to the log file
+        """
+        with self._lock:
+            if self._num_log_files == 0:
+                self._stdout = sys.stdout
+                sys.stdout = self
+            self._num_log_files += 1
+        self._local.log_file = log_file
+
+    def stop_log_file(self):
+        """
+        Stops writing the output of the current thread to its log file
+        (sys.stdout is restored when no thread writes to a log file)
+        """
+        self._local.log_file = None
+        with self._lock:
+            self._num_log_files -= 1
+            if self._num_log_files == 0 and sys.stdout is self:
+                sys.stdout = self._stdout
+
+    def _get_stream(self):
+        return getattr(self._local, 'log_file', None) or self._stdout
+
+    def write(self, text):
+        self._get_stream().write(text)
+
+    def flush(self):
+        self._get_stream().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stdout, name)
+
+def _call_with_log(thread_stdout, log_file_path, function):
+    """
+    Calls the function in this thread with its output appended to the log
+    """
+    with open(log_file_path, 'a') as log_file:
+        thread_stdout.start_log_file(log_file)
+        try:
+            return function()
+        finally:
+            thread_stdout.stop_log_file()
+
+def _notify_event_loop(loop, event):
+    """
+    Sets the event from another thread (ignored once the loop is closed)
+    """
+    try:
+        loop.call_soon_threadsafe(event.set)
+    except RuntimeError:
+        pass
+
+def _get_autoroute_run(run_job):
+    """
+    Returns the AutoRoute run of a run_autoroute_multiprocess job
+    (each run has its own copy of the AutoRoute manager)
+    """
+    return AutoRouteRun(run_job[0],
+                        deepcopy(run_job[1]),
+                        run_job[2],
+                        run_job[3],
+                        run_job[4],
+                        out_shapefile_name=run_job[5],
+                        delete_flood_raster=run_job[6],
+                        stream_info_file=run_job[9],
+                        incremental=run_job[11],
+                        output_manifest_file=run_job[13])
+
+async def _run_autoroute_job(semaphore, executor, thread_stdout, run_job):
+    """
+    Writes the input file of the job in a thread of the executor (the
+    inputs are hashed in incremental mode) and runs the AutoRoute
+    executable as a subprocess. Returns the job, the time it started
+    and finished, the error (None if it succeeded) and the cpu time and
+    peak memory of the executable (None if it did not run or psutil is
+    not installed).
+    """
+    job_name = run_job[7]
+    log_file_path = os.path.join(run_job[8], "{0}-{1}.log".format(job_name, datetime.now().strftime("%Y-%m-%d_%H-%M-%S")))
+    timeout = run_job[12]
+    loop = asyncio.get_event_loop()
+    job_resources = None
+    job_error = None
+    async with semaphore:
+        time_start = time()
+        try:
+            autoroute_run = _get_autoroute_run(run_job)
+            open(log_file_path, 'w').close()
+            run_required = await loop.run_in_executor(executor, _call_with_log, thread_stdout,
+                                                      log_file_path, autoroute_run.prepare)
+            if run_required:
+                #bytes and RSS of the span are of this process (shared by the jobs)
+                with span("autoroute_run", os.path.basename(run_job[2])):
+                    with open(log_file_path, 'a') as log_file:
+                        log_file.write("Running AutoRoute ...\nAutoRoute output:\n")
+                        log_file.flush()
+                        process = await asyncio.create_subprocess_exec(*autoroute_run.get_command_list(),
+                                                                       cwd=run_job[2],
+                                                                       stdout=log_file,
+                                                                       stderr=asyncio.subprocess.PIPE)
+                        #sampled in a thread as in the pool workers
+                        with JobResourceMonitor(process_id=process.pid) as job_resources:
+                            try:
+                                _, error_output = await asyncio.wait_for(process.communicate(), timeout)
+                            except asyncio.TimeoutError:
+                                kill_process_tree(process)
+                                await process.wait()
+                                raise Exception("ERROR: AutoRoute exceeded the timeout of {0} seconds and was killed ...".format(timeout))
+                        error_output = error_output.decode('utf-8', 'replace').strip()
+                        if error_output or process.returncode != 0:
+                            raise Exception("ERROR: AutoRoute failed with exit code {0}:\n{1}".format(process.returncode,
+                                                                                                     error_output))
+                        log_file.write("Time to run AutoRoute: {0}\n".format(time() - time_start))
+                #the outputs are read for the manifest
+                await loop.run_in_executor(executor, _call_with_log, thread_stdout,
+                                           log_file_path, autoroute_run.finish)
+        except Exception as ex:
+            with open(log_file_path, 'a') as log_file:
+                log_file.write("{0}\n".format(ex))
+            job_error = str(ex)
+        time_end = time()
+    if job_resources is None:
+        return run_job, time_start, time_end, job_error, None, None
+    return run_job, time_start, time_end, job_error, job_resources.cpu_time, job_resources.peak_memory
+
+#----------------------------------------------------------------------------------------
+# MAIN FUNCTION
+#----------------------------------------------------------------------------------------
+def run_autoroute_async(run_job_list, num_concurrent_jobs, job_checkpoint=None, job_ledger=None,
+                        pipeline=None, pipeline_run_job_lists=None):
+    """
+    Runs the run_autoroute_multiprocess jobs with up to num_concurrent_jobs
+    AutoRoute executables at once from this process instead of a Python
+    worker process per job. Yields the output of each job as it finishes
+    (the same as run_autoroute_multiprocess_worker).
+
+    If pipeline (MultiprocessPipeline) is set, the jobs in
+    pipeline_run_job_lists by the output of a pipeline job (i.e. the name
+    of the streamflow preparation job of the sub-basin) are started as
+    soon as that job finishes. The jobs in run_job_list start right away.
+
+    The jobs are recorded in the checkpoint and ledger if set. Raises
+    an exception after all of the jobs finished if a job failed.
+    """
+    pipeline_run_job_lists = dict(pipeline_run_job_lists or {})
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    executor = ThreadPoolExecutor(max_workers=num_concurrent_jobs)
+    thread_stdout = _ThreadStdOut()
+    try:
+        semaphore = asyncio.Semaphore(num_concurrent_jobs)
+        pending_task_set = set()
+        num_jobs = 0
+
+        def start_jobs(start_run_job_list):
+            for run_job in start_run_job_list:
+                pending_task_set.add(loop.create_task(_run_autoroute_job(semaphore, executor,
+                                                                         thread_stdout, run_job)))
+
+        start_jobs(run_job_list)
+        num_jobs += len(run_job_list)
+        pipeline_event = None
+        pipeline_wait_task = None
+        if pipeline is not None:
+            pipeline_event = asyncio.Event()
+            pipeline.set_result_listener(lambda: _notify_event_loop(loop, pipeline_event))
+        job_error_list = []
+        time_start = time()
+        busy_time = 0
+        while True:
+            if pipeline is not None:
+                #start the jobs of the pipeline jobs that finished
+                pipeline_event.clear()
+                try:
+                    for stage_name, job_output in pipeline.results(block=False):
+                        print("{0} finished: {1}".format(stage_name, job_output))
+                        ready_run_job_list = pipeline_run_job_lists.pop(job_output, [])
+                        start_jobs(ready_run_job_list)
+                        num_jobs += len(ready_run_job_list)
+                except Exception as ex:
+                    #the jobs waiting on the pipeline are not run
+                    job_error_list.append(str(ex))
+                    pipeline.set_result_listener(None)
+                    pipeline = None
+                else:
+                    if pipeline.is_finished():
+                        pipeline.set_result_listener(None)
+                        pipeline = None
+            if not pending_task_set and pipeline is None:
+                break
+            wait_task_set = set(pending_task_set)
+            if pipeline is not None:
+                if pipeline_wait_task is None:
+                    pipeline_wait_task = loop.create_task(pipeline_event.wait())
+                wait_task_set.add(pipeline_wait_task)
+            done_task_set = loop.run_until_complete(asyncio.wait(wait_task_set,
+                                                                 return_when=asyncio.FIRST_COMPLETED))[0]
+            if pipeline_wait_task in done_task_set:
+                pipeline_wait_task = None
+            for job_task in done_task_set & pending_task_set:
+                pending_task_set.discard(job_task)
+                run_job, job_time_start, job_time_end, job_error, job_cpu_time, job_peak_memory = job_task.result()
+                busy_time += job_time_end - job_time_start
+                output_file_list = get_run_job_output_file_list(run_job)
+                status = "success" if job_error is None else "failed"
+                if job_checkpoint is not None:
+                    job_checkpoint.record_job("AutoRoute simulation", run_job[7], status=status,
+                                              output_file_list=output_file_list, error=job_error or "")
+                if job_ledger is not None:
+                    job_ledger.record_job("AutoRoute simulation", run_job[7], job_time_start, job_time_end,
+                                          cpu_time=job_cpu_time, peak_memory=job_peak_memory,
+                                          status=status, error=job_error or "", input_directory=run_job[2],
+                                          output_file_list=output_file_list)
+                if job_error is not None:
+                    job_error_list.append("{0}: {1}".format(run_job[7], job_error))
+                    continue
+                yield get_run_job_output(run_job)
+        if pipeline_wait_task is not None:
+            pipeline_wait_task.cancel()
+        total_wall_time = max(time() - time_start, 1e-9)
+        print("AutoRoute simulation: {0} jobs, core utilization {1:.1f}% of {2} concurrent jobs".format(num_jobs,
+                                                                                                       100.0 * busy_time / (num_concurrent_jobs * total_wall_time),
+                                                                                                       num_concurrent_jobs))
+    finally:
+        if pipeline is not None:
+            pipeline.set_result_listener(None)
+        executor.shutdown(wait=True)
+        loop.close()
+        asyncio.set_event_loop(None)
+
+    if job_error_list:
+        raise Exception("ERROR: {0} AutoRoute simulation(s) failed:\n{1}".format(len(job_error_list),
+                                                                                 "\n".join(job_error_list)))
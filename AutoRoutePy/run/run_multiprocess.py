@@ -21,13 +21,41 @@ except ImportError:
           "mode, please install condorpy (i.e. pip install condorpy).")
     pass
 
+#python 3 only
+try:
+    from .run_async import run_autoroute_async
+except (ImportError, SyntaxError):
+    run_autoroute_async = None
+
 #local imports
+from ..checkpoint import JobCheckpoint
+from ..instrumentation import (enable_instrumentation,
+                               restore_instrumentation,
+                               write_prometheus_textfile)
+from ..ledger import JobLedger
 from ..utilities import (CaptureStdOutToLog, 
-                        case_insensitive_file_search, 
-                        get_valid_num_cpus)
-from .worker_multiprocess import run_AutoRoute
-from ..prepare.prepare_multiprocess import (get_valid_streamflow_prepare_mode,
+                        case_insensitive_file_search)
+from .worker_multiprocess import (get_run_job_output,
+                                  get_run_job_output_file_list,
+                                  run_AutoRoute)
+from ..prepare.prepare_multiprocess import (get_ecmwf_streamflow_lookup_list,
+                                            get_return_period_streamflow_lookup_list,
+                                            get_valid_streamflow_prepare_mode,
                                             prepare_autoroute_streamflow_multiprocess_worker)
+from ..prepare.stream_info import get_stream_info_scenario_file
+from ..scheduling import (VALID_JOB_ORDER_LIST,
+                          MultiprocessPipeline,
+                          estimate_autoroute_job_cost,
+                          estimate_autoroute_job_memory,
+                          estimate_streamflow_job_memory,
+                          get_autoroute_job_size,
+                          get_job_cost_list,
+                          get_job_memory_budget,
+                          get_job_order)
+from ..prepare.streamflow import DEFAULT_MAX_MEMORY_BYTES
+
+#how the AutoRoute simulations are run in multiprocess mode
+VALID_EXECUTOR_LIST = ['multiprocess', 'async']
 
 #----------------------------------------------------------------------------------------
 # MULTIPROCESS FUNCTIONS
@@ -46,9 +74,89 @@ def run_autoroute_multiprocess_worker(args):
                       out_flood_map_raster_name=args[3],
                       out_flood_depth_raster_name=args[4],
                       out_shapefile_name=args[5],
-                      delete_flood_raster=args[6])
+                      delete_flood_raster=args[6],
+                      stream_info_file=args[9],
+                      incremental=args[11],
+                      timeout=args[12],
+                      output_manifest_file=args[13])
         
-    return args[2], args[3], args[4], job_name
+    return get_run_job_output(args)
+
+def _get_pipeline_run_outputs(pipeline, pool, job_ledger=None, completed_run_output_list=()):
+    """
+    Yields the output of the AutoRoute simulations as they finish
+    (after the simulations completed in a previous run) and closes the
+    pool (and job ledger) with a report of the stage times when done.
+    The pool is terminated if a job failed.
+    """
+    for job_output in completed_run_output_list:
+        yield job_output
+    finished = False
+    try:
+        for stage_name, job_output in pipeline.results():
+            if stage_name == "Streamflow preparation":
+                print("STREAMFLOW READY: {0}".format(job_output))
+            else:
+                yield job_output
+        finished = True
+    finally:
+        if finished:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+        if job_ledger is not None:
+            job_ledger.close()
+    pipeline.print_report()
+
+def _get_async_run_outputs(pipeline, pool, run_job_list, streamflow_job_list, num_concurrent_jobs,
+                           job_checkpoint=None, job_ledger=None, completed_run_output_list=()):
+    """
+    Yields the output of the AutoRoute simulations as they finish running
+    the AutoRoute executables from this process with asyncio. The
+    simulations of a sub-basin start as soon as its streamflow is
+    prepared in the pool (if any).
+    """
+    for job_output in completed_run_output_list:
+        yield job_output
+    streamflow_job_names = dict((streamflow_job[1], streamflow_job[12]) \
+                                for streamflow_job in streamflow_job_list)
+    start_run_job_list = []
+    pipeline_run_job_lists = {}
+    for run_job in run_job_list:
+        if run_job[2] in streamflow_job_names:
+            pipeline_run_job_lists.setdefault(streamflow_job_names[run_job[2]], []).append(run_job)
+        else:
+            start_run_job_list.append(run_job)
+    finished = False
+    try:
+        for job_output in run_autoroute_async(start_run_job_list, num_concurrent_jobs,
+                                              job_checkpoint, job_ledger,
+                                              pipeline, pipeline_run_job_lists):
+            yield job_output
+        finished = True
+    finally:
+        if pool is not None:
+            if finished:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+        if job_ledger is not None:
+            job_ledger.close()
+    if pipeline is not None:
+        pipeline.print_report()
+
+def _restore_instrumentation_when_done(job_output_generator, previous_events_file):
+    """
+    Yields the job outputs and restores the events file of the caller
+    when done
+    """
+    try:
+        for job_output in job_output_generator:
+            yield job_output
+    finally:
+        restore_instrumentation(previous_events_file)
 
 #----------------------------------------------------------------------------------------
 # MAIN PROCESS
@@ -59,7 +167,7 @@ def run_autoroute_multiprocess(autoroute_input_directory, #path to AutoRoute inp
                                autoroute_executable_location="", #location of AutoRoute executable
                                autoroute_manager=None, #AutoRoute manager with default parameters
                                rapid_output_directory="", #path to ECMWF RAPID input/output directory
-                               return_period="", # return period name in return period file
+                               return_period="", # return period name in return period file (or list of names to run all at once)
                                return_period_file="", # return period file generated from RAPID historical run
                                rapid_output_file="", #path to RAPID output file to be used
                                date_peak_search_start=None, #datetime of start of search for peakflow
@@ -72,10 +180,52 @@ def run_autoroute_multiprocess(autoroute_input_directory, #path to AutoRoute inp
                                generate_flood_depth_raster=False, #generate flood raster
                                generate_flood_map_shapefile=False, #generate a flood map shapefile
                                wait_for_all_processes_to_finish=True, #waits for all processes to finish before ending script
-                               num_cpus=-17 #number of processes to use on computer
+                               num_cpus=-17, #number of processes to use on computer
+                               rapid_output_max_memory_bytes=DEFAULT_MAX_MEMORY_BYTES, #memory limit per process for reading RAPID output
+                               job_order="directory", #order to submit jobs (directory or largest_first)
+                               job_runtime_history=None, #historical runtime in seconds by job name for job_order
+                               job_memory_budget=None, #memory in bytes for running jobs (None for 80% of memory, 0 for 3 GB per cpu)
+                               job_ledger_file="", #SQLite file to record the jobs in and read the job history from
+                               incremental=False, #reuse the outputs of simulations with unchanged inputs
+                               resume=False, #only run the simulations not completed in the last run
+                               autoroute_timeout=None, #seconds before the AutoRoute executable of a job is killed
+                               executor="multiprocess", #run simulations in a pool of python workers (multiprocess) or from this process (async, python 3)
+                               instrumentation_events_file="", #JSON lines file to write the timing and resources of each stage to
+                               prometheus_textfile="", #Prometheus textfile collector file summarizing the events when finished
+                               job_budget=None, #JobBudget with the cpus and memory budget shared with other runs (replaces num_cpus and job_memory_budget)
                                ):
     """
     This it the main AutoRoute-RAPID process
+
+    If return_period is a list, the streamflow for all of the return periods
+    is prepared in one pass and the simulations of every return period and
+    sub-basin run in the same pool. The output of each return period is
+    in a folder with its name in the output directory.
+
+    Jobs are only started while the sum of their estimated memory fits
+    in job_memory_budget, so large sub-basins do not run out of memory
+    when they run at the same time. If job_budget is set, the cpus and
+    memory budget are shared with the other runs using it (i.e. several
+    watersheds run at the same time).
+
+    If job_ledger_file is set, each job is recorded in the ledger and the
+    runtime and peak memory of previous runs are used for scheduling.
+
+    If incremental is True, simulations with the same inputs as the last
+    run reuse the existing outputs instead of running AutoRoute again.
+
+    In multiprocess mode, the status and outputs of each simulation are
+    written to autoroute_run_manifest.json in the output directory as it
+    finishes. If resume is True, the simulations with complete outputs
+    in the manifest are not run again.
+
+    With the async executor, the AutoRoute input files are written and
+    up to num_cpus AutoRoute executables are run from this process with
+    asyncio instead of a python worker process for each simulation
+    (the memory budget is not used for the simulations).
+
+    If instrumentation_events_file is set, the timing and resources of
+    each stage of each job are written to it as JSON lines.
     """
     time_start_all = datetime.utcnow()
     if not generate_flood_depth_raster and not generate_flood_map_raster and not generate_flood_map_shapefile:
@@ -91,245 +241,444 @@ def run_autoroute_multiprocess(autoroute_input_directory, #path to AutoRoute inp
     if mode == "htcondor" and not HTCONDOR_ENABLED:
         raise Exception("ERROR: HTCondor mode not allowed. Must have condorpy and HTCondor installed to work ...".format(mode))
         
-    #DETERMINE MODE TO PREPARE STREAMFLOW
-    PREPARE_MODE = get_valid_streamflow_prepare_mode(autoroute_input_directory,
-                                                     rapid_output_directory,
-                                                     return_period,
-                                                     return_period_file,
-                                                     rapid_output_file,
-                                                     river_id,
-                                                     streamflow_id,
-                                                     stream_network_shapefile,
-                                                     )    
-    #--------------------------------------------------------------------------
-    #Initialize Run
-    #--------------------------------------------------------------------------
+    if executor not in VALID_EXECUTOR_LIST:
+        raise Exception("ERROR: Invalid executor {0}. Only {1} allowed ...".format(executor,
+                                                                                 ", ".join(VALID_EXECUTOR_LIST)))
+
+    if executor == "async" and run_autoroute_async is None:
+        raise Exception("ERROR: The async executor requires Python 3 ...")
+
+    if executor == "async" and mode != "multiprocess":
+        raise Exception("ERROR: The async executor is only available in multiprocess mode ...")
+
+    if prometheus_textfile and not instrumentation_events_file:
+        raise Exception("ERROR: prometheus_textfile requires instrumentation_events_file ...")
+
+    #the events file of the caller is restored when done
+    previous_events_file = None
+    if instrumentation_events_file:
+        previous_events_file = enable_instrumentation(instrumentation_events_file)
     try:
-        os.makedirs(autoroute_output_directory)
-    except OSError:
-        pass
+
+        if job_order not in VALID_JOB_ORDER_LIST:
+            raise Exception("ERROR: Invalid job order {0}. Only {1} allowed ...".format(job_order,
+                                                                                      ", ".join(VALID_JOB_ORDER_LIST)))
+
+        #DETERMINE MODE TO PREPARE STREAMFLOW
+        PREPARE_MODE = get_valid_streamflow_prepare_mode(autoroute_input_directory,
+                                                         rapid_output_directory,
+                                                         return_period,
+                                                         return_period_file,
+                                                         rapid_output_file,
+                                                         river_id,
+                                                         streamflow_id,
+                                                         stream_network_shapefile,
+                                                         )    
+        #a list of return periods runs each return period as a scenario
+        #with its own stream info file and output directory
+        scenario_list = [""]
+        if PREPARE_MODE == 2 and isinstance(return_period, (list, tuple)):
+            if mode == "htcondor":
+                raise Exception("ERROR: Multiple return periods only allowed in multiprocess mode ...")
+            scenario_list = list(return_period)
+
+        #--------------------------------------------------------------------------
+        #Initialize Run
+        #--------------------------------------------------------------------------
+        for scenario_name in scenario_list:
+            try:
+                os.makedirs(os.path.join(autoroute_output_directory, scenario_name))
+            except OSError:
+                pass
     
-    local_scripts_location = os.path.dirname(os.path.realpath(__file__))
+        local_scripts_location = os.path.dirname(os.path.realpath(__file__))
 
-    #initialize HTCondor/multiprocess log directories
-    prepare_log_directory = os.path.join(log_directory, "prepare")
-    try:
-        os.makedirs(prepare_log_directory)
-    except OSError:
-        pass
-    if PREPARE_MODE > 0:
-        print("Streamflow preparation logs can be found here: {0}".format(prepare_log_directory))
+        #initialize HTCondor/multiprocess log directories
+        prepare_log_directory = os.path.join(log_directory, "prepare")
+        try:
+            os.makedirs(prepare_log_directory)
+        except OSError:
+            pass
+        if PREPARE_MODE > 0:
+            print("Streamflow preparation logs can be found here: {0}".format(prepare_log_directory))
         
-    run_log_directory = os.path.join(log_directory, "run")
-    try:
-        os.makedirs(run_log_directory)
-    except OSError:
-        pass
-    print("AutoRoute simulation logs can be found here: {0}".format(run_log_directory))
-
-    #keep list of jobs
-    autoroute_job_info = {
-                            'multiprocess_job_list': [],
-                            'htcondor_job_list': [],
-                            'htcondor_job_info': [],
-                            'output_folder': autoroute_output_directory,
-                           }
+        run_log_directory = os.path.join(log_directory, "run")
+        try:
+            os.makedirs(run_log_directory)
+        except OSError:
+            pass
+        print("AutoRoute simulation logs can be found here: {0}".format(run_log_directory))
+
+        #keep list of jobs
+        autoroute_job_info = {
+                                'multiprocess_job_list': [],
+                                'htcondor_job_list': [],
+                                'htcondor_job_info': [],
+                                'output_folder': autoroute_output_directory,
+                               }
                            
-    if mode == "multiprocess":
-        num_cpus = get_valid_num_cpus(num_cpus)                    
-        #start pool
-        pool_streamflow = multiprocessing.Pool(num_cpus)
-        pool_main = multiprocessing.Pool(num_cpus)
+        pool_main = None
+        if mode == "multiprocess" or PREPARE_MODE > 0:
+            if job_budget is not None:
+                num_cpus, job_memory_budget = job_budget.num_cpus, job_budget.memory_budget
+            else:
+                num_cpus, job_memory_budget = get_job_memory_budget(num_cpus, job_memory_budget)
+            if executor == "multiprocess" or PREPARE_MODE > 0:
+                #start pool shared by the streamflow preparation and simulations
+                pool_main = multiprocessing.Pool(num_cpus)
 
-    #--------------------------------------------------------------------------
-    #Run the model
-    #--------------------------------------------------------------------------
-    #loop through sub-directories
-    streamflow_job_list = []
-    for directory in os.listdir(autoroute_input_directory):
-        master_watershed_autoroute_input_directory = os.path.join(autoroute_input_directory, directory)
-        if os.path.isdir(master_watershed_autoroute_input_directory):
-            autoroute_watershed_name = os.path.basename(autoroute_input_directory)
-            autoroute_job_name = "{0}-{1}".format(autoroute_watershed_name, directory)
+        #--------------------------------------------------------------------------
+        #Run the model
+        #--------------------------------------------------------------------------
+        #loop through sub-directories
+        streamflow_job_list = []
+        for directory in os.listdir(autoroute_input_directory):
+            master_watershed_autoroute_input_directory = os.path.join(autoroute_input_directory, directory)
+            if os.path.isdir(master_watershed_autoroute_input_directory):
+                autoroute_watershed_name = os.path.basename(autoroute_input_directory)
+                autoroute_job_name = "{0}-{1}".format(autoroute_watershed_name, directory)
             
-            try:
-                case_insensitive_file_search(master_watershed_autoroute_input_directory, r'elevation\.(?!prj)')
-            except Exception:
                 try:
-                    case_insensitive_file_search(os.path.join(master_watershed_autoroute_input_directory, 'elevation'), r'hdr\.adf')
+                    case_insensitive_file_search(master_watershed_autoroute_input_directory, r'elevation\.(?!prj)')
                 except Exception:
-                    print("ERROR: Elevation raster not found. Skipping run ...")
-                    continue
+                    try:
+                        case_insensitive_file_search(os.path.join(master_watershed_autoroute_input_directory, 'elevation'), r'hdr\.adf')
+                    except Exception:
+                        print("ERROR: Elevation raster not found. Skipping run ...")
+                        continue
+                        pass
                     pass
-                pass
             
-            try:
-                stream_info_file = case_insensitive_file_search(master_watershed_autoroute_input_directory,
-                                                                r'stream_info\.txt')
-            except Exception:
-                print("Stream info file not found. Skipping run ...")
-                continue
-                pass
+                try:
+                    stream_info_file = case_insensitive_file_search(master_watershed_autoroute_input_directory,
+                                                                    r'stream_info\.txt')
+                except Exception:
+                    print("Stream info file not found. Skipping run ...")
+                    continue
+                    pass
 
-            if PREPARE_MODE > 0:
-                streamflow_job_list.append((PREPARE_MODE,
-                                            master_watershed_autoroute_input_directory,
-                                            stream_info_file,
-                                            rapid_output_directory,
-                                            return_period_file,
-                                            return_period,
-                                            rapid_output_file,
-                                            date_peak_search_start,
-                                            date_peak_search_end,
-                                            river_id,
-                                            streamflow_id,
-                                            stream_network_shapefile,
-                                            autoroute_job_name,
-                                            prepare_log_directory,
-                                            ))
+                if PREPARE_MODE > 0:
+                    streamflow_job_list.append((PREPARE_MODE,
+                                                master_watershed_autoroute_input_directory,
+                                                stream_info_file,
+                                                rapid_output_directory,
+                                                return_period_file,
+                                                return_period,
+                                                rapid_output_file,
+                                                date_peak_search_start,
+                                                date_peak_search_end,
+                                                river_id,
+                                                streamflow_id,
+                                                stream_network_shapefile,
+                                                autoroute_job_name,
+                                                prepare_log_directory,
+                                                rapid_output_max_memory_bytes,
+                                                None,
+                                                #HTCondor transfers the text file without the binary cache
+                                                mode == "htcondor",
+                                                ))
             
-            output_shapefile_base_name = '{0}_{1}'.format(autoroute_watershed_name, directory)
-            #set up flood raster name
-            output_flood_map_raster_name = 'flood_map_raster_{0}.tif'.format(output_shapefile_base_name)
-            master_output_flood_map_raster_name = os.path.join(autoroute_output_directory, output_flood_map_raster_name)
-            #set up flood raster name
-            output_flood_depth_raster_name = 'flood_depth_raster_{0}.tif'.format(output_shapefile_base_name)
-            master_output_flood_depth_raster_name = os.path.join(autoroute_output_directory, output_flood_depth_raster_name)
-            #set up flood shapefile name
-            output_shapefile_shp_name = '{0}.shp'.format(output_shapefile_base_name)
-            master_output_shapefile_shp_name = os.path.join(autoroute_output_directory, output_shapefile_shp_name)
-
-            delete_flood_map_raster = False
-            if not generate_flood_map_shapefile:
-                master_output_shapefile_shp_name = ""
-            else:
-                if not generate_flood_map_raster:
-                    generate_flood_map_raster = True
-                    delete_flood_map_raster = True
+                for scenario_name in scenario_list:
+                    scenario_output_directory = autoroute_output_directory
+                    scenario_stream_info_file = ""
+                    scenario_job_name = autoroute_job_name
+                    if scenario_name:
+                        #each scenario has its own stream info file and output directory
+                        scenario_output_directory = os.path.join(autoroute_output_directory, scenario_name)
+                        scenario_stream_info_file = get_stream_info_scenario_file(stream_info_file, scenario_name)
+                        scenario_job_name = "{0}-{1}".format(autoroute_job_name, scenario_name)
+
+                    output_shapefile_base_name = '{0}_{1}'.format(autoroute_watershed_name, directory)
+                    #set up flood raster name
+                    output_flood_map_raster_name = 'flood_map_raster_{0}.tif'.format(output_shapefile_base_name)
+                    master_output_flood_map_raster_name = os.path.join(scenario_output_directory, output_flood_map_raster_name)
+                    #set up flood raster name
+                    output_flood_depth_raster_name = 'flood_depth_raster_{0}.tif'.format(output_shapefile_base_name)
+                    master_output_flood_depth_raster_name = os.path.join(scenario_output_directory, output_flood_depth_raster_name)
+                    #set up flood shapefile name
+                    output_shapefile_shp_name = '{0}.shp'.format(output_shapefile_base_name)
+                    master_output_shapefile_shp_name = os.path.join(scenario_output_directory, output_shapefile_shp_name)
+
+                    delete_flood_map_raster = False
+                    if not generate_flood_map_shapefile:
+                        master_output_shapefile_shp_name = ""
+                    else:
+                        if not generate_flood_map_raster:
+                            generate_flood_map_raster = True
+                            delete_flood_map_raster = True
                 
-            if not generate_flood_map_raster:
-                master_output_flood_map_raster_name = ""
+                    if not generate_flood_map_raster:
+                        master_output_flood_map_raster_name = ""
 
-            if not generate_flood_depth_raster:
-                master_output_flood_depth_raster_name = ""
+                    if not generate_flood_depth_raster:
+                        master_output_flood_depth_raster_name = ""
 
-            if mode == "htcondor":
-                #create job to run autoroute for each raster in watershed
-                job = CJob('job_autoroute_{0}_{1}'.format(os.path.basename(autoroute_input_directory), directory), tmplt.vanilla_transfer_files)
+                    if mode == "htcondor":
+                        #create job to run autoroute for each raster in watershed
+                        job = CJob('job_autoroute_{0}_{1}'.format(os.path.basename(autoroute_input_directory), directory), tmplt.vanilla_transfer_files)
                 
 
-                if generate_flood_map_shapefile:
-                    #setup additional floodmap shapfile names
-                    output_shapefile_shx_name = '{0}.shx'.format(output_shapefile_base_name)
-                    master_output_shapefile_shx_name = os.path.join(autoroute_output_directory, output_shapefile_shx_name)
-                    output_shapefile_prj_name = '{0}.prj'.format(output_shapefile_base_name)
-                    master_output_shapefile_prj_name = os.path.join(autoroute_output_directory, output_shapefile_prj_name)
-                    output_shapefile_dbf_name = '{0}.dbf'.format(output_shapefile_base_name)
-                    master_output_shapefile_dbf_name = os.path.join(autoroute_output_directory, output_shapefile_dbf_name)
+                        if generate_flood_map_shapefile:
+                            #setup additional floodmap shapfile names
+                            output_shapefile_shx_name = '{0}.shx'.format(output_shapefile_base_name)
+                            master_output_shapefile_shx_name = os.path.join(scenario_output_directory, output_shapefile_shx_name)
+                            output_shapefile_prj_name = '{0}.prj'.format(output_shapefile_base_name)
+                            master_output_shapefile_prj_name = os.path.join(scenario_output_directory, output_shapefile_prj_name)
+                            output_shapefile_dbf_name = '{0}.dbf'.format(output_shapefile_base_name)
+                            master_output_shapefile_dbf_name = os.path.join(scenario_output_directory, output_shapefile_dbf_name)
                 
-                    transfer_output_remaps = "{0} = {1}; {2} = {3}; {4} = {5};" \
-                                             " {6} = {7}; {8} = {9}".format(output_shapefile_shp_name, 
-                                                                            master_output_shapefile_shp_name,
-                                                                            output_shapefile_shx_name,
-                                                                            master_output_shapefile_shx_name,
-                                                                            output_shapefile_prj_name,
-                                                                            master_output_shapefile_prj_name,
-                                                                            output_shapefile_dbf_name,
-                                                                            master_output_shapefile_dbf_name,
-                                                                            output_flood_map_raster_name,
-                                                                            master_output_flood_map_raster_name)
+                            transfer_output_remaps = "{0} = {1}; {2} = {3}; {4} = {5};" \
+                                                     " {6} = {7}; {8} = {9}".format(output_shapefile_shp_name, 
+                                                                                    master_output_shapefile_shp_name,
+                                                                                    output_shapefile_shx_name,
+                                                                                    master_output_shapefile_shx_name,
+                                                                                    output_shapefile_prj_name,
+                                                                                    master_output_shapefile_prj_name,
+                                                                                    output_shapefile_dbf_name,
+                                                                                    master_output_shapefile_dbf_name,
+                                                                                    output_flood_map_raster_name,
+                                                                                    master_output_flood_map_raster_name)
                     
-                    if generate_flood_depth_raster:
-                        transfer_output_remaps += "; {0} = {1}".format(output_flood_depth_raster_name, 
-                                                                       master_output_flood_depth_raster_name)
-                else:
-                    output_shapefile_shp_name = ""
-                    transfer_output_remaps = ""
-                    if generate_flood_map_raster:
-                        transfer_output_remaps = "{0} = {1}".format(output_flood_map_raster_name, 
-                                                                    master_output_flood_map_raster_name)
-                    if generate_flood_depth_raster:
-                        if transfer_output_remaps:
-                            transfer_output_remaps += "; "
+                            if generate_flood_depth_raster:
+                                transfer_output_remaps += "; {0} = {1}".format(output_flood_depth_raster_name, 
+                                                                               master_output_flood_depth_raster_name)
+                        else:
+                            output_shapefile_shp_name = ""
+                            transfer_output_remaps = ""
+                            if generate_flood_map_raster:
+                                transfer_output_remaps = "{0} = {1}".format(output_flood_map_raster_name, 
+                                                                            master_output_flood_map_raster_name)
+                            if generate_flood_depth_raster:
+                                if transfer_output_remaps:
+                                    transfer_output_remaps += "; "
                             
-                        transfer_output_remaps += "{0} = {1}".format(output_flood_depth_raster_name, 
-                                                                     master_output_flood_depth_raster_name)
+                                transfer_output_remaps += "{0} = {1}".format(output_flood_depth_raster_name, 
+                                                                             master_output_flood_depth_raster_name)
                                                                      
-                job.set('transfer_output_remaps',"\"{0}\"" .format(transfer_output_remaps))
+                        job.set('transfer_output_remaps',"\"{0}\"" .format(transfer_output_remaps))
                                                                       
-                job.set('executable', os.path.join(local_scripts_location,'multicore_worker_process.py'))
-                job.set('transfer_input_files', "{0}".format(master_watershed_autoroute_input_directory))
-                job.set('initialdir', run_log_directory)
+                        job.set('executable', os.path.join(local_scripts_location,'multicore_worker_process.py'))
+                        job.set('transfer_input_files', "{0}".format(master_watershed_autoroute_input_directory))
+                        job.set('initialdir', run_log_directory)
                     
-                job.set('arguments', '{0} {1} {2} {3} {4} {5} {6}' % (autoroute_executable_location,
-                                                                      autoroute_manager,
-                                                                      directory,
-                                                                      output_flood_map_raster_name,
-                                                                      output_flood_depth_raster_name,
-                                                                      output_shapefile_shp_name,
-                                                                      delete_flood_map_raster))
+                        job.set('arguments', '{0} {1} {2} {3} {4} {5} {6}' % (autoroute_executable_location,
+                                                                              autoroute_manager,
+                                                                              directory,
+                                                                              output_flood_map_raster_name,
+                                                                              output_flood_depth_raster_name,
+                                                                              output_shapefile_shp_name,
+                                                                              delete_flood_map_raster))
                                                               
-                autoroute_job_info['htcondor_job_list'].append(job)
-                autoroute_job_info['htcondor_job_info'].append({ 'output_shapefile_base_name': output_shapefile_base_name,
-                                                                 'autoroute_job_name': autoroute_job_name})
-
-            else: #mode == "multiprocess":
-                autoroute_job_info['multiprocess_job_list'].append((autoroute_executable_location,
-                                                                    autoroute_manager,
-                                                                    master_watershed_autoroute_input_directory,
-                                                                    master_output_flood_map_raster_name,
-                                                                    master_output_flood_depth_raster_name,
-                                                                    master_output_shapefile_shp_name,
-                                                                    delete_flood_map_raster,
-                                                                    autoroute_job_name,
-                                                                    run_log_directory
-                                                                    ))
-                #For testing function serially
-                """
-                run_autoroute_multiprocess_worker((autoroute_executable_location,
-                                                   autoroute_manager,
-                                                   master_watershed_autoroute_input_directory,
-                                                   master_output_flood_map_raster_name,
-                                                   master_output_flood_depth_raster_name,
-                                                   master_output_shapefile_shp_name,
-                                                   delete_flood_map_raster,
-                                                   autoroute_job_name,
-                                                   run_log_directory))
-                """
-    if PREPARE_MODE > 0:
-        #generate streamflow
-        streamflow_job_list = pool_streamflow.imap_unordered(prepare_autoroute_streamflow_multiprocess_worker,
-                                                             streamflow_job_list,
-                                                             chunksize=1)
-        for streamflow_job_output in streamflow_job_list:
-            print("STREAMFLOW READY: {0}".format(streamflow_job_output))
-        pool_streamflow.close()
-        pool_streamflow.join()
-        
-    print("Running AutoRoute simulations ...")
-    #submit jobs to run
-    if mode == "multiprocess":
-        autoroute_job_info['multiprocess_worker_list'] = pool_main.imap_unordered(run_autoroute_multiprocess_worker, 
-                                                                                 autoroute_job_info['multiprocess_job_list'], 
-                                                                                 chunksize=1)
-    else:
-        for htcondor_job in autoroute_job_info['htcondor_job_list']:
-            htcondor_job.submit()
-
-    if wait_for_all_processes_to_finish:
-        #wait for all of the jobs to complete
+                        autoroute_job_info['htcondor_job_list'].append(job)
+                        autoroute_job_info['htcondor_job_info'].append({ 'output_shapefile_base_name': output_shapefile_base_name,
+                                                                         'autoroute_job_name': scenario_job_name})
+
+                    else: #mode == "multiprocess":
+                        autoroute_job_info['multiprocess_job_list'].append((autoroute_executable_location,
+                                                                            autoroute_manager,
+                                                                            master_watershed_autoroute_input_directory,
+                                                                            master_output_flood_map_raster_name,
+                                                                            master_output_flood_depth_raster_name,
+                                                                            master_output_shapefile_shp_name,
+                                                                            delete_flood_map_raster,
+                                                                            scenario_job_name,
+                                                                            run_log_directory,
+                                                                            scenario_stream_info_file,
+                                                                            scenario_name,
+                                                                            incremental,
+                                                                            autoroute_timeout,
+                                                                            os.path.join(scenario_output_directory,
+                                                                                         'output_manifest_{0}.json'.format(output_shapefile_base_name)),
+                                                                            ))
+                        #For testing function serially
+                        """
+                        run_autoroute_multiprocess_worker((autoroute_executable_location,
+                                                           autoroute_manager,
+                                                           master_watershed_autoroute_input_directory,
+                                                           master_output_flood_map_raster_name,
+                                                           master_output_flood_depth_raster_name,
+                                                           master_output_shapefile_shp_name,
+                                                           delete_flood_map_raster,
+                                                           autoroute_job_name,
+                                                           run_log_directory))
+                        """
+
+        #skip the simulations that finished in a previous run
+        job_checkpoint = None
+        completed_run_output_list = []
         if mode == "multiprocess":
-            for multi_job_output in autoroute_job_info['multiprocess_worker_list']:
-                print("JOB FINISHED: {0}".format(multi_job_output[3]))
-            #just in case ...
-            pool_main.close()
-            pool_main.join()
+            job_checkpoint = JobCheckpoint(os.path.join(autoroute_output_directory, "autoroute_run_manifest.json"),
+                                           resume)
+            if resume:
+                run_job_list = []
+                for run_job in autoroute_job_info['multiprocess_job_list']:
+                    if job_checkpoint.is_job_complete("AutoRoute simulation",
+                                                      run_job[7],
+                                                      get_run_job_output_file_list(run_job)):
+                        completed_run_output_list.append(get_run_job_output(run_job))
+                    else:
+                        run_job_list.append(run_job)
+                print("Resuming run: {0} of {1} simulations already complete ...".format(len(completed_run_output_list),
+                                                                                        len(autoroute_job_info['multiprocess_job_list'])))
+                autoroute_job_info['multiprocess_job_list'] = run_job_list
+                #only prepare the sub-basins with simulations left to run
+                run_directory_list = set([run_job[2] for run_job in run_job_list])
+                streamflow_job_list = [streamflow_job for streamflow_job in streamflow_job_list \
+                                       if streamflow_job[1] in run_directory_list]
+
+        if PREPARE_MODE in (1, 2) and streamflow_job_list:
+            stream_info_file_list = [streamflow_job[2] for streamflow_job in streamflow_job_list]
+            if PREPARE_MODE == 1:
+                #read the ECMWF forecast once for all of the sub-basins
+                streamflow_lookup_list = get_ecmwf_streamflow_lookup_list(stream_info_file_list,
+                                                                          rapid_output_directory,
+                                                                          pool=pool_main,
+                                                                          max_memory_bytes=rapid_output_max_memory_bytes)
+            else:
+                #read the return period file once for all of the sub-basins
+                streamflow_lookup_list = get_return_period_streamflow_lookup_list(stream_info_file_list,
+                                                                                  return_period_file,
+                                                                                  return_period)
+            streamflow_job_list = [streamflow_job[:15] + (streamflow_lookup,) + streamflow_job[16:] \
+                                   for streamflow_job, streamflow_lookup in zip(streamflow_job_list, streamflow_lookup_list)]
+
+        #run each sub-basin as soon as its streamflow is prepared
+        pipeline = None
+        job_ledger = None
+        run_job_memory_history = {}
+        streamflow_job_memory_history = {}
+        if job_ledger_file and (mode == "multiprocess" or PREPARE_MODE > 0):
+            job_ledger = JobLedger(job_ledger_file)
+            if job_runtime_history is None:
+                job_runtime_history = job_ledger.get_job_runtime_history("AutoRoute simulation")
+            run_job_memory_history = job_ledger.get_job_memory_history("AutoRoute simulation")
+            streamflow_job_memory_history = job_ledger.get_job_memory_history("Streamflow preparation")
+        if pool_main is not None:
+            pipeline = MultiprocessPipeline(pool_main, num_cpus, job_memory_budget, job_ledger,
+                                            job_checkpoint, job_budget)
+            run_job_list = []
+            if mode == "multiprocess" and executor == "multiprocess":
+                run_job_list = autoroute_job_info['multiprocess_job_list']
+            #size of the sub-basins for the job order, memory estimates and ledger
+            job_size_dict = {}
+            if job_order != "directory" or job_memory_budget > 0 or job_ledger is not None:
+                for subbasin_directory in [run_job[2] for run_job in run_job_list] + \
+                                          [streamflow_job[1] for streamflow_job in streamflow_job_list]:
+                    if subbasin_directory not in job_size_dict:
+                        job_size_dict[subbasin_directory] = get_autoroute_job_size(subbasin_directory)
+            #order the simulations and the sub-basins to prepare by cost
+            run_job_cost_list = [0] * len(run_job_list)
+            if job_order != "directory":
+                run_job_cost_list = get_job_cost_list([run_job[7] for run_job in run_job_list],
+                                                      [estimate_autoroute_job_cost(run_job[2],
+                                                                                   job_size=job_size_dict[run_job[2]]) \
+                                                       for run_job in run_job_list],
+                                                      job_runtime_history)
+            subbasin_cost_dict = {}
+            for run_job, run_job_cost in zip(run_job_list, run_job_cost_list):
+                subbasin_cost_dict[run_job[2]] = subbasin_cost_dict.get(run_job[2], 0) + run_job_cost
+            streamflow_job_list = [streamflow_job_list[job_index] for job_index in \
+                                   get_job_order([subbasin_cost_dict.get(streamflow_job[1], 0) \
+                                                  for streamflow_job in streamflow_job_list],
+                                                 job_order)]
+
+            run_job_lists = {}
+            for job_index in get_job_order(run_job_cost_list, job_order):
+                run_job = run_job_list[job_index]
+                run_job_memory = 0
+                if job_memory_budget > 0:
+                    #use the measured memory of previous runs if available
+                    run_job_memory = run_job_memory_history.get(run_job[7],
+                                                                estimate_autoroute_job_memory(run_job[2],
+                                                                                              job_size=job_size_dict[run_job[2]]))
+                run_job_info = None
+                if job_ledger is not None or job_checkpoint is not None:
+                    run_job_info = {
+                                    'job_name': run_job[7],
+                                    'input_directory': run_job[2],
+                                    'num_dem_cells': job_size_dict[run_job[2]][0],
+                                    'num_stream_cells': job_size_dict[run_job[2]][1],
+                                    'estimated_memory': run_job_memory,
+                                    'output_file_list': get_run_job_output_file_list(run_job),
+                                    'stream_info_file': run_job[9],
+                                    'scenario_name': run_job[10],
+                                   }
+                run_job_lists.setdefault(run_job[2], []).append(("AutoRoute simulation",
+                                                                 run_autoroute_multiprocess_worker,
+                                                                 run_job,
+                                                                 (),
+                                                                 run_job_memory,
+                                                                 run_job_info))
+            for streamflow_job in streamflow_job_list:
+                streamflow_job_memory = 0
+                if job_memory_budget > 0:
+                    streamflow_job_memory = streamflow_job_memory_history.get(streamflow_job[12],
+                                                                              estimate_streamflow_job_memory(streamflow_job[1],
+                                                                                                             job_size=job_size_dict[streamflow_job[1]]))
+                streamflow_job_info = None
+                if job_ledger is not None or job_checkpoint is not None:
+                    streamflow_job_info = {
+                                           'job_name': streamflow_job[12],
+                                           'input_directory': streamflow_job[1],
+                                           'num_dem_cells': job_size_dict[streamflow_job[1]][0],
+                                           'num_stream_cells': job_size_dict[streamflow_job[1]][1],
+                                           'estimated_memory': streamflow_job_memory,
+                                           'output_file_list': [streamflow_job[2]],
+                                           'prepare_mode': streamflow_job[0],
+                                           'return_period': streamflow_job[5],
+                                           'rapid_output_file': streamflow_job[6],
+                                          }
+                pipeline.submit("Streamflow preparation",
+                                prepare_autoroute_streamflow_multiprocess_worker,
+                                streamflow_job,
+                                run_job_lists.pop(streamflow_job[1], []),
+                                streamflow_job_memory,
+                                streamflow_job_info)
+            for job_index in get_job_order(run_job_cost_list, job_order):
+                if run_job_list[job_index][2] in run_job_lists:
+                    for run_job in run_job_lists.pop(run_job_list[job_index][2]):
+                        pipeline.submit(*run_job)
+
+        print("Running AutoRoute simulations ...")
+        #submit jobs to run
+        if mode == "multiprocess" and executor == "async":
+            autoroute_job_info['multiprocess_worker_list'] = _get_async_run_outputs(pipeline, pool_main,
+                                                                                    autoroute_job_info['multiprocess_job_list'],
+                                                                                    streamflow_job_list,
+                                                                                    num_cpus, job_checkpoint, job_ledger,
+                                                                                    completed_run_output_list)
+        elif mode == "multiprocess":
+            autoroute_job_info['multiprocess_worker_list'] = _get_pipeline_run_outputs(pipeline, pool_main, job_ledger,
+                                                                                       completed_run_output_list)
         else:
-            for htcondor_job_index, htcondor_job in enumerate(autoroute_job_info['htcondor_job_list']):
-                htcondor_job.wait()
-                print("JOB FINISHED: {0}".format(autoroute_job_info['htcondor_job_info'][htcondor_job_index]['autoroute_job_name']))
-    
-        print("Time to complete entire AutoRoute process: {0}".format(datetime.utcnow()-time_start_all))
-    else:       
-        return autoroute_job_info
+            if pipeline is not None:
+                #prepare streamflow before submitting
+                for run_output in _get_pipeline_run_outputs(pipeline, pool_main, job_ledger):
+                    pass
+            for htcondor_job in autoroute_job_info['htcondor_job_list']:
+                htcondor_job.submit()
 
+        if wait_for_all_processes_to_finish:
+            #wait for all of the jobs to complete
+            if mode == "multiprocess":
+                for multi_job_output in autoroute_job_info['multiprocess_worker_list']:
+                    print("JOB FINISHED: {0}".format(multi_job_output[3]))
+            else:
+                for htcondor_job_index, htcondor_job in enumerate(autoroute_job_info['htcondor_job_list']):
+                    htcondor_job.wait()
+                    print("JOB FINISHED: {0}".format(autoroute_job_info['htcondor_job_info'][htcondor_job_index]['autoroute_job_name']))
+    
+            print("Time to complete entire AutoRoute process: {0}".format(datetime.utcnow()-time_start_all))
+            if prometheus_textfile:
+                write_prometheus_textfile(instrumentation_events_file, prometheus_textfile)
+        else:
+            if previous_events_file is not None and mode == "multiprocess":
+                #the simulations are instrumented until their outputs are consumed
+                autoroute_job_info['multiprocess_worker_list'] = \
+                    _restore_instrumentation_when_done(autoroute_job_info['multiprocess_worker_list'],
+                                                       previous_events_file)
+                previous_events_file = None
+            return autoroute_job_info
+    finally:
+        if previous_events_file is not None:
+            restore_instrumentation(previous_events_file)
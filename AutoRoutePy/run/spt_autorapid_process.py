@@ -7,8 +7,8 @@
 ##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
 ##  License: BSD-3 Clause
 
-from glob import glob
 import os
+import threading
 GEOSERVER_ENABLED = False
 try:
     from geoserver.catalog import FailedRequestError as geo_cat_FailedRequestError
@@ -26,6 +26,9 @@ from ..utilities import (case_insensitive_file_search,
 #package imports
 from .run_multiprocess import run_autoroute_multiprocess
 from ..post.post_process import get_shapefile_layergroup_bounds, rename_shapefiles
+from ..post.publish import ShapefilePublisher
+from ..manifest import read_output_manifest
+from ..scheduling import JobBudget, get_job_memory_budget
 
 #----------------------------------------------------------------------------------------
 # MAIN PROCESS
@@ -40,12 +43,21 @@ def run_spt_autorapid_process(autoroute_executable_location, #location of AutoRo
                               geoserver_username='',
                               geoserver_password='',
                               app_instance_id='',
-                              num_cpus=-17
+                              num_cpus=-17,
+                              num_upload_threads=4,
+                              upload_queue_size=16,
+                              max_upload_retries=3,
                               ):
     """
     This it the main AutoRoute-RAPID process for 
     generating historical flood maps and uploading to geoserver
     for the Streamflow Prediction Tool (SPT)
+
+    The shapefiles are uploaded by num_upload_threads threads as the
+    jobs of any watershed finish (at most upload_queue_size wait to be
+    uploaded and failed uploads are retried max_upload_retries times).
+    The layer group of a watershed and return period is created once
+    all of its shapefiles are uploaded.
     """
     valid_return_period_list = ['max_flow', 'return_period_20', 'return_period_10', 'return_period_2']
 
@@ -59,46 +71,42 @@ def run_spt_autorapid_process(autoroute_executable_location, #location of AutoRo
     autoroute_output_folder = os.path.join(autoroute_io_files_location, "output")
     autoroute_input_directories = get_valid_watershed_list(autoroute_input_folder)
 
-    for return_period in return_period_list:
-        print("Running AutoRoute process for:", return_period)
-        #run autorapid for each watershed
-        autoroute_watershed_jobs = {}
-        for autoroute_input_directory in autoroute_input_directories:
-            watershed, subbasin = get_watershed_subbasin_from_folder(autoroute_input_directory)
-            
-            #RAPID file paths
-            master_watershed_rapid_input_directory = os.path.join(rapid_io_files_location, "input", autoroute_input_directory)
-                                                                   
-            if not os.path.exists(master_watershed_rapid_input_directory):
-                print("AutoRoute watershed", autoroute_input_directory, "not in RAPID IO folder. Skipping ...")
-                continue
-            try:
-                return_period_file=case_insensitive_file_search(master_watershed_rapid_input_directory, r'return_period.*?\.nc')
-            except Exception:
-                print("AutoRoute watershed", autoroute_input_directory, "missing return period file. Skipping ...")
-                continue
-            
-            #setup the output location
-            master_watershed_autoroute_output_directory = os.path.join(autoroute_output_folder,
-                                                                       autoroute_input_directory, 
-                                                                       return_period)
-            try:
-                os.makedirs(master_watershed_autoroute_output_directory)
-            except OSError:
-                pass
-            #loop through sub-directories
-            autoroute_watershed_directory_path = os.path.join(autoroute_input_folder, autoroute_input_directory)        
-            autoroute_watershed_jobs[autoroute_input_directory] = run_autoroute_multiprocess(autoroute_executable_location, 
-                                                                                             autoroute_input_directory=autoroute_watershed_directory_path, 
-                                                                                             autoroute_output_directory=master_watershed_autoroute_output_directory,
-                                                                                             log_directory=log_directory,
-                                                                                             return_period=return_period, 
-                                                                                             return_period_file=return_period_file, 
-                                                                                             mode="multiprocess", 
-                                                                                             generate_floodmap_shapefile=generate_floodmap_shapefile,
-                                                                                             wait_for_all_processes_to_finish=False,
-                                                                                             num_cpus=num_cpus
-                                                                                             )
+    print("Running AutoRoute process for:", ", ".join(return_period_list))
+    #the watersheds run at the same time, so they share the cpus and memory
+    job_budget = JobBudget(*get_job_memory_budget(num_cpus))
+    #run autorapid for each watershed with all return periods at once
+    autoroute_watershed_jobs = {}
+    for autoroute_input_directory in autoroute_input_directories:
+        watershed, subbasin = get_watershed_subbasin_from_folder(autoroute_input_directory)
+        
+        #RAPID file paths
+        master_watershed_rapid_input_directory = os.path.join(rapid_io_files_location, "input", autoroute_input_directory)
+                                                               
+        if not os.path.exists(master_watershed_rapid_input_directory):
+            print("AutoRoute watershed", autoroute_input_directory, "not in RAPID IO folder. Skipping ...")
+            continue
+        try:
+            return_period_file=case_insensitive_file_search(master_watershed_rapid_input_directory, r'return_period.*?\.nc')
+        except Exception:
+            print("AutoRoute watershed", autoroute_input_directory, "missing return period file. Skipping ...")
+            continue
+        
+        #setup the output location (each return period is a sub-folder)
+        master_watershed_autoroute_output_directory = os.path.join(autoroute_output_folder,
+                                                                   autoroute_input_directory)
+        #loop through sub-directories
+        autoroute_watershed_directory_path = os.path.join(autoroute_input_folder, autoroute_input_directory)        
+        autoroute_watershed_jobs[autoroute_input_directory] = run_autoroute_multiprocess(autoroute_executable_location=autoroute_executable_location, 
+                                                                                         autoroute_input_directory=autoroute_watershed_directory_path, 
+                                                                                         autoroute_output_directory=master_watershed_autoroute_output_directory,
+                                                                                         log_directory=log_directory,
+                                                                                         return_period=return_period_list, 
+                                                                                         return_period_file=return_period_file, 
+                                                                                         mode="multiprocess", 
+                                                                                         generate_flood_map_shapefile=generate_floodmap_shapefile,
+                                                                                         wait_for_all_processes_to_finish=False,
+                                                                                         job_budget=job_budget
+                                                                                         )
     geoserver_manager = None
     if GEOSERVER_ENABLED and geoserver_url and geoserver_username \
         and geoserver_password and app_instance_id and generate_floodmap_shapefile:
@@ -115,95 +123,165 @@ def run_spt_autorapid_process(autoroute_executable_location, #location of AutoRo
     else:
         print("GeoServer parameters incomplete. Skipping upload ...")
         
-    #wait for jobs to finish by watershed
-    for autoroute_watershed_directory, autoroute_watershed_job in autoroute_watershed_jobs.iteritems():
-        master_watershed_autoroute_output_directory = os.path.join(autoroute_output_folder,
-                                                                   autoroute_watershed_directory, 
-                                                                   return_period)
-        #time stamped layer name
-        geoserver_layer_group_name = "%s-floodmap-%s" % (autoroute_watershed_directory, 
-                                                         return_period)
-        geoserver_resource_list = []
-        upload_shapefile_list = []
-        for job_index, job_output in enumerate(autoroute_watershed_job['multiprocess_worker_list']):
-            #upload to GeoServer
-            if geoserver_manager and job_output[2]:
-                #time stamped layer name
-                geoserver_resource_name = "%s-%s" % (geoserver_layer_group_name,
-                                                     job_index)
-                #upload each shapefile
-                upload_shapefile = os.path.join(master_watershed_autoroute_output_directory, 
-                                                "%s%s" % (geoserver_resource_name, ".shp"))
-                #rename files
-                rename_shapefiles(master_watershed_autoroute_output_directory, 
-                                  os.path.splitext(upload_shapefile)[0], 
-                                  os.path.splitext(os.path.basename(job_output[2]))[0])
-                                  
-                if os.path.exists(upload_shapefile):
-                    upload_shapefile_list.append(upload_shapefile)
-                    print("Uploading", upload_shapefile, "to GeoServer as", geoserver_resource_name)
-                    shapefile_basename = os.path.splitext(upload_shapefile)[0]
-                    #remove past layer if exists
-                    #geoserver_manager.purge_remove_geoserver_layer(geoserver_manager.get_layer_name(geoserver_resource_name))
-                    
-                    #upload updated layer
-                    shapefile_list = glob("%s*" % shapefile_basename)
-                    #Note: Added try, except statement because the request search fails when the app
-                    #deletes the layer after request is made (happens hourly), so the process may throw
-                    #an exception even though it was successful.
-                    """
-                    ...
-                      File "/home/alan/work/scripts/spt_ecmwf_autorapid_process/spt_dataset_manager/dataset_manager.py", line 798, in upload_shapefile
-                        overwrite=True)
-                      File "/usr/lib/tethys/local/lib/python2.7/site-packages/tethys_dataset_services/engines/geoserver_engine.py", line 1288, in create_shapefile_resource
-                        new_resource = catalog.get_resource(name=name, workspace=workspace)
-                      File "/usr/lib/tethys/local/lib/python2.7/site-packages/geoserver/catalog.py", line 616, in get_resource
-                        resource = self.get_resource(name, store)
-                      File "/usr/lib/tethys/local/lib/python2.7/site-packages/geoserver/catalog.py", line 606, in get_resource
-                        candidates = [s for s in self.get_resources(store) if s.name == name]
-                      File "/usr/lib/tethys/local/lib/python2.7/site-packages/geoserver/catalog.py", line 645, in get_resources
-                        return store.get_resources()
-                      File "/usr/lib/tethys/local/lib/python2.7/site-packages/geoserver/store.py", line 58, in get_resources
-                        xml = self.catalog.get_xml(res_url)
-                      File "/usr/lib/tethys/local/lib/python2.7/site-packages/geoserver/catalog.py", line 188, in get_xml
-                        raise FailedRequestError("Tried to make a GET request to %s but got a %d status code: \n%s" % (rest_url, response.status, content))
-                    geoserver.catalog.FailedRequestError: ...
-                    """
-                    try:
-                        geoserver_manager.upload_shapefile(geoserver_resource_name, 
-                                                           shapefile_list)
-                    except geo_cat_FailedRequestError as ex:
-                        print(ex)
-                        print("Most likely OK, but always wise to check ...")
-                        pass
-                                                       
-                    geoserver_resource_list.append(geoserver_manager.get_layer_name(geoserver_resource_name))
-                    #TODO: Upload to CKAN for history of predicted floodmaps?
-                else:
-                    print(upload_shapefile, "not found. Skipping upload to GeoServer ...")
-        
-        if geoserver_manager and geoserver_resource_list:
+    shapefile_publisher = None
+    #shapefile information from the output manifests by resource name
+    upload_shapefile_infos = {}
+    if geoserver_manager:
+        def upload_shapefile(geoserver_resource_name, shapefile_list):
+            """
+            Uploads the shapefile to GeoServer
+            """
+            #Note: Added try, except statement because the request search fails when the app
+            #deletes the layer after request is made (happens hourly), so the process may throw
+            #an exception even though it was successful.
+            """
+            ...
+              File "/home/alan/work/scripts/spt_ecmwf_autorapid_process/spt_dataset_manager/dataset_manager.py", line 798, in upload_shapefile
+                overwrite=True)
+              File "/usr/lib/tethys/local/lib/python2.7/site-packages/tethys_dataset_services/engines/geoserver_engine.py", line 1288, in create_shapefile_resource
+                new_resource = catalog.get_resource(name=name, workspace=workspace)
+              File "/usr/lib/tethys/local/lib/python2.7/site-packages/geoserver/catalog.py", line 616, in get_resource
+                resource = self.get_resource(name, store)
+              File "/usr/lib/tethys/local/lib/python2.7/site-packages/geoserver/catalog.py", line 606, in get_resource
+                candidates = [s for s in self.get_resources(store) if s.name == name]
+              File "/usr/lib/tethys/local/lib/python2.7/site-packages/geoserver/catalog.py", line 645, in get_resources
+                return store.get_resources()
+              File "/usr/lib/tethys/local/lib/python2.7/site-packages/geoserver/store.py", line 58, in get_resources
+                xml = self.catalog.get_xml(res_url)
+              File "/usr/lib/tethys/local/lib/python2.7/site-packages/geoserver/catalog.py", line 188, in get_xml
+                raise FailedRequestError("Tried to make a GET request to %s but got a %d status code: \n%s" % (rest_url, response.status, content))
+            geoserver.catalog.FailedRequestError: ...
+            """
+            try:
+                geoserver_manager.upload_shapefile(geoserver_resource_name, 
+                                                   shapefile_list)
+            except geo_cat_FailedRequestError as ex:
+                print(ex)
+                print("Most likely OK, but always wise to check ...")
+                pass
+            #TODO: Upload to CKAN for history of predicted floodmaps?
+
+        def create_layer_group(geoserver_layer_group_name, upload_list):
+            """
+            Creates the layer group once all of the shapefiles of
+            the watershed and return period are uploaded
+            """
+            if not upload_list:
+                return
             print("Creating Layer Group:", geoserver_layer_group_name)
+            geoserver_resource_list = [geoserver_manager.get_layer_name(geoserver_resource_name) \
+                                       for geoserver_resource_name, upload_shapefile in upload_list]
+            #kept until the layer group is created in case it is retried
+            shapefile_info_list = [upload_shapefile_infos[geoserver_resource_name] \
+                                   for geoserver_resource_name, upload_shapefile in upload_list]
             style_list = ['green' for i in range(len(geoserver_resource_list))]
-            bounds = get_shapefile_layergroup_bounds(upload_shapefile_list)
+            bounds = get_shapefile_layergroup_bounds(shapefile_info_list=shapefile_info_list)
             geoserver_manager.dataset_engine.create_layer_group(layer_group_id=geoserver_manager.get_layer_name(geoserver_layer_group_name), 
                                                                 layers=tuple(geoserver_resource_list), 
                                                                 styles=tuple(style_list),
                                                                 bounds=tuple(bounds))
+            for geoserver_resource_name, upload_shapefile in upload_list:
+                upload_shapefile_infos.pop(geoserver_resource_name, None)
             #remove local shapefile when done
-            for upload_shapefile in upload_shapefile_list:
-                shapefile_parts = glob("%s*" % os.path.splitext(upload_shapefile)[0])
-                for shapefile_part in shapefile_parts:
+            for shapefile_info in shapefile_info_list:
+                for shapefile_part in shapefile_info['parts']:
                     try:
                         os.remove(shapefile_part)
                     except OSError:
                         pass
-                    
+                
             #remove local directories when done
             try:
-                os.rmdir(master_watershed_autoroute_output_directory)
+                os.rmdir(os.path.dirname(shapefile_info_list[0]['path']))
             except OSError:
                 pass
+
+        shapefile_publisher = ShapefilePublisher(upload_shapefile,
+                                                 create_layer_group,
+                                                 num_threads=num_upload_threads,
+                                                 max_queue_size=upload_queue_size,
+                                                 max_retries=max_upload_retries)
+
+    def publish_watershed_outputs(autoroute_watershed_directory, autoroute_watershed_job):
+        """
+        Queues the shapefiles of the watershed for upload as its jobs finish
+        """
+        return_period_job_index = dict((return_period, 0) for return_period in return_period_list)
+        for job_output in autoroute_watershed_job['multiprocess_worker_list']:
+            print("JOB FINISHED: {0}".format(job_output[3]))
+            return_period = job_output[5]
+            job_index = return_period_job_index[return_period]
+            return_period_job_index[return_period] += 1
+            #upload to GeoServer
+            if shapefile_publisher and job_output[4]:
+                #the shapefile parts and extent are in the output manifest
+                shapefile_info = read_output_manifest(job_output[6])['outputs'].get('shapefile')
+                if shapefile_info is None:
+                    print(job_output[4], "not found. Skipping upload to GeoServer ...")
+                    continue
+                master_watershed_autoroute_output_directory = os.path.join(autoroute_output_folder,
+                                                                           autoroute_watershed_directory, 
+                                                                           return_period)
+                #time stamped layer name
+                geoserver_layer_group_name = "%s-floodmap-%s" % (autoroute_watershed_directory, 
+                                                                 return_period)
+                geoserver_resource_name = "%s-%s" % (geoserver_layer_group_name,
+                                                     job_index)
+                #upload each shapefile
+                upload_shapefile = os.path.join(master_watershed_autoroute_output_directory, 
+                                                "%s%s" % (geoserver_resource_name, ".shp"))
+                #rename files listed in the output manifest
+                shapefile_info['parts'] = rename_shapefiles(master_watershed_autoroute_output_directory, 
+                                                            os.path.splitext(upload_shapefile)[0], 
+                                                            os.path.splitext(os.path.basename(job_output[4]))[0],
+                                                            shapefile_parts=shapefile_info['parts'])
+                shapefile_info['path'] = upload_shapefile
+                upload_shapefile_infos[geoserver_resource_name] = shapefile_info
+                              
+                print("Uploading", upload_shapefile, "to GeoServer as", geoserver_resource_name)
+                #remove past layer if exists
+                #geoserver_manager.purge_remove_geoserver_layer(geoserver_manager.get_layer_name(geoserver_resource_name))
+            
+                #upload updated layer (blocks while the upload queue is full)
+                shapefile_publisher.submit(geoserver_layer_group_name,
+                                           geoserver_resource_name,
+                                           upload_shapefile,
+                                           shapefile_info['parts'])
+
+        #the layer groups are created when their last upload is done
+        if shapefile_publisher:
+            for return_period in return_period_list:
+                shapefile_publisher.finish_group("%s-floodmap-%s" % (autoroute_watershed_directory, 
+                                                                     return_period))
+
+    def publish_watershed_outputs_thread(autoroute_watershed_directory, autoroute_watershed_job):
+        """
+        Keeps the error of the watershed to raise it in the main thread
+        """
+        try:
+            publish_watershed_outputs(autoroute_watershed_directory, autoroute_watershed_job)
+        except Exception as ex:
+            print("ERROR: {0} failed: {1}".format(autoroute_watershed_directory, ex))
+            watershed_error_list.append((autoroute_watershed_directory, ex))
+
+    #consume the finished jobs of all watersheds as they arrive
+    watershed_error_list = []
+    watershed_thread_list = []
+    for autoroute_watershed_directory, autoroute_watershed_job in autoroute_watershed_jobs.items():
+        watershed_thread = threading.Thread(target=publish_watershed_outputs_thread,
+                                            args=(autoroute_watershed_directory, autoroute_watershed_job))
+        watershed_thread.daemon = True
+        watershed_thread.start()
+        watershed_thread_list.append(watershed_thread)
+    for watershed_thread in watershed_thread_list:
+        watershed_thread.join()
+
+    if shapefile_publisher:
+        shapefile_publisher.close()
+
+    if watershed_error_list:
+        raise watershed_error_list[0][1]
+
 """
 ##EXAMPLE
 if __name__ == "__main__":
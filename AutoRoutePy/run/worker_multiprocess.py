@@ -7,12 +7,289 @@
 ##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
 ##  License BSD 3-Clause
 
+import hashlib
+import json
 import os
+from shutil import copy
 import sys
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
 
 #local imports
 from ..autoroute import AutoRoute 
-from ..utilities import case_insensitive_file_search
+from ..manifest import write_output_manifest
+from ..prepare.stream_info import sync_stream_info_text_file
+from ..utilities import (VALID_RASTER_EXTENSIONS,
+                         case_insensitive_file_search,
+                         get_file_fingerprint,
+                         write_json_file_atomic)
+
+#------------------------------------------------------------------------------
+#FINGERPRINT FUNCTIONS
+#------------------------------------------------------------------------------
+def get_autoroute_input_files(input_file_list):
+    """
+    Returns the files to fingerprint for the inputs (all of the files
+    of an ESRI grid and the executable found on the path)
+    """
+    fingerprint_file_list = []
+    for input_file in input_file_list:
+        if not input_file:
+            continue
+        if not os.path.exists(input_file):
+            input_file = which(input_file) or input_file
+        if os.path.basename(input_file).lower() == "hdr.adf":
+            grid_directory = os.path.dirname(input_file)
+            fingerprint_file_list += [os.path.join(grid_directory, grid_file) \
+                                      for grid_file in sorted(os.listdir(grid_directory))]
+        else:
+            fingerprint_file_list.append(input_file)
+    return fingerprint_file_list
+
+def get_autoroute_fingerprint(input_file_list, previous_file_fingerprints=None):
+    """
+    Returns the combined hash of the input files and the
+    fingerprint of each file (size, modification time, hash)
+    """
+    previous_file_fingerprints = previous_file_fingerprints or {}
+    file_fingerprints = {}
+    autoroute_hash = hashlib.sha256()
+    for input_file in get_autoroute_input_files(input_file_list):
+        input_file = os.path.abspath(input_file)
+        autoroute_hash.update(input_file.encode('utf-8'))
+        if os.path.isfile(input_file):
+            file_fingerprints[input_file] = get_file_fingerprint(input_file,
+                                                                 previous_file_fingerprints.get(input_file))
+            autoroute_hash.update(file_fingerprints[input_file][2].encode('utf-8'))
+    return autoroute_hash.hexdigest(), file_fingerprints
+
+def get_output_file_stats(output_file_list):
+    """
+    Returns the size and modification time of each output file
+    (None if an output file is missing)
+    """
+    output_file_stats = {}
+    for output_file in output_file_list:
+        if not os.path.exists(output_file):
+            return None
+        output_file_stat = os.stat(output_file)
+        output_file_stats[os.path.abspath(output_file)] = [output_file_stat.st_size,
+                                                           output_file_stat.st_mtime]
+    return output_file_stats
+
+def read_fingerprint_file(fingerprint_file):
+    """
+    Reads the fingerprint of the last run ({} if not found)
+    """
+    try:
+        with open(fingerprint_file) as fingerprint_handle:
+            return json.load(fingerprint_handle)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def write_fingerprint_file(fingerprint_file, fingerprint, file_fingerprints, output_file_list):
+    """
+    Writes the fingerprint of the inputs and the outputs of the run
+    """
+    output_file_stats = get_output_file_stats(output_file_list)
+    if output_file_stats is None:
+        #do not reuse a run with missing outputs
+        return
+    write_json_file_atomic(fingerprint_file,
+                           {
+                            'fingerprint': fingerprint,
+                            'input_files': file_fingerprints,
+                            'output_files': output_file_stats,
+                           })
+
+#------------------------------------------------------------------------------
+#AUTOROUTE RUN CLASS
+#------------------------------------------------------------------------------
+class AutoRouteRun(object):
+    """
+    One AutoRoute simulation of an input directory. Writes the input file
+    of the simulation (prepare), which can be done in a different process
+    than the one running the executable, and cleans up after it (finish).
+    """
+    def __init__(self,
+                 autoroute_executable_location,
+                 autoroute_manager,
+                 autoroute_input_path,
+                 out_flood_map_raster_name,
+                 out_flood_depth_raster_name,
+                 out_shapefile_name="",
+                 delete_flood_raster=False,
+                 stream_info_file="",
+                 incremental=False,
+                 output_manifest_file=""):
+        if not autoroute_manager:
+            autoroute_manager = AutoRoute(autoroute_executable_location)
+        self.autoroute_manager = autoroute_manager
+        self.autoroute_executable_location = autoroute_executable_location
+        self.autoroute_input_path = autoroute_input_path
+        self.out_flood_map_raster_name = out_flood_map_raster_name
+        self.out_flood_depth_raster_name = out_flood_depth_raster_name
+        self.out_shapefile_name = out_shapefile_name
+        self.delete_flood_raster = delete_flood_raster
+        self.stream_info_file = stream_info_file
+        self.incremental = incremental
+        self.output_manifest_file = output_manifest_file
+        self._stream_info_file_path = stream_info_file
+
+        #autoroute input file
+        autoroute_input_file_name = "AUTOROUTE_INPUT_FILE.txt"
+        if stream_info_file:
+            #scenarios running in the same directory need their own input file
+            autoroute_input_file_name = "AUTOROUTE_INPUT_FILE_{0}.txt".format(os.path.splitext(os.path.basename(stream_info_file))[0])
+        self.autoroute_input_file = os.path.join(autoroute_input_path, autoroute_input_file_name)
+        self.fingerprint_file = "{0}_FINGERPRINT.json".format(os.path.splitext(self.autoroute_input_file)[0])
+
+        self.output_file_list = [output_file for output_file in (out_flood_map_raster_name,
+                                                                 out_flood_depth_raster_name,
+                                                                 out_shapefile_name) if output_file]
+        if delete_flood_raster:
+            self.output_file_list.remove(out_flood_map_raster_name)
+        self._fingerprint = None
+        self._file_fingerprints = None
+
+    def prepare(self):
+        """
+        Writes the AutoRoute input file with the inputs found in the
+        directory. Returns False if the run can be skipped because
+        the inputs are the same as the last run (incremental).
+        """
+        autoroute_input_path = self.autoroute_input_path
+        valid_raster_extensions = VALID_RASTER_EXTENSIONS
+        
+        #get the raster for elevation    
+        try:
+            elevation_raster = case_insensitive_file_search(autoroute_input_path, r'elevation\.(?:{})'.format(valid_raster_extensions))
+        except IndexError:
+            try:
+                elevation_raster = case_insensitive_file_search(os.path.join(autoroute_input_path, 'elevation'), r'hdr\.adf')
+            except IndexError:
+                print("Elevation raster not found. Skipping entire process ...")
+                raise
+            pass
+
+        #get the manning n raster
+        try:
+            manning_n_raster = case_insensitive_file_search(autoroute_input_path, r'manning_n\.(?:{})'.format(valid_raster_extensions))
+        except IndexError:
+            manning_n_raster = ""
+            print("Manning n raster not found. Ignoring this file ...")
+            pass
+
+        try:
+            autoroute_input_file = case_insensitive_file_search(autoroute_input_path, r'AUTOROUTE_INPUT_FILE\.TXT')
+            if self.stream_info_file:
+                copy(autoroute_input_file, self.autoroute_input_file)
+                autoroute_input_file = self.autoroute_input_file
+            self.autoroute_manager.update_input_file(autoroute_input_file)
+        except IndexError:
+            print("AUTOROUTE_INPUT_FILE.txt not found. Ignoring this file ...")
+            pass
+
+        #write stream info file if prepare stored streamflow in the cache only
+        stream_info_file = self.stream_info_file
+        if not stream_info_file:
+            stream_info_file = case_insensitive_file_search(autoroute_input_path, r'stream_info\.txt')
+        sync_stream_info_text_file(stream_info_file)
+        self._stream_info_file_path = stream_info_file
+            
+        self.autoroute_manager.update_parameters(dem_raster_file_path=elevation_raster,
+                                                 stream_info_file_path=stream_info_file,
+                                                 out_flood_map_raster_path=self.out_flood_map_raster_name,
+                                                 out_flood_depth_raster_path=self.out_flood_depth_raster_name,
+                                                 out_flood_map_shapefile_path=self.out_shapefile_name,
+                                                 manning_n_raster_file_path=manning_n_raster
+                                                 )
+        self.autoroute_manager.write_input_file(self.autoroute_input_file)
+
+        if self.incremental:
+            previous_fingerprint = read_fingerprint_file(self.fingerprint_file)
+            self._fingerprint, self._file_fingerprints = get_autoroute_fingerprint([self.autoroute_input_file,
+                                                                                    elevation_raster,
+                                                                                    manning_n_raster,
+                                                                                    stream_info_file,
+                                                                                    self.autoroute_executable_location],
+                                                                                   previous_fingerprint.get('input_files'))
+            if previous_fingerprint.get('fingerprint') == self._fingerprint \
+                and previous_fingerprint.get('output_files') == get_output_file_stats(self.output_file_list):
+                print("Inputs unchanged since last run. Reusing existing outputs ...")
+                if self.output_manifest_file and not os.path.exists(self.output_manifest_file):
+                    self.write_output_manifest()
+                return False
+            #remove the old fingerprint in case the run fails
+            if previous_fingerprint:
+                os.remove(self.fingerprint_file)
+        return True
+
+    def get_command_list(self):
+        """
+        Returns the command to run the AutoRoute executable
+        """
+        return [self.autoroute_executable_location, self.autoroute_input_file]
+
+    def write_output_manifest(self):
+        """
+        Writes the manifest of the outputs for post-processing
+        """
+        write_output_manifest(self.output_manifest_file,
+                              flood_map_raster="" if self.delete_flood_raster else self.out_flood_map_raster_name,
+                              flood_depth_raster=self.out_flood_depth_raster_name,
+                              shapefile=self.out_shapefile_name,
+                              input_directory=os.path.abspath(self.autoroute_input_path),
+                              stream_info_file=os.path.abspath(self._stream_info_file_path) \
+                                               if self._stream_info_file_path else "")
+
+    def finish(self):
+        """
+        Removes the temporary outputs, writes the output manifest and
+        records the fingerprint of the inputs (incremental) after the
+        executable succeeded
+        """
+        if self.delete_flood_raster:
+            try:
+                os.remove(self.out_flood_map_raster_name)
+                os.remove("%s.prj" % os.path.splitext(self.out_flood_map_raster_name)[0])
+            except OSError:
+                pass
+
+        if self.output_manifest_file:
+            self.write_output_manifest()
+
+        if self.incremental:
+            write_fingerprint_file(self.fingerprint_file, self._fingerprint,
+                                   self._file_fingerprints, self.output_file_list)
+
+#------------------------------------------------------------------------------
+#RUN JOB FUNCTIONS
+#------------------------------------------------------------------------------
+#run_autoroute_multiprocess job: (executable, AutoRoute manager, input directory,
+#flood map raster, flood depth raster, shapefile, delete flood map raster,
+#job name, log directory, stream info file, scenario name, incremental, timeout,
+#output manifest file)
+def get_run_job_output(run_job):
+    """
+    Returns the output of the AutoRoute simulation job (input directory,
+    flood map, flood depth, job name, shapefile, scenario name,
+    output manifest file)
+    """
+    return run_job[2], run_job[3], run_job[4], run_job[7], run_job[5], run_job[10], run_job[13]
+
+def get_run_job_output_file_list(run_job):
+    """
+    Returns the files the AutoRoute simulation job generates
+    """
+    out_flood_map_raster = run_job[3]
+    if run_job[6]:
+        #the flood map is deleted after the shapefile is generated
+        out_flood_map_raster = ""
+    return [output_file for output_file in (out_flood_map_raster, run_job[4], run_job[5]) \
+            if output_file]
 
 #------------------------------------------------------------------------------
 #MAIN PROCESS
@@ -23,64 +300,46 @@ def run_AutoRoute(autoroute_executable_location,
                   out_flood_map_raster_name,
                   out_flood_depth_raster_name,
                   out_shapefile_name="",
-                  delete_flood_raster=False):
+                  delete_flood_raster=False,
+                  stream_info_file="",
+                  incremental=False,
+                  timeout=None,
+                  output_manifest_file=""):
                       
     """
     Run AutoRoute with searching for inputs in directory
+
+    If stream_info_file is not set, stream_info.txt in the
+    input directory is used
+
+    If incremental is True, the run is skipped and the existing outputs
+    are reused when the DEM, manning n raster, stream info file,
+    AutoRoute input file and executable are the same as the last run
+
+    AutoRoute is killed if it runs longer than timeout (seconds)
+
+    If output_manifest_file is set, the paths, extents, projections and
+    feature and pixel counts of the outputs are written to it
     """
     #change working directory for python (this is for the input file produced to
     # prevent overwriting)
     os.chdir(autoroute_input_path)
     
-    if not autoroute_manager:
-        autoroute_manager = AutoRoute(autoroute_executable_location)
+    autoroute_run = AutoRouteRun(autoroute_executable_location,
+                                 autoroute_manager,
+                                 autoroute_input_path,
+                                 out_flood_map_raster_name,
+                                 out_flood_depth_raster_name,
+                                 out_shapefile_name=out_shapefile_name,
+                                 delete_flood_raster=delete_flood_raster,
+                                 stream_info_file=stream_info_file,
+                                 incremental=incremental,
+                                 output_manifest_file=output_manifest_file)
+    if not autoroute_run.prepare():
+        return
 
-    valid_raster_extensions = "asc|bmp|dt2|img|jp2|j2c|j2k|jpeg|jpg2|jpg|png|tif|tiff"
-    
-    #get the raster for elevation    
-    try:
-        elevation_raster = case_insensitive_file_search(autoroute_input_path, r'elevation\.(?:{})'.format(valid_raster_extensions))
-    except IndexError:
-        try:
-            elevation_raster = case_insensitive_file_search(os.path.join(autoroute_input_path, 'elevation'), r'hdr\.adf')
-        except IndexError:
-            print("Elevation raster not found. Skipping entire process ...")
-            raise
-        pass
-
-    #get the manning n raster
-    try:
-        manning_n_raster = case_insensitive_file_search(autoroute_input_path, r'manning_n\.(?:{})'.format(valid_raster_extensions))
-    except IndexError:
-        manning_n_raster = ""
-        print("Manning n raster not found. Ignoring this file ...")
-        pass
-
-    #autoroute input file
-    try:
-        autoroute_input_file = case_insensitive_file_search(autoroute_input_path, r'AUTOROUTE_INPUT_FILE\.TXT')
-        autoroute_manager.update_input_file(autoroute_input_file)
-    except IndexError:
-        print("AUTOROUTE_INPUT_FILE.txt not found. Ignoring this file ...")
-        pass
-
-        
-    autoroute_manager.update_parameters(dem_raster_file_path=elevation_raster,
-                                        stream_info_file_path=case_insensitive_file_search(autoroute_input_path, r'stream_info\.txt'),
-                                        out_flood_map_raster_path=out_flood_map_raster_name,
-                                        out_flood_depth_raster_path=out_flood_depth_raster_name,
-                                        out_flood_map_shapefile_path=out_shapefile_name,
-                                        manning_n_raster_file_path=manning_n_raster
-                                        )
-                         
-    autoroute_manager.run_autoroute()
-
-    if delete_flood_raster:
-        try:
-            os.remove(out_flood_map_raster_name)
-            os.remove("%s.prj" % os.path.splitext(out_flood_map_raster_name)[0])
-        except OSError:
-            pass
+    autoroute_run.autoroute_manager.run_autoroute(autoroute_run.autoroute_input_file, timeout=timeout)
+    autoroute_run.finish()
     
 def run_AutoRoute_HTCondor_directory(autoroute_executable_location,
                                      autoroute_manager,
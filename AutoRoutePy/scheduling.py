@@ -0,0 +1,569 @@
+# -*- coding: utf-8 -*-
+##
+##  scheduling.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+from collections import deque
+from datetime import timedelta
+from glob import glob
+import os
+import sys
+import threading
+from time import time
+import traceback
+try:
+    from queue import Empty, Queue
+except ImportError:
+    from Queue import Empty, Queue
+
+from osgeo import gdal
+try:
+    from psutil import NoSuchProcess, Process
+except ImportError:
+    Process = None
+
+#local imports
+from .utilities import (VALID_RASTER_EXTENSIONS,
+                        case_insensitive_file_search,
+                        get_memory_limit,
+                        get_valid_num_cpus)
+
+#job orders for multiprocessing
+#directory: order of the sub-basin folders
+#largest_first: longest estimated jobs first to shorten the total time
+VALID_JOB_ORDER_LIST = ['directory', 'largest_first']
+
+#relative cost of a stream cell to a DEM cell (AutoRoute samples a
+#cross section of many DEM cells at each stream cell)
+STREAM_CELL_COST = 100
+
+#memory estimate of a job in bytes: a base amount, the rasters
+#(elevation, stream, manning n, flood map and depth) held for each DEM
+#cell and the stream info/cross section data of each stream cell
+JOB_BASE_MEMORY = 200 * 1024**2
+DEM_CELL_MEMORY = 24
+STREAM_CELL_MEMORY = 1024
+#memory estimate of the streamflow preparation for each stream cell
+STREAMFLOW_STREAM_CELL_MEMORY = 256
+#fraction of the memory limit available to jobs by default
+JOB_MEMORY_FRACTION = 0.8
+
+#----------------------------------------------------------------------------------------
+# JOB COST FUNCTIONS
+#----------------------------------------------------------------------------------------
+def get_raster_cell_count(raster_file):
+    """
+    Returns the number of cells in the raster from its metadata
+    (0 if the raster cannot be opened)
+    """
+    raster = gdal.Open(raster_file)
+    if raster is None:
+        return 0
+    return raster.RasterXSize * raster.RasterYSize
+
+def get_file_line_count(file_path, block_size=1024**2):
+    """
+    Returns the number of lines in the file
+    """
+    num_lines = 0
+    with open(file_path, 'rb') as file_handle:
+        file_block = file_handle.read(block_size)
+        while file_block:
+            num_lines += file_block.count(b'\n')
+            file_block = file_handle.read(block_size)
+    return num_lines
+
+def get_elevation_raster(input_directory, dem_extension=""):
+    """
+    Returns the elevation raster in the directory ("" if not found)
+
+    If dem_extension is set, the first raster with that extension is
+    returned (i.e. before the prepare step renames it to elevation)
+    """
+    if dem_extension:
+        dem_file_list = glob(os.path.join(input_directory, '*.{0}'.format(dem_extension)))
+        if dem_file_list:
+            return dem_file_list[0]
+        return ""
+    try:
+        return case_insensitive_file_search(input_directory,
+                                            r'elevation\.(?:{0})$'.format(VALID_RASTER_EXTENSIONS))
+    except (IndexError, OSError):
+        pass
+    try:
+        return case_insensitive_file_search(os.path.join(input_directory, 'elevation'),
+                                            r'hdr\.adf')
+    except (IndexError, OSError):
+        pass
+    return ""
+
+def get_autoroute_job_size(input_directory, dem_extension=""):
+    """
+    Returns the number of DEM cells and the number of stream cells
+    in the stream info file of an AutoRoute job
+    """
+    num_dem_cells = 0
+    elevation_raster = get_elevation_raster(input_directory, dem_extension)
+    if elevation_raster:
+        num_dem_cells = get_raster_cell_count(elevation_raster)
+    num_stream_cells = 0
+    stream_info_file = os.path.join(input_directory, 'stream_info.txt')
+    if os.path.exists(stream_info_file):
+        num_stream_cells = max(0, get_file_line_count(stream_info_file) - 1)
+    return num_dem_cells, num_stream_cells
+
+def estimate_autoroute_job_cost(input_directory, dem_extension="", job_size=None):
+    """
+    Estimates the relative cost of an AutoRoute job from the number of
+    cells in the DEM and the number of stream cells in the stream info file
+    """
+    if job_size is None:
+        job_size = get_autoroute_job_size(input_directory, dem_extension)
+    num_dem_cells, num_stream_cells = job_size
+    return num_dem_cells + STREAM_CELL_COST * num_stream_cells
+
+def estimate_autoroute_job_memory(input_directory, dem_extension="", job_size=None):
+    """
+    Estimates the peak memory in bytes of an AutoRoute job (or the
+    prepare of an AutoRoute job) from the size of the DEM and the
+    number of stream cells
+    """
+    if job_size is None:
+        job_size = get_autoroute_job_size(input_directory, dem_extension)
+    num_dem_cells, num_stream_cells = job_size
+    return JOB_BASE_MEMORY + DEM_CELL_MEMORY * num_dem_cells + \
+           STREAM_CELL_MEMORY * num_stream_cells
+
+def estimate_streamflow_job_memory(input_directory, job_size=None):
+    """
+    Estimates the peak memory in bytes of preparing the streamflow
+    of an AutoRoute job
+    """
+    if job_size is None:
+        job_size = get_autoroute_job_size(input_directory)
+    return JOB_BASE_MEMORY + STREAMFLOW_STREAM_CELL_MEMORY * job_size[1]
+
+def get_job_memory_budget(num_cpus, job_memory_budget=None):
+    """
+    Returns the number of cpus and the memory budget of the jobs in bytes
+
+    If job_memory_budget is None, the budget is a fraction of the memory
+    available to the process. If it is 0, there is no budget and the
+    number of cpus is limited by the recommended memory per cpu instead.
+    """
+    if job_memory_budget is None:
+        job_memory_budget = int(JOB_MEMORY_FRACTION * get_memory_limit())
+    if job_memory_budget > 0:
+        return get_valid_num_cpus(num_cpus, memory_per_cpu=0), job_memory_budget
+    return get_valid_num_cpus(num_cpus), 0
+
+def get_job_cost_list(job_name_list, estimated_cost_list, job_runtime_history=None):
+    """
+    Returns the cost of each job in seconds if the job has a historical
+    runtime (job name: seconds). The estimated cost of the other jobs is
+    converted to seconds with the median ratio of the jobs with both.
+    """
+    if not job_runtime_history:
+        return list(estimated_cost_list)
+
+    seconds_per_cost_list = sorted([job_runtime_history[job_name] / float(estimated_cost)
+                                    for job_name, estimated_cost in zip(job_name_list, estimated_cost_list) \
+                                    if job_name in job_runtime_history and estimated_cost > 0])
+    seconds_per_cost = 1
+    if seconds_per_cost_list:
+        seconds_per_cost = seconds_per_cost_list[len(seconds_per_cost_list) // 2]
+
+    return [job_runtime_history[job_name] if job_name in job_runtime_history \
+            else estimated_cost * seconds_per_cost
+            for job_name, estimated_cost in zip(job_name_list, estimated_cost_list)]
+
+def get_job_order(job_cost_list, job_order="directory"):
+    """
+    Returns the order to submit the jobs in
+    """
+    if job_order not in VALID_JOB_ORDER_LIST:
+        raise Exception("ERROR: Invalid job order {0}. Only {1} allowed ...".format(job_order,
+                                                                                  ", ".join(VALID_JOB_ORDER_LIST)))
+    if job_order == "largest_first":
+        return sorted(range(len(job_cost_list)), key=lambda job_index: -job_cost_list[job_index])
+    return list(range(len(job_cost_list)))
+
+#----------------------------------------------------------------------------------------
+# MULTIPROCESS FUNCTIONS
+#----------------------------------------------------------------------------------------
+class JobResourceMonitor(threading.Thread):
+    """
+    Samples the memory of the process and its child processes (i.e. the
+    AutoRoute executable) while a job runs to find the peak memory and
+    measures the cpu time of the job
+
+    The peak memory does not include the resident memory of the process
+    when the job started (the pool worker is reused by many jobs).
+
+    If process_id is set, the job is that process (i.e. the AutoRoute
+    executable started by the async executor) and its cpu time is
+    sampled until it exits.
+    """
+    def __init__(self, sample_interval=0.5, process_id=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sample_interval = sample_interval
+        self.peak_memory = None
+        self.cpu_time = None
+        self._stop_event = threading.Event()
+        self._process = None
+        self._process_id = process_id
+        self._cpu_time_start = 0
+        self._memory_start = 0
+        if Process is not None:
+            try:
+                self._process = Process(process_id)
+            except NoSuchProcess:
+                #the process already exited
+                return
+            if process_id is None:
+                self._cpu_time_start = self._get_cpu_time()
+                self._memory_start = self._process.memory_info().rss
+
+    def _get_cpu_time(self):
+        """
+        Returns the cpu time of the process and its finished child processes
+        """
+        cpu_times = self._process.cpu_times()
+        return cpu_times.user + cpu_times.system + \
+               getattr(cpu_times, 'children_user', 0) + \
+               getattr(cpu_times, 'children_system', 0)
+
+    def _sample_memory(self):
+        """
+        Updates the peak memory with the resident memory the process
+        gained since the job started and its child processes
+        """
+        try:
+            memory = max(0, self._process.memory_info().rss - self._memory_start)
+            child_process_list = self._process.children(recursive=True)
+            if self._process_id is not None:
+                self.cpu_time = self._get_cpu_time()
+        except NoSuchProcess:
+            #the process of the job exited
+            return
+        for child_process in child_process_list:
+            try:
+                memory += child_process.memory_info().rss
+            except NoSuchProcess:
+                pass
+        self.peak_memory = max(self.peak_memory or 0, memory)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self._sample_memory()
+            self._stop_event.wait(self.sample_interval)
+
+    def __enter__(self):
+        if self._process is not None:
+            self.start()
+        return self
+
+    def __exit__(self, *args):
+        if self._process is not None:
+            self._stop_event.set()
+            self.join()
+            self._sample_memory()
+            if self._process_id is None:
+                self.cpu_time = self._get_cpu_time() - self._cpu_time_start
+
+def pipeline_worker(args):
+    """
+    Runs one job of a pipeline stage on one of multiple cores and
+    records when it started and finished, its cpu time and peak memory
+    """
+    stage_name, worker_function, job_args = args
+    time_start = time()
+    job_output = None
+    job_error = None
+    with JobResourceMonitor() as job_resources:
+        try:
+            job_output = worker_function(job_args)
+        except Exception:
+            job_error = traceback.format_exc()
+    return stage_name, job_output, job_error, time_start, time(), \
+           job_resources.cpu_time, job_resources.peak_memory
+
+#----------------------------------------------------------------------------------------
+# JOB BUDGET CLASS
+#----------------------------------------------------------------------------------------
+class JobBudget(object):
+    """
+    Number of cpus and memory budget (bytes) of the running jobs that can
+    be shared by several pipelines (i.e. the watersheds run at the same
+    time) so together they do not run more jobs than the cpus or plan
+    for more memory than the budget.
+    """
+    def __init__(self, num_cpus, memory_budget=0):
+        self.num_cpus = num_cpus
+        self.memory_budget = memory_budget
+        self.num_admitted = 0
+        self.memory_admitted = 0
+        self.max_memory_admitted = 0
+        self._lock = threading.Lock()
+        self._pipeline_list = []
+
+    def add_pipeline(self, pipeline):
+        """
+        Adds a pipeline to admit waiting jobs for when a job finishes
+        """
+        with self._lock:
+            self._pipeline_list.append(pipeline)
+
+    def try_admit(self, job_memory):
+        """
+        Reserves a cpu and the memory of the job if they are available
+        (a job larger than the budget runs alone)
+        """
+        with self._lock:
+            if self.num_admitted > 0 \
+                and (self.num_admitted >= self.num_cpus or \
+                     (self.memory_budget > 0 and \
+                      self.memory_admitted + job_memory > self.memory_budget)):
+                return False
+            self.num_admitted += 1
+            self.memory_admitted += job_memory
+            self.max_memory_admitted = max(self.max_memory_admitted,
+                                           self.memory_admitted)
+            return True
+
+    def release(self, job_memory):
+        """
+        Releases the cpu and memory of a finished job and admits
+        the jobs waiting in the pipelines
+        """
+        with self._lock:
+            self.num_admitted -= 1
+            self.memory_admitted -= job_memory
+            pipeline_list = list(self._pipeline_list)
+        for pipeline in pipeline_list:
+            pipeline._admit_jobs()
+
+#----------------------------------------------------------------------------------------
+# PIPELINE CLASS
+#----------------------------------------------------------------------------------------
+class MultiprocessPipeline(object):
+    """
+    Runs jobs on one multiprocessing pool where each job can have jobs
+    that are submitted as soon as it finishes (i.e. the AutoRoute
+    simulations of a sub-basin after its streamflow preparation)
+
+    If memory_budget (bytes) is set, jobs are only sent to the pool while
+    the sum of the memory estimates of the running jobs fits in the
+    budget. Jobs are admitted in the order submitted and a job larger
+    than the budget runs alone.
+
+    If job_budget (JobBudget) is set, the cpus and memory budget are
+    shared with the other pipelines using it instead.
+
+    If ledger (JobLedger) or checkpoint (JobCheckpoint) is set, each
+    finished job is recorded in it with the job information submitted
+    with it.
+    """
+    def __init__(self, pool, num_cpus, memory_budget=0, ledger=None, checkpoint=None,
+                 job_budget=None):
+        self._pool = pool
+        if job_budget is None:
+            job_budget = JobBudget(num_cpus, memory_budget)
+        self._job_budget = job_budget
+        self._job_budget.add_pipeline(self)
+        self._ledger = ledger
+        self._checkpoint = checkpoint
+        self._result_queue = Queue()
+        self._lock = threading.Lock()
+        self._num_pending = 0
+        #jobs waiting for memory and the jobs in the pool
+        self._waiting_jobs = deque()
+        self._time_start = time()
+        self._time_end = None
+        #stage name -> list of (start time, end time)
+        self._stage_times = {}
+        self._stage_order = []
+        #called (from the pool result thread) when a job finishes
+        self._result_listener = None
+
+    def set_result_listener(self, result_listener):
+        """
+        Sets a function called without arguments each time a job
+        finishes (i.e. to wake up an event loop waiting on the results)
+        """
+        self._result_listener = result_listener
+
+    def is_finished(self):
+        """
+        Returns True if the results of all of the jobs were returned
+        """
+        with self._lock:
+            return self._num_pending <= 0
+
+    def submit(self, stage_name, worker_function, job_args, next_job_list=(),
+               job_memory=0, job_info=None):
+        """
+        Submits a job to the pool. The jobs in next_job_list
+        (stage name, worker function, job arguments, next jobs,
+        job memory, job info) are submitted when this job finishes
+        successfully. The job info (job_name, input_directory,
+        output_file_list, ...) is recorded in the ledger.
+        """
+        with self._lock:
+            self._num_pending += 1
+            if stage_name not in self._stage_order:
+                self._stage_order.append(stage_name)
+            self._waiting_jobs.append((stage_name, worker_function, job_args,
+                                       next_job_list, job_memory, job_info))
+        self._admit_jobs()
+
+    def _admit_jobs(self):
+        """
+        Sends the waiting jobs to the pool while they fit in the memory budget
+        """
+        admitted_job_list = []
+        with self._lock:
+            while self._waiting_jobs:
+                if not self._job_budget.try_admit(self._waiting_jobs[0][4]):
+                    break
+                admitted_job_list.append(self._waiting_jobs.popleft())
+
+        for stage_name, worker_function, job_args, next_job_list, job_memory, job_info in admitted_job_list:
+            job_finished = self._get_job_finished_callback(next_job_list, job_memory, job_info)
+            apply_kwargs = {'callback': job_finished}
+            if sys.version_info[0] >= 3:
+                #the job fails if its arguments or result cannot be pickled
+                apply_kwargs['error_callback'] = self._get_job_error_callback(stage_name, job_finished)
+            self._pool.apply_async(pipeline_worker,
+                                   ((stage_name, worker_function, job_args),),
+                                   **apply_kwargs)
+
+    @staticmethod
+    def _get_job_error_callback(stage_name, job_finished):
+        """
+        Returns the function called in the parent process when the job
+        could not run or return its result in the pool
+        """
+        time_start = time()
+        def job_error(exception):
+            """
+            Finishes the job as failed
+            """
+            error_message = "".join(traceback.format_exception_only(type(exception), exception))
+            job_finished((stage_name, None, error_message, time_start, time(), None, None))
+        return job_error
+
+    def _get_job_finished_callback(self, next_job_list, job_memory, job_info):
+        """
+        Returns the function called in the parent process when the job finishes
+        """
+        def job_finished(job_result):
+            """
+            Releases the memory of the job and submits the jobs that
+            were waiting on it
+            """
+            if job_result[2] is None:
+                for next_job in next_job_list:
+                    self.submit(*next_job)
+            #admits the waiting jobs of every pipeline sharing the budget
+            self._job_budget.release(job_memory)
+            self._result_queue.put((job_result, job_info))
+            if self._result_listener is not None:
+                self._result_listener()
+        return job_finished
+
+    def results(self, block=True):
+        """
+        Yields the stage name and output of each job as it finishes
+        until all jobs are done (or, if block is False, until no
+        finished job is waiting). Raises an exception if a job failed.
+        """
+        while True:
+            with self._lock:
+                if self._num_pending <= 0:
+                    break
+            try:
+                job_result, job_info = self._result_queue.get(block)
+            except Empty:
+                return
+            stage_name, job_output, job_error, time_start, time_end = job_result[:5]
+            with self._lock:
+                self._num_pending -= 1
+            self._stage_times.setdefault(stage_name, []).append((time_start, time_end))
+            if job_info is not None:
+                self._record_job(job_result, job_info)
+            if job_error is not None:
+                raise Exception("ERROR: {0} job failed:\n{1}".format(stage_name, job_error))
+            yield stage_name, job_output
+        self._time_end = time()
+
+    def _record_job(self, job_result, job_info):
+        """
+        Records the finished job in the checkpoint and the ledger
+        """
+        stage_name, job_output, job_error, time_start, time_end, cpu_time, peak_memory = job_result
+        if self._checkpoint is not None:
+            self._checkpoint.record_job(stage_name,
+                                        job_info['job_name'],
+                                        status="success" if job_error is None else "failed",
+                                        output_file_list=job_info.get('output_file_list', ()),
+                                        error=job_error or "")
+        if self._ledger is None:
+            return
+        job_info = dict(job_info)
+        self._ledger.record_job(stage_name,
+                                job_info.pop('job_name'),
+                                time_start,
+                                time_end,
+                                cpu_time=cpu_time,
+                                peak_memory=peak_memory,
+                                status="success" if job_error is None else "failed",
+                                error=job_error or "",
+                                input_directory=job_info.pop('input_directory', ""),
+                                num_dem_cells=job_info.pop('num_dem_cells', None),
+                                num_stream_cells=job_info.pop('num_stream_cells', None),
+                                estimated_memory=job_info.pop('estimated_memory', None),
+                                output_file_list=job_info.pop('output_file_list', ()),
+                                parameters=job_info)
+
+    def print_report(self):
+        """
+        Prints the wall time of each stage, the total time (makespan)
+        compared to the ideal time and the core utilization
+        """
+        time_end = self._time_end or time()
+        total_wall_time = max(time_end - self._time_start, 1e-9)
+        total_busy_time = 0
+        for stage_name in self._stage_order:
+            stage_times = self._stage_times.get(stage_name)
+            if not stage_times:
+                continue
+            stage_wall_time = max([job_end for job_start, job_end in stage_times]) - \
+                              min([job_start for job_start, job_end in stage_times])
+            stage_busy_time = sum([job_end - job_start for job_start, job_end in stage_times])
+            total_busy_time += stage_busy_time
+            print("{0}: {1} jobs, wall time {2}, busy time {3}".format(stage_name,
+                                                                      len(stage_times),
+                                                                      timedelta(seconds=stage_wall_time),
+                                                                      timedelta(seconds=stage_busy_time)))
+        #the total time cannot be shorter than the longest job or
+        #the total busy time spread evenly over all of the cpus
+        job_time_list = [job_end - job_start for stage_times in self._stage_times.values() \
+                         for job_start, job_end in stage_times]
+        if job_time_list:
+            ideal_wall_time = max(max(job_time_list), total_busy_time / self._job_budget.num_cpus)
+            print("Makespan: {0}, ideal: {1} ({2:.2f}x ideal)".format(timedelta(seconds=total_wall_time),
+                                                                     timedelta(seconds=ideal_wall_time),
+                                                                     total_wall_time / max(ideal_wall_time, 1e-9)))
+        job_budget = self._job_budget
+        if job_budget.memory_budget > 0:
+            print("Peak estimated memory admitted: {0:.2f} GB of {1:.2f} GB budget".format(job_budget.max_memory_admitted * 1e-9,
+                                                                                          job_budget.memory_budget * 1e-9))
+        print("Core utilization: {0:.1f}% of {1} CPUS over {2}".format(100.0 * total_busy_time / (self._job_budget.num_cpus * total_wall_time),
+                                                                       self._job_budget.num_cpus,
+                                                                       timedelta(seconds=total_wall_time)))
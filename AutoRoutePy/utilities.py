@@ -7,6 +7,8 @@
 ##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
 ##  License: BSD-3 Clause
 
+import hashlib
+import json
 from multiprocessing import cpu_count
 import os
 import re
@@ -19,6 +21,9 @@ except ImportError:
           "mode, please install psutil (i.e. pip install psutil).")
     pass
 
+#raster extensions AutoRoute can read
+VALID_RASTER_EXTENSIONS = "asc|bmp|dt2|img|jp2|j2c|j2k|jpeg|jpg2|jpg|png|tif|tiff"
+
 #----------------------------------------------------------------------------------------
 # HELPER FUNCTIONS
 #----------------------------------------------------------------------------------------
@@ -69,14 +74,97 @@ def get_watershed_subbasin_from_folder(folder_name):
     subbasin = input_folder_split[1].lower()
     return watershed, subbasin
     
-def get_valid_num_cpus(num_cpus):
+def write_json_file_atomic(json_file, json_data):
+    """
+    Writes the data to a JSON file by replacing the file with a
+    complete temporary file so readers never see a partial file
+    """
+    temp_json_file = "{0}.tmp".format(json_file)
+    with open(temp_json_file, 'w') as json_handle:
+        json.dump(json_data, json_handle, indent=1, sort_keys=True)
+        json_handle.flush()
+        os.fsync(json_handle.fileno())
+    try:
+        os.replace(temp_json_file, json_file)
+    except AttributeError:
+        #python 2 cannot rename over an existing file on Windows
+        if os.name == 'nt' and os.path.exists(json_file):
+            os.remove(json_file)
+        os.rename(temp_json_file, json_file)
+
+def get_file_fingerprint(file_path, previous_fingerprint=None, block_size=1024**2):
+    """
+    Returns the size, modification time and sha256 hash of the file
+
+    If the size and modification time match previous_fingerprint,
+    the previous hash is reused instead of reading the file again
+    """
+    file_stat = os.stat(file_path)
+    if previous_fingerprint and previous_fingerprint[0] == file_stat.st_size \
+        and previous_fingerprint[1] == file_stat.st_mtime:
+        return list(previous_fingerprint)
+
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as file_handle:
+        for file_block in iter(lambda: file_handle.read(block_size), b''):
+            file_hash.update(file_block)
+    return [file_stat.st_size, file_stat.st_mtime, file_hash.hexdigest()]
+
+def _read_cgroup_value(cgroup_file):
+    """
+    Reads the value in the cgroup file ("" if it does not exist)
+    """
+    try:
+        with open(cgroup_file) as cgroup_handle:
+            return cgroup_handle.read().strip()
+    except (IOError, OSError):
+        return ""
+
+def get_cpu_limit():
+    """
+    Retrieves the number of cpus available to the process
+    (respects cpu affinity and cgroup quotas in containers)
+    """
+    total_cpus = cpu_count()
+    try:
+        total_cpus = min(total_cpus, len(os.sched_getaffinity(0)))
+    except AttributeError:
+        pass
+
+    #cgroup v2 (quota period) or cgroup v1
+    cpu_quota = _read_cgroup_value('/sys/fs/cgroup/cpu.max').split()
+    if len(cpu_quota) < 2:
+        cpu_quota = [_read_cgroup_value('/sys/fs/cgroup/cpu/cpu.cfs_quota_us'),
+                     _read_cgroup_value('/sys/fs/cgroup/cpu/cpu.cfs_period_us')]
+    if cpu_quota[0].isdigit() and cpu_quota[1].isdigit() and int(cpu_quota[1]) > 0:
+        total_cpus = min(total_cpus, max(1, -(-int(cpu_quota[0]) // int(cpu_quota[1]))))
+    return total_cpus
+
+def get_memory_limit():
+    """
+    Retrieves the memory available to the process in bytes
+    (respects cgroup memory limits in containers)
+    """
+    memory_limit = virtual_memory().total
+    for cgroup_file in ('/sys/fs/cgroup/memory.max',
+                        '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        cgroup_memory_limit = _read_cgroup_value(cgroup_file)
+        if cgroup_memory_limit.isdigit():
+            memory_limit = min(memory_limit, int(cgroup_memory_limit))
+    return memory_limit
+
+def get_valid_num_cpus(num_cpus, memory_per_cpu=3e9):
     """
     Retrieves the valid number of cpus based on computer specs
+
+    memory_per_cpu is the recommended memory for each cpu in bytes
+    (0 if the memory is managed by admitting jobs by size instead)
     """
     #set number of cpus to use (recommended 3 GB per cpu)
-    total_cpus = cpu_count()
-    mem = virtual_memory()
-    recommended_max_num_cpus = max(1, int(mem.total  * 1e-9 / 3))
+    total_cpus = get_cpu_limit()
+    recommended_max_num_cpus = total_cpus
+    if memory_per_cpu > 0:
+        recommended_max_num_cpus = max(1, int(get_memory_limit() / memory_per_cpu))
     if num_cpus <= 0:
         num_cpus = total_cpus
         num_cpus = min(recommended_max_num_cpus, total_cpus)
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+##
+##  benchmark_pipeline.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License BSD 3-Clause
+"""
+Times the prepare, run, post and mosaic stages end to end on a synthetic
+watershed with the stand-in AutoRoute executable (fake_autoroute.py)
+and saves the results as JSON to track throughput over time.
+
+Usage: python benchmark_pipeline.py --num-tiles 4 --tile-rows 1000
+       --tile-cols 1000 --num-reaches 200 --qout-length 8760
+       [--num-ensembles 52] [--results-directory results]
+"""
+import argparse
+from collections import OrderedDict
+from datetime import datetime
+import json
+import os
+import platform
+import stat
+from subprocess import CalledProcessError, check_output
+import sys
+from tempfile import mkdtemp
+from time import time
+
+from netCDF4 import Dataset
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+from AutoRoutePy.instrumentation import disable_instrumentation, read_events
+from AutoRoutePy.manifest import find_output_manifests
+from AutoRoutePy.post.post_process import (merge_shapefiles,
+                                           mosaic_rasters,
+                                           polygonize_rasters)
+from AutoRoutePy.prepare.prepare_multiprocess import prepare_autoroute_multiprocess
+from AutoRoutePy.run.run_multiprocess import run_autoroute_multiprocess
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+#origin and cell size of the synthetic watershed (EPSG:4326)
+ORIGIN_X = -100.0
+ORIGIN_Y = 40.0
+CELL_SIZE = 0.0001
+
+#number of time steps in the ECMWF low and high (52) resolution ensembles
+ECMWF_LOW_RES_SIZE = 61
+ECMWF_HIGH_RES_SIZE = 125
+
+#executable that runs the stand-in with this python
+FAKE_AUTOROUTE_LAUNCHER = """#!{0}
+import sys
+sys.path.insert(0, {1!r})
+from fake_autoroute import main
+main(sys.argv[1:])
+"""
+
+
+def get_spatial_reference_wkt():
+    """
+    Returns the projection of the synthetic watershed
+    """
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.ImportFromEPSG(4326)
+    return spatial_reference.ExportToWkt()
+
+
+def get_reach_list(num_tiles, tile_rows, tile_cols, num_reaches):
+    """
+    Returns the (river id, x start, x end, y) of each reach. The reaches
+    are horizontal lines split into segments across the tiles.
+    """
+    width = num_tiles * tile_cols * CELL_SIZE
+    height = tile_rows * CELL_SIZE
+    num_lines = int(np.ceil(np.sqrt(num_reaches)))
+    num_segments = int(np.ceil(float(num_reaches) / num_lines))
+    reach_list = []
+    for reach_index in range(num_reaches):
+        line_index, segment_index = divmod(reach_index, num_segments)
+        reach_list.append((1000 + reach_index,
+                           ORIGIN_X + segment_index * width / num_segments,
+                           ORIGIN_X + (segment_index + 1) * width / num_segments,
+                           ORIGIN_Y - (line_index + 0.5) * height / num_lines))
+    return reach_list
+
+
+def generate_elevation_dems(watershed_folder, num_tiles, tile_rows, tile_cols,
+                            reach_list, random_state):
+    """
+    Writes a DEM for each tile in its own sub-basin folder with valleys
+    along the reaches
+    """
+    projection = get_spatial_reference_wkt()
+    reach_row_array = np.unique([int((ORIGIN_Y - reach[3]) / CELL_SIZE) for reach in reach_list])
+    row_array = np.arange(tile_rows)
+    #distance in cells to the nearest reach
+    valley_distance = np.abs(row_array[:, None] - reach_row_array[None, :]).min(axis=1)
+    for tile_index in range(num_tiles):
+        sub_folder = os.path.join(watershed_folder, "tile_{0}".format(tile_index))
+        os.makedirs(sub_folder)
+        col_array = tile_index * tile_cols + np.arange(tile_cols)
+        elevation_array = 100.0 - 0.001 * col_array[None, :] + 0.1 * valley_distance[:, None] + \
+            random_state.uniform(0, 0.05, (tile_rows, tile_cols))
+        elevation_raster = gdal.GetDriverByName('GTiff').Create(os.path.join(sub_folder, "dem.tif"),
+                                                                tile_cols, tile_rows, 1,
+                                                                gdal.GDT_Float32)
+        elevation_raster.SetGeoTransform((ORIGIN_X + tile_index * tile_cols * CELL_SIZE, CELL_SIZE, 0,
+                                          ORIGIN_Y, 0, -CELL_SIZE))
+        elevation_raster.SetProjection(projection)
+        elevation_raster.GetRasterBand(1).WriteArray(elevation_array.astype(np.float32))
+        elevation_raster = None
+
+
+def generate_land_use(land_use_raster, manning_n_table, num_tiles, tile_rows, tile_cols,
+                      random_state):
+    """
+    Writes a land use raster over the watershed and its manning n table
+    """
+    land_use_raster_ds = gdal.GetDriverByName('GTiff').Create(land_use_raster,
+                                                              num_tiles * tile_cols, tile_rows,
+                                                              1, gdal.GDT_Byte)
+    land_use_raster_ds.SetGeoTransform((ORIGIN_X, CELL_SIZE, 0, ORIGIN_Y, 0, -CELL_SIZE))
+    land_use_raster_ds.SetProjection(get_spatial_reference_wkt())
+    land_use_raster_ds.GetRasterBand(1).WriteArray(random_state.randint(1, 5, (tile_rows,
+                                                                               num_tiles * tile_cols)).astype(np.uint8))
+    land_use_raster_ds = None
+    with open(manning_n_table, 'w') as manning_n_file:
+        manning_n_file.write("LC_ID\tDescription\tManning_n\n")
+        for land_use_id, manning_n in zip(range(1, 5), (0.03, 0.05, 0.1, 0.12)):
+            manning_n_file.write("{0}\tclass {0}\t{1}\n".format(land_use_id, manning_n))
+
+
+def generate_stream_network(stream_network_shapefile, reach_list, random_state):
+    """
+    Writes the stream network shapefile with the river id and slope
+    """
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.ImportFromEPSG(4326)
+    shapefile = ogr.GetDriverByName('ESRI Shapefile').CreateDataSource(stream_network_shapefile)
+    layer = shapefile.CreateLayer('drainage_line', spatial_reference, geom_type=ogr.wkbLineString)
+    layer.CreateField(ogr.FieldDefn('COMID', ogr.OFTInteger))
+    layer.CreateField(ogr.FieldDefn('SLOPE', ogr.OFTReal))
+    for river_id, x_start, x_end, y in reach_list:
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField('COMID', river_id)
+        feature.SetField('SLOPE', random_state.uniform(0.001, 0.01))
+        line = ogr.Geometry(ogr.wkbLineString)
+        line.AddPoint_2D(x_start, y)
+        line.AddPoint_2D(x_end, y)
+        feature.SetGeometry(line)
+        layer.CreateFeature(feature)
+        feature = None
+    shapefile = None
+
+
+def generate_rapid_output(rapid_output_file, river_id_list, num_time_steps, random_state,
+                          time_step_seconds=3600, time_block_size=1000):
+    """
+    Writes a RAPID Qout file (time x river) in blocks of time steps
+    """
+    with Dataset(rapid_output_file, 'w') as qout_nc:
+        qout_nc.createDimension('time', num_time_steps)
+        qout_nc.createDimension('rivid', len(river_id_list))
+        rivid_var = qout_nc.createVariable('rivid', 'i4', ('rivid',))
+        rivid_var[:] = river_id_list
+        time_var = qout_nc.createVariable('time', 'i4', ('time',))
+        time_var.units = "seconds since 1970-01-01 00:00:00+00:00"
+        time_var[:] = np.arange(num_time_steps) * time_step_seconds
+        qout_var = qout_nc.createVariable('Qout', 'f4', ('time', 'rivid'))
+        base_flow_array = random_state.uniform(1, 100, len(river_id_list))
+        for time_start in range(0, num_time_steps, time_block_size):
+            time_index_array = np.arange(time_start, min(num_time_steps, time_start + time_block_size))
+            seasonal_array = 1 + 0.5 * np.sin(2 * np.pi * time_index_array / 8760.0)
+            qout_var[time_index_array[0]:time_index_array[-1] + 1, :] = \
+                seasonal_array[:, None] * base_flow_array[None, :] * \
+                random_state.uniform(0.5, 1.5, (len(time_index_array), len(river_id_list)))
+
+
+def generate_ecmwf_prediction_folder(prediction_folder, watershed_name, river_id_list,
+                                     num_ensembles, random_state):
+    """
+    Writes the ECMWF ensemble Qout files (52 is the high resolution member)
+    """
+    os.makedirs(prediction_folder)
+    for ensemble_index in range(1, num_ensembles + 1):
+        num_time_steps, time_step_seconds = ECMWF_LOW_RES_SIZE, 6 * 3600
+        if ensemble_index == 52:
+            num_time_steps, time_step_seconds = ECMWF_HIGH_RES_SIZE, 3600
+        generate_rapid_output(os.path.join(prediction_folder,
+                                           "Qout_{0}_{1}.nc".format(watershed_name, ensemble_index)),
+                              river_id_list, num_time_steps, random_state,
+                              time_step_seconds=time_step_seconds)
+
+
+def generate_synthetic_watershed(output_directory, num_tiles, tile_rows, tile_cols,
+                                 num_reaches, qout_length, num_ensembles, seed=0):
+    """
+    Writes the synthetic watershed and returns the paths of its inputs
+    """
+    random_state = np.random.RandomState(seed)
+    watershed_name = "synthetic"
+    watershed_folder = os.path.join(output_directory, "input", watershed_name)
+    os.makedirs(watershed_folder)
+    reach_list = get_reach_list(num_tiles, tile_rows, tile_cols, num_reaches)
+    generate_elevation_dems(watershed_folder, num_tiles, tile_rows, tile_cols,
+                            reach_list, random_state)
+
+    inputs = {
+        'watershed_folder': watershed_folder,
+        'stream_network_shapefile': os.path.join(output_directory, "drainage_line.shp"),
+        'land_use_raster': os.path.join(output_directory, "land_use.tif"),
+        'manning_n_table': os.path.join(output_directory, "manning_n_table.txt"),
+        'rapid_output_file': "",
+        'rapid_output_directory': "",
+    }
+    generate_stream_network(inputs['stream_network_shapefile'], reach_list, random_state)
+    generate_land_use(inputs['land_use_raster'], inputs['manning_n_table'],
+                      num_tiles, tile_rows, tile_cols, random_state)
+    river_id_list = [reach[0] for reach in reach_list]
+    if num_ensembles > 0:
+        inputs['rapid_output_directory'] = os.path.join(output_directory, "ecmwf")
+        generate_ecmwf_prediction_folder(inputs['rapid_output_directory'], watershed_name,
+                                         river_id_list, num_ensembles, random_state)
+    else:
+        inputs['rapid_output_file'] = os.path.join(output_directory, "Qout.nc")
+        generate_rapid_output(inputs['rapid_output_file'], river_id_list, qout_length,
+                              random_state)
+    return inputs
+
+
+def create_fake_autoroute_executable(executable_path):
+    """
+    Writes an executable that runs fake_autoroute.py with this python
+    """
+    with open(executable_path, 'w') as executable_file:
+        executable_file.write(FAKE_AUTOROUTE_LAUNCHER.format(sys.executable, BENCHMARK_DIRECTORY))
+    os.chmod(executable_path, os.stat(executable_path).st_mode | stat.S_IEXEC)
+
+
+def get_stage_events(events_file):
+    """
+    Returns the number of spans and the total seconds of each
+    instrumented stage
+    """
+    stage_events = OrderedDict()
+    if not os.path.exists(events_file):
+        return stage_events
+    for event in read_events(events_file):
+        stage_event = stage_events.setdefault(event['stage'], {'count': 0, 'seconds': 0.0})
+        stage_event['count'] += 1
+        stage_event['seconds'] += event['duration']
+    return stage_events
+
+
+def get_git_revision():
+    """
+    Returns the commit of AutoRoutePy benchmarked (None outside of git)
+    """
+    try:
+        return check_output(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARK_DIRECTORY,
+                            universal_newlines=True).strip()
+    except (CalledProcessError, OSError):
+        return None
+
+
+def run_benchmark(output_directory, num_tiles, tile_rows, tile_cols, num_reaches,
+                  qout_length, num_ensembles, num_cpus, executor="multiprocess", seed=0):
+    """
+    Times the prepare, run and post stages on the synthetic watershed
+    """
+    inputs = generate_synthetic_watershed(output_directory, num_tiles, tile_rows, tile_cols,
+                                          num_reaches, qout_length, num_ensembles, seed)
+    autoroute_executable = os.path.join(output_directory, "fake_autoroute")
+    create_fake_autoroute_executable(autoroute_executable)
+    log_directory = os.path.join(output_directory, "logs")
+    flood_output_directory = os.path.join(output_directory, "output")
+    os.makedirs(flood_output_directory)
+    events_file = os.path.join(output_directory, "events.jsonl")
+
+    stage_seconds = OrderedDict()
+    try:
+        time_start = time()
+        prepare_autoroute_multiprocess(inputs['watershed_folder'],
+                                       autoroute_executable,
+                                       inputs['stream_network_shapefile'],
+                                       log_directory,
+                                       land_use_raster=inputs['land_use_raster'],
+                                       manning_n_table=inputs['manning_n_table'],
+                                       dem_extension='tif',
+                                       river_id='COMID',
+                                       slope_id='SLOPE',
+                                       rapid_output_directory=inputs['rapid_output_directory'],
+                                       rapid_output_file=inputs['rapid_output_file'],
+                                       num_cpus=num_cpus,
+                                       instrumentation_events_file=events_file)
+        stage_seconds['prepare'] = time() - time_start
+
+        time_start = time()
+        run_autoroute_multiprocess(autoroute_executable_location=autoroute_executable,
+                                   autoroute_input_directory=inputs['watershed_folder'],
+                                   autoroute_output_directory=flood_output_directory,
+                                   log_directory=log_directory,
+                                   generate_flood_map_raster=True,
+                                   num_cpus=num_cpus,
+                                   executor=executor,
+                                   instrumentation_events_file=events_file)
+        stage_seconds['run'] = time() - time_start
+
+        time_start = time()
+        output_manifest_list = find_output_manifests(flood_output_directory)
+        polygonize_rasters(flood_output_directory, num_cpus=num_cpus,
+                           output_manifest_list=output_manifest_list)
+        merge_shapefiles(flood_output_directory,
+                         os.path.join(output_directory, "flood_map_merged.gpkg"),
+                         num_cpus=num_cpus)
+        stage_seconds['post'] = time() - time_start
+
+        time_start = time()
+        mosaic_rasters(flood_output_directory,
+                       os.path.join(output_directory, "flood_map.vrt"),
+                       out_cog_file=os.path.join(output_directory, "flood_map.tif"),
+                       num_cpus=num_cpus,
+                       output_manifest_list=output_manifest_list)
+        stage_seconds['mosaic'] = time() - time_start
+    finally:
+        disable_instrumentation()
+
+    num_dem_cells = num_tiles * tile_rows * tile_cols
+    return OrderedDict([
+        ('benchmark', "pipeline"),
+        ('time', datetime.utcnow().isoformat()),
+        ('git_revision', get_git_revision()),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('parameters', OrderedDict([('num_tiles', num_tiles),
+                                    ('tile_rows', tile_rows),
+                                    ('tile_cols', tile_cols),
+                                    ('num_reaches', num_reaches),
+                                    ('qout_length', qout_length),
+                                    ('num_ensembles', num_ensembles),
+                                    ('num_cpus', num_cpus),
+                                    ('executor', executor),
+                                    ('seed', seed)])),
+        ('stage_seconds', stage_seconds),
+        ('total_seconds', sum(stage_seconds.values())),
+        ('dem_cells_per_second', OrderedDict((stage, num_dem_cells / max(seconds, 1e-9)) \
+                                             for stage, seconds in stage_seconds.items())),
+        ('instrumented_stages', get_stage_events(events_file)),
+    ])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--num-tiles', type=int, default=4)
+    parser.add_argument('--tile-rows', type=int, default=1000)
+    parser.add_argument('--tile-cols', type=int, default=1000)
+    parser.add_argument('--num-reaches', type=int, default=200)
+    parser.add_argument('--qout-length', type=int, default=8760,
+                        help="time steps in the RAPID output file")
+    parser.add_argument('--num-ensembles', type=int, default=0,
+                        help="ECMWF ensembles to use instead of the RAPID output file (up to 52)")
+    parser.add_argument('--num-cpus', type=int, default=2)
+    parser.add_argument('--executor', default="multiprocess", choices=['multiprocess', 'async'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output-directory', default="",
+                        help="directory for the synthetic watershed (temporary by default)")
+    parser.add_argument('--results-directory', default=os.path.join(BENCHMARK_DIRECTORY, "results"))
+    args = parser.parse_args()
+
+    output_directory = args.output_directory or mkdtemp()
+    results = run_benchmark(output_directory, args.num_tiles, args.tile_rows, args.tile_cols,
+                            args.num_reaches, args.qout_length, min(args.num_ensembles, 52),
+                            args.num_cpus, args.executor, args.seed)
+    try:
+        os.makedirs(args.results_directory)
+    except OSError:
+        pass
+    results_file = os.path.join(args.results_directory,
+                                "benchmark_pipeline_{0}.json".format(datetime.utcnow().strftime("%Y%m%d%H%M%S")))
+    with open(results_file, 'w') as results_handle:
+        json.dump(results, results_handle, indent=2)
+    print(json.dumps(results, indent=2))
+    print("Results saved to {0}".format(results_file))
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+##
+##  benchmark_publish.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License BSD 3-Clause
+"""
+Times uploading flood map shapefiles and creating the layer groups with
+the ShapefilePublisher against a local stub of the GeoServer REST API
+(with latency and failed requests) so publishing can be benchmarked offline.
+
+Usage: python benchmark_publish.py --num-watersheds 4 --num-jobs 10
+       --shapefile-size 500000 --latency 0.2 --failure-rate 0.05
+       [--num-threads 1 4 8] [--results-directory results]
+"""
+import argparse
+from collections import OrderedDict
+from datetime import datetime
+import json
+import os
+import platform
+import random
+from shutil import rmtree
+from tempfile import mkdtemp
+import threading
+from time import sleep, time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.request import Request, urlopen
+except ImportError:
+    #python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib2 import Request, urlopen
+
+from AutoRoutePy.post.publish import ShapefilePublisher, upload_shapefile_rest
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+RETURN_PERIOD_LIST = ['return_period_20', 'return_period_10', 'return_period_2']
+
+WORKSPACE = "spt"
+
+
+class StubGeoServer(ThreadingMixIn, HTTPServer):
+    """
+    Accepts the shapefile uploads and layer groups of the GeoServer REST
+    API after a delay and fails some of them with 503 (nothing is stored)
+    """
+    daemon_threads = True
+
+    def __init__(self, latency, failure_rate, seed=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubGeoServerHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random_state = random.Random(seed)
+        self.lock = threading.Lock()
+        self.request_counts = {'uploads': 0, 'layer_groups': 0, 'failed': 0, 'bytes': 0}
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}/geoserver".format(self.server_address[1])
+
+
+class StubGeoServerHandler(BaseHTTPRequestHandler):
+    """
+    Handles the requests of the stub GeoServer
+    """
+    def _handle(self):
+        content_length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(content_length)
+        server = self.server
+        sleep(server.latency)
+        with server.lock:
+            failed = server.random_state.random() < server.failure_rate
+            if failed:
+                server.request_counts['failed'] += 1
+            elif "/layergroups" in self.path:
+                server.request_counts['layer_groups'] += 1
+            else:
+                server.request_counts['uploads'] += 1
+                server.request_counts['bytes'] += content_length
+        self.send_response(503 if failed else 201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_PUT = _handle
+    do_POST = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+def create_layer_group_rest(geoserver_url, layer_group_name, upload_list, timeout=60):
+    """
+    Creates the layer group with the uploaded layers on the stub GeoServer
+    """
+    layer_group = {'layerGroup': {'name': layer_group_name,
+                                  'layers': {'layer': [resource_name for resource_name, shapefile in upload_list]},
+                                  'styles': {'style': ['green' for upload in upload_list]}}}
+    request = Request("{0}/rest/workspaces/{1}/layergroups".format(geoserver_url, WORKSPACE),
+                      data=json.dumps(layer_group).encode('utf-8'),
+                      headers={'Content-type': 'application/json'})
+    response = urlopen(request, timeout=timeout)
+    response.read()
+    response.close()
+
+
+def generate_shapefiles(output_directory, num_watersheds, num_jobs, shapefile_size, seed):
+    """
+    Writes random bytes as the parts of the flood map shapefiles
+    (the publisher does not read them) and returns the upload jobs
+    """
+    random_state = random.Random(seed)
+    upload_job_list = []
+    for watershed_index in range(num_watersheds):
+        watershed = "watershed_{0}-sub".format(watershed_index)
+        for return_period in RETURN_PERIOD_LIST:
+            return_period_directory = os.path.join(output_directory, watershed, return_period)
+            os.makedirs(return_period_directory)
+            for job_index in range(num_jobs):
+                resource_name = "{0}-floodmap-{1}-{2}".format(watershed, return_period, job_index)
+                shapefile_base = os.path.join(return_period_directory, resource_name)
+                for extension, part_size in (('.shp', shapefile_size), ('.shx', shapefile_size // 50),
+                                             ('.dbf', shapefile_size // 20), ('.prj', 150)):
+                    with open(shapefile_base + extension, 'wb') as part_file:
+                        part_file.write(bytearray(random_state.getrandbits(8) for i in range(min(part_size, 4096))) \
+                                        * (part_size // 4096 + 1))
+                upload_job_list.append((watershed, return_period, resource_name, shapefile_base + ".shp"))
+    return upload_job_list
+
+
+def run_publish(geoserver_url, upload_job_list, num_threads, queue_size, max_retries, retry_delay):
+    """
+    Publishes all shapefiles by watershed as the SPT process does and
+    returns the time and the failed uploads
+    """
+    layer_group_list = []
+
+    def upload_function(resource_name, shapefile_list):
+        upload_shapefile_rest(geoserver_url, WORKSPACE, resource_name, shapefile_list)
+
+    def group_function(layer_group_name, upload_list):
+        create_layer_group_rest(geoserver_url, layer_group_name, upload_list)
+        layer_group_list.append(layer_group_name)
+
+    time_start = time()
+    shapefile_publisher = ShapefilePublisher(upload_function, group_function,
+                                             num_threads=num_threads,
+                                             max_queue_size=queue_size,
+                                             max_retries=max_retries,
+                                             retry_delay=retry_delay)
+    watershed_list = []
+    for watershed, return_period, resource_name, upload_shapefile in upload_job_list:
+        if watershed not in watershed_list:
+            if watershed_list:
+                for group_return_period in RETURN_PERIOD_LIST:
+                    shapefile_publisher.finish_group("{0}-floodmap-{1}".format(watershed_list[-1],
+                                                                               group_return_period))
+            watershed_list.append(watershed)
+        shapefile_publisher.submit("{0}-floodmap-{1}".format(watershed, return_period),
+                                   resource_name, upload_shapefile)
+    for group_return_period in RETURN_PERIOD_LIST:
+        shapefile_publisher.finish_group("{0}-floodmap-{1}".format(watershed_list[-1],
+                                                                   group_return_period))
+    failed_upload_list = shapefile_publisher.close()
+    return OrderedDict([('seconds', time() - time_start),
+                        ('uploads', shapefile_publisher.num_uploads),
+                        ('retries', shapefile_publisher.num_retries),
+                        ('failed', len(failed_upload_list)),
+                        ('layer_groups', len(layer_group_list))])
+
+
+def run_benchmark(output_directory, num_watersheds, num_jobs, shapefile_size, latency,
+                  failure_rate, num_threads_list, queue_size=16, max_retries=3,
+                  retry_delay=0.1, seed=0):
+    """
+    Times publishing the shapefiles with each number of upload threads
+    """
+    upload_job_list = generate_shapefiles(output_directory, num_watersheds, num_jobs,
+                                          shapefile_size, seed)
+    stub_geoserver = StubGeoServer(latency, failure_rate, seed)
+    server_thread = threading.Thread(target=stub_geoserver.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    thread_results = OrderedDict()
+    try:
+        for num_threads in num_threads_list:
+            thread_results[str(num_threads)] = run_publish(stub_geoserver.url, upload_job_list,
+                                                           num_threads, queue_size, max_retries,
+                                                           retry_delay)
+            thread_results[str(num_threads)]['shapefiles_per_second'] = \
+                len(upload_job_list) / max(thread_results[str(num_threads)]['seconds'], 1e-9)
+    finally:
+        stub_geoserver.shutdown()
+        stub_geoserver.server_close()
+
+    return OrderedDict([
+        ('benchmark', "publish"),
+        ('time', datetime.utcnow().isoformat()),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('parameters', OrderedDict([('num_watersheds', num_watersheds),
+                                    ('num_jobs', num_jobs),
+                                    ('shapefile_size', shapefile_size),
+                                    ('latency', latency),
+                                    ('failure_rate', failure_rate),
+                                    ('queue_size', queue_size),
+                                    ('max_retries', max_retries),
+                                    ('retry_delay', retry_delay),
+                                    ('seed', seed)])),
+        ('num_threads', thread_results),
+        ('server_requests', stub_geoserver.request_counts),
+    ])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--num-watersheds', type=int, default=4)
+    parser.add_argument('--num-jobs', type=int, default=10,
+                        help="shapefiles per watershed and return period")
+    parser.add_argument('--shapefile-size', type=int, default=500000,
+                        help="bytes in each .shp file")
+    parser.add_argument('--latency', type=float, default=0.2,
+                        help="seconds the stub GeoServer takes per request")
+    parser.add_argument('--failure-rate', type=float, default=0.05,
+                        help="fraction of the requests failed with 503")
+    parser.add_argument('--num-threads', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--queue-size', type=int, default=16)
+    parser.add_argument('--max-retries', type=int, default=3)
+    parser.add_argument('--retry-delay', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--results-directory', default=os.path.join(BENCHMARK_DIRECTORY, "results"))
+    args = parser.parse_args()
+
+    output_directory = mkdtemp()
+    try:
+        results = run_benchmark(output_directory, args.num_watersheds, args.num_jobs,
+                                args.shapefile_size, args.latency, args.failure_rate,
+                                args.num_threads, args.queue_size, args.max_retries,
+                                args.retry_delay, args.seed)
+    finally:
+        rmtree(output_directory)
+    try:
+        os.makedirs(args.results_directory)
+    except OSError:
+        pass
+    results_file = os.path.join(args.results_directory,
+                                "benchmark_publish_{0}.json".format(datetime.utcnow().strftime("%Y%m%d%H%M%S")))
+    with open(results_file, 'w') as results_handle:
+        json.dump(results, results_handle, indent=2)
+    print(json.dumps(results, indent=2))
+    print("Results saved to {0}".format(results_file))
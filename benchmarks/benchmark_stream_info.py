@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+##
+##  benchmark_stream_info.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License BSD 3-Clause
+"""
+Compares the CSV round trips previously used to append attributes to the
+stream info file with the binary stream info cache.
+
+Usage: python benchmark_stream_info.py [num_rows] [output_directory]
+"""
+import csv
+import json
+import os
+import sys
+from tempfile import mkdtemp
+from time import time
+
+import numpy as np
+from RAPIDpy.helper_functions import csv_to_list, open_csv
+
+from AutoRoutePy.prepare.stream_info import (create_stream_info_table,
+                                             read_stream_info_table,
+                                             sync_stream_info_text_file,
+                                             write_stream_info_table,
+                                             write_stream_info_text_file)
+
+
+def generate_stream_info_file(stream_info_file, num_rows, rows_per_river=50):
+    """
+    Writes a synthetic stream info file from the AutoRoute starter
+    """
+    stream_info_table = create_stream_info_table(num_rows)
+    stream_info_table['DEM_1D_Index'] = np.arange(num_rows)
+    stream_info_table['Row'] = np.arange(num_rows) // 1000
+    stream_info_table['Col'] = np.arange(num_rows) % 1000
+    stream_info_table['StreamID'] = 1000 + np.arange(num_rows) // rows_per_river
+    stream_info_table['StreamDirection'] = np.round(np.random.uniform(0, 3.14, num_rows), 6)
+    write_stream_info_text_file(stream_info_file, stream_info_table)
+
+
+def csv_round_trip(stream_info_file, value_column):
+    """
+    One append as previously done: parse the text file into lists
+    and write every row back out through a temporary file
+    """
+    stream_info_table = csv_to_list(stream_info_file, ", ")[1:]
+    temp_stream_info_file = "{0}_temp.txt".format(os.path.splitext(stream_info_file)[0])
+    with open_csv(temp_stream_info_file, 'w') as outfile:
+        writer = csv.writer(outfile, delimiter=" ")
+        writer.writerow([u"DEM_1D_Index", u"Row", u"Col", u"StreamID",
+                         u"StreamDirection", u"Slope", u"Flow"][:value_column+1])
+        for row in stream_info_table:
+            writer.writerow(row[:value_column] + [1.5] + row[value_column+1:])
+    os.remove(stream_info_file)
+    os.rename(temp_stream_info_file, stream_info_file)
+
+
+def cache_round_trip(stream_info_file, column_name):
+    """
+    One append with the binary stream info cache
+    """
+    stream_info_table = read_stream_info_table(stream_info_file)
+    stream_info_table[column_name] = 1.5
+    write_stream_info_table(stream_info_file, stream_info_table, write_text=False)
+
+
+def run_benchmark(num_rows, output_directory):
+    """
+    Times the slope and streamflow appends followed by the
+    text file required by the run stage
+    """
+    stream_info_file = os.path.join(output_directory, 'stream_info.txt')
+    results = {'num_rows': num_rows}
+
+    generate_stream_info_file(stream_info_file, num_rows)
+    time_start = time()
+    csv_round_trip(stream_info_file, 5)
+    csv_round_trip(stream_info_file, 6)
+    results['csv_seconds'] = time() - time_start
+
+    generate_stream_info_file(stream_info_file, num_rows)
+    time_start = time()
+    cache_round_trip(stream_info_file, 'Slope')
+    cache_round_trip(stream_info_file, 'Flow')
+    sync_stream_info_text_file(stream_info_file)
+    results['cache_seconds'] = time() - time_start
+
+    results['speedup'] = results['csv_seconds'] / results['cache_seconds']
+    return results
+
+
+if __name__ == "__main__":
+    num_rows = 3000000
+    if len(sys.argv) > 1:
+        num_rows = int(sys.argv[1])
+    output_directory = mkdtemp()
+    if len(sys.argv) > 2:
+        output_directory = sys.argv[2]
+    print(json.dumps(run_benchmark(num_rows, output_directory), indent=2))
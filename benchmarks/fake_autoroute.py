@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+##
+##  fake_autoroute.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License BSD 3-Clause
+"""
+Stand-in for the AutoRoute executable that reads and writes the same
+files so the prepare, run and post stages can be timed without it.
+The flood extent is the stream cells grown by a radius based on the flow.
+
+Usage (the same arguments as AutoRoute):
+    fake_autoroute.py stream_raster stream_info_file search_radius
+    fake_autoroute.py land_use_raster dem manning_n_table manning_n_raster default_manning_n
+    fake_autoroute.py autoroute_input_file
+"""
+import sys
+import warnings
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+STREAM_INFO_HEADER = "DEM_1D_Index Row Col StreamID StreamDirection"
+
+#largest number of cells the flood extends from a stream
+MAX_FLOOD_RADIUS = 5
+
+
+def create_raster_like(template_raster, raster_path, data_array, data_type, no_data_value=None):
+    """
+    Writes the array to a GeoTiff with the grid of the template raster
+    """
+    out_raster = gdal.GetDriverByName('GTiff').Create(raster_path,
+                                                      template_raster.RasterXSize,
+                                                      template_raster.RasterYSize,
+                                                      1, data_type)
+    out_raster.SetGeoTransform(template_raster.GetGeoTransform())
+    out_raster.SetProjection(template_raster.GetProjection())
+    out_band = out_raster.GetRasterBand(1)
+    if no_data_value is not None:
+        out_band.SetNoDataValue(no_data_value)
+    out_band.WriteArray(data_array)
+    out_band.FlushCache()
+    return out_raster
+
+
+def generate_stream_info_file(stream_raster_path, stream_info_file):
+    """
+    Writes a stream info file with a row for each stream cell
+    """
+    stream_raster = gdal.Open(stream_raster_path)
+    stream_array = stream_raster.GetRasterBand(1).ReadAsArray()
+    row_array, col_array = np.nonzero(stream_array > 0)
+    stream_info_array = np.column_stack([row_array * stream_array.shape[1] + col_array,
+                                         row_array,
+                                         col_array,
+                                         stream_array[row_array, col_array],
+                                         np.zeros(len(row_array))])
+    np.savetxt(stream_info_file, stream_info_array, fmt="%d %d %d %d %.6f",
+               header=STREAM_INFO_HEADER, comments="")
+
+
+def generate_manning_n_raster(elevation_dem_path, manning_n_raster_path, default_manning_n):
+    """
+    Writes a manning n raster on the DEM grid with the default value
+    """
+    elevation_raster = gdal.Open(elevation_dem_path)
+    manning_n_array = np.empty((elevation_raster.RasterYSize, elevation_raster.RasterXSize),
+                               dtype=np.float32)
+    manning_n_array.fill(float(default_manning_n))
+    create_raster_like(elevation_raster, manning_n_raster_path, manning_n_array,
+                       gdal.GDT_Float32)
+
+
+def run_simulation(autoroute_input_file):
+    """
+    Writes the flood map raster, depth raster and shapefile
+    requested in the AutoRoute input file
+    """
+    input_parameters = {}
+    with open(autoroute_input_file) as input_file:
+        for line in input_file:
+            line_split = line.split()
+            if len(line_split) > 1:
+                input_parameters[line_split[0]] = line_split[1]
+
+    elevation_raster = gdal.Open(input_parameters['dem_raster_file_path'])
+    elevation_array = elevation_raster.GetRasterBand(1).ReadAsArray()
+    with warnings.catch_warnings():
+        #tiles without streams have an empty stream info file
+        warnings.simplefilter("ignore")
+        stream_info_array = np.atleast_2d(np.loadtxt(input_parameters['stream_info_file_path'],
+                                                     skiprows=1))
+    if input_parameters.get('manning_n_raster_file_path'):
+        gdal.Open(input_parameters['manning_n_raster_file_path']).GetRasterBand(1).ReadAsArray()
+
+    #grow the stream cells by a radius that increases with the flow
+    flood_depth_array = np.zeros(elevation_array.shape, dtype=np.float32)
+    if stream_info_array.size > 0:
+        flow_array = stream_info_array[:, 6] if stream_info_array.shape[1] > 6 \
+            else np.ones(len(stream_info_array))
+        radius_array = np.minimum(MAX_FLOOD_RADIUS,
+                                  1 + np.log1p(np.maximum(flow_array, 0)).astype(int) // 2)
+        row_array = stream_info_array[:, 1].astype(int)
+        col_array = stream_info_array[:, 2].astype(int)
+        for radius in range(1, MAX_FLOOD_RADIUS + 1):
+            radius_index = radius_array >= radius
+            for row_offset in (-radius, 0, radius):
+                for col_offset in (-radius, 0, radius):
+                    flood_rows = np.clip(row_array[radius_index] + row_offset, 0, elevation_array.shape[0] - 1)
+                    flood_cols = np.clip(col_array[radius_index] + col_offset, 0, elevation_array.shape[1] - 1)
+                    flood_depth_array[flood_rows, flood_cols] = \
+                        np.maximum(flood_depth_array[flood_rows, flood_cols],
+                                   MAX_FLOOD_RADIUS + 1 - radius)
+
+    if input_parameters.get('out_flood_depth_raster_path'):
+        create_raster_like(elevation_raster, input_parameters['out_flood_depth_raster_path'],
+                           flood_depth_array, gdal.GDT_Float32, 0)
+
+    flood_map_path = input_parameters.get('out_flood_map_raster_path')
+    flood_shapefile_path = input_parameters.get('out_flood_map_shapefile_path')
+    if flood_map_path or flood_shapefile_path:
+        flood_map_array = (flood_depth_array > 0).astype(np.uint8)
+        if flood_map_path:
+            flood_map_raster = create_raster_like(elevation_raster, flood_map_path,
+                                                  flood_map_array, gdal.GDT_Byte, 0)
+        else:
+            flood_map_raster = create_raster_like(elevation_raster, '/vsimem/flood_map.tif',
+                                                  flood_map_array, gdal.GDT_Byte, 0)
+        if flood_shapefile_path:
+            spatial_reference = osr.SpatialReference()
+            spatial_reference.ImportFromWkt(elevation_raster.GetProjection())
+            shapefile = ogr.GetDriverByName('ESRI Shapefile').CreateDataSource(flood_shapefile_path)
+            layer = shapefile.CreateLayer('flood_map', spatial_reference, geom_type=ogr.wkbPolygon)
+            layer.CreateField(ogr.FieldDefn('value', ogr.OFTInteger))
+            flood_map_band = flood_map_raster.GetRasterBand(1)
+            gdal.Polygonize(flood_map_band, flood_map_band, layer, 0, [], callback=None)
+            shapefile = None
+
+
+def main(argv):
+    """
+    Runs the stand-in for the AutoRoute command line
+    """
+    #GDAL warnings on stderr would fail the run (errors still raise)
+    gdal.UseExceptions()
+    gdal.PushErrorHandler('CPLQuietErrorHandler')
+    if len(argv) == 3:
+        generate_stream_info_file(argv[0], argv[1])
+    elif len(argv) == 5:
+        generate_manning_n_raster(argv[1], argv[3], argv[4])
+    elif len(argv) == 1:
+        run_simulation(argv[0])
+    else:
+        sys.stderr.write("Invalid arguments: {0}\n".format(" ".join(argv)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -8,10 +8,35 @@
 ##
 
 from filecmp import cmp as fcmp
+import multiprocessing
 from nose.tools import raises, ok_
 import os
-from shutil import copy
+from shutil import copy, rmtree
+import stat
+import sys
+from time import time
 from AutoRoutePy import AutoRoute
+from AutoRoutePy.executable import run_executable
+from AutoRoutePy.ledger import JobLedger
+from AutoRoutePy.scheduling import MultiprocessPipeline
+from AutoRoutePy.run.worker_multiprocess import run_AutoRoute
+
+try:
+    from psutil import Process
+except ImportError:
+    Process = None
+
+#executable that copies the stream info file to the flood map
+#and counts the number of runs
+FAKE_AUTOROUTE_EXECUTABLE = """#!{0}
+import shutil
+import sys
+input_parameters = dict(line.split() for line in open(sys.argv[1]) if line.strip())
+shutil.copy(input_parameters['stream_info_file_path'],
+            input_parameters['out_flood_map_raster_path'])
+with open('run_count.txt', 'a') as run_count_file:
+    run_count_file.write('1')
+"""
 
 @raises(Exception)
 def test_generate_autoroute_input_file_invalid():
@@ -132,8 +157,156 @@ def test_update_autoroute_input_file():
         os.remove(out_var_input_file)
     except OSError:
         pass
+
+def test_run_autoroute_incremental():
+    """
+    Checks that an incremental run reuses the outputs of unchanged inputs
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    
+    original_data_path = os.path.join(main_tests_folder, 'original')
+    output_data_path = os.path.join(main_tests_folder, 'output')
+    input_directory = os.path.join(output_data_path, 'incremental')
+    os.makedirs(input_directory)
+    original_directory = os.getcwd()
+    try:
+        copy(os.path.join(original_data_path, 'elevation.asc'), input_directory)
+        stream_info_file = os.path.join(input_directory, 'stream_info.txt')
+        copy(os.path.join(original_data_path, 'stream_info.txt'), stream_info_file)
+        autoroute_executable = os.path.join(input_directory, 'fake_autoroute.py')
+        with open(autoroute_executable, 'w') as executable_file:
+            executable_file.write(FAKE_AUTOROUTE_EXECUTABLE.format(sys.executable))
+        os.chmod(autoroute_executable, os.stat(autoroute_executable).st_mode | stat.S_IEXEC)
+        out_flood_map_raster = os.path.join(input_directory, 'flood_map.tif')
+        run_count_file = os.path.join(input_directory, 'run_count.txt')
+
+        def run_count():
+            run_AutoRoute(autoroute_executable, None, input_directory,
+                          out_flood_map_raster, "", incremental=True)
+            with open(run_count_file) as run_count_handle:
+                return len(run_count_handle.read())
+
+        ok_(run_count() == 1)
+        ok_(run_count() == 1)
+        #changed streamflow
+        with open(stream_info_file, 'a') as stream_info_handle:
+            stream_info_handle.write("1 1 1 1\n")
+        ok_(run_count() == 2)
+        #missing output
+        os.remove(out_flood_map_raster)
+        ok_(run_count() == 3)
+        ok_(run_count() == 3)
+    finally:
+        os.chdir(original_directory)
+        rmtree(input_directory)
+
+def test_run_executable():
+    """
+    Checks running an executable with progress output
+    """
+    progress_list = []
+    executable_result = run_executable([sys.executable, "-c",
+                                        "print('Start'); print('50% done'); print('100 % done')"],
+                                       progress_callback=lambda percent, line: progress_list.append(percent))
+    ok_(progress_list == [50.0, 100.0])
+    ok_(executable_result.return_code == 0)
+    ok_(executable_result.wall_time > 0)
+
+@raises(Exception)
+def test_run_executable_error():
+    """
+    Checks that an executable writing to stderr raises an exception
+    """
+    run_executable([sys.executable, "-c", "import sys; sys.stderr.write('Bad input')"])
+
+def test_run_executable_timeout():
+    """
+    Checks that an executable running past the timeout is killed
+    """
+    time_start = time()
+    try:
+        run_executable([sys.executable, "-c", "import time; time.sleep(30)"],
+                       timeout=0.5)
+        ok_(False)
+    except Exception as ex:
+        ok_("timeout" in str(ex))
+    ok_(time() - time_start < 10)
+
+def test_run_autoroute_async():
+    """
+    Checks running AutoRoute simulations from the asyncio runner
+    """
+    try:
+        from AutoRoutePy.run.run_async import run_autoroute_async
+    except (ImportError, SyntaxError):
+        #python 3 only
+        return
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    
+    original_data_path = os.path.join(main_tests_folder, 'original')
+    output_data_path = os.path.join(main_tests_folder, 'output')
+    run_directory = os.path.join(output_data_path, 'async')
+    original_directory = os.getcwd()
+    try:
+        run_job_list = []
+        for job_index in range(3):
+            input_directory = os.path.join(run_directory, 'job{0}'.format(job_index))
+            os.makedirs(input_directory)
+            copy(os.path.join(original_data_path, 'elevation.asc'), input_directory)
+            copy(os.path.join(original_data_path, 'stream_info.txt'), input_directory)
+            autoroute_executable = os.path.join(input_directory, 'fake_autoroute.py')
+            with open(autoroute_executable, 'w') as executable_file:
+                executable_file.write(FAKE_AUTOROUTE_EXECUTABLE.format(sys.executable))
+            os.chmod(autoroute_executable, os.stat(autoroute_executable).st_mode | stat.S_IEXEC)
+            run_job_list.append((autoroute_executable, None, input_directory,
+                                 os.path.join(input_directory, 'flood_map.tif'),
+                                 "", "", False, 'job{0}'.format(job_index), run_directory,
+                                 "", "", False, None, ""))
+
+        with JobLedger(os.path.join(run_directory, 'job_ledger.sqlite')) as job_ledger:
+            job_output_list = []
+            original_stdout = sys.stdout
+            for job_output in run_autoroute_async(run_job_list, 2, job_ledger=job_ledger):
+                #the output of the caller is not redirected between jobs
+                ok_(sys.stdout is original_stdout)
+                job_output_list.append(job_output)
+            #the executables are measured as in the pool workers (with psutil)
+            job_memory_history = job_ledger.get_job_memory_history("AutoRoute simulation")
+        ok_(sorted(job_output[3] for job_output in job_output_list) == ['job0', 'job1', 'job2'])
+        for run_job in run_job_list:
+            ok_(fcmp(run_job[3], os.path.join(run_job[2], 'stream_info.txt')))
+        if Process is not None:
+            ok_(sorted(job_memory_history) == ['job0', 'job1', 'job2'])
+            ok_(min(job_memory_history.values()) > 0)
+
+        #jobs start when the pipeline job they wait on finishes
+        #and are not run if it fails
+        for run_job in run_job_list:
+            os.remove(run_job[3])
+        pool = multiprocessing.Pool(2)
+        try:
+            pipeline = MultiprocessPipeline(pool, 2)
+            pipeline.submit("Streamflow preparation", str, 'job1')
+            pipeline.submit("Streamflow preparation", int, 'job2')
+            job_output_list = []
+            try:
+                for job_output in run_autoroute_async(run_job_list[:1], 2, pipeline=pipeline,
+                                                      pipeline_run_job_lists={'job1': run_job_list[1:2],
+                                                                              'job2': run_job_list[2:]}):
+                    job_output_list.append(job_output)
+                ok_(False)
+            except Exception as ex:
+                ok_("Streamflow preparation job failed" in str(ex))
+        finally:
+            pool.terminate()
+            pool.join()
+        ok_(sorted(job_output[3] for job_output in job_output_list) == ['job0', 'job1'])
+        ok_(not os.path.exists(run_job_list[2][3]))
+    finally:
+        os.chdir(original_directory)
+        rmtree(run_directory)
+
         
 if __name__ == '__main__':
     import nose
     nose.main()
-
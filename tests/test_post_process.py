@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+##
+##  test_post_process.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##
+
+import multiprocessing
+from nose.tools import ok_
+import numpy as np
+import os
+from osgeo import gdal, ogr, osr
+from shutil import rmtree
+
+from AutoRoutePy.manifest import find_output_manifests, write_output_manifest
+from AutoRoutePy.post.post_process import (get_shapefile_layergroup_bounds,
+                                           imap_bounded,
+                                           merge_shapefiles,
+                                           mosaic_rasters,
+                                           polygonize_rasters,
+                                           stitch_tile_rasters)
+from AutoRoutePy.prepare.tile_dem import DEM_TILE_INDEX_FILE, tile_dem
+from AutoRoutePy.post.publish import ShapefilePublisher
+
+def _write_polygon_shapefile(shapefile_path, polygon_wkt_list, epsg_code=4326):
+    """
+    Writes a polygon shapefile for the merge tests
+    """
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.ImportFromEPSG(epsg_code)
+    shapefile = ogr.GetDriverByName('ESRI Shapefile').CreateDataSource(shapefile_path)
+    layer = shapefile.CreateLayer('flood_map', spatial_reference, geom_type=ogr.wkbPolygon)
+    for polygon_wkt in polygon_wkt_list:
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(ogr.CreateGeometryFromWkt(polygon_wkt))
+        layer.CreateFeature(feature)
+        feature = None
+    shapefile = None
+
+def test_merge_shapefiles():
+    """
+    Checks merging the shapefiles of the sub-basins with their attributes
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    merge_directory = os.path.join(main_tests_folder, 'output', 'merge')
+    os.makedirs(merge_directory)
+    try:
+        _write_polygon_shapefile(os.path.join(merge_directory, 'watershed_1.shp'),
+                                 ["POLYGON ((0 0,1 0,1 1,0 0))",
+                                  "POLYGON ((2 2,3 2,3 3,2 2))"])
+        _write_polygon_shapefile(os.path.join(merge_directory, 'watershed_2.shp'),
+                                 ["POLYGON ((5 5,6 5,6 6,5 5))"])
+
+        for out_file_name, num_cpus in (('merged.shp', 1), ('merged.gpkg', 2)):
+            out_file = os.path.join(main_tests_folder, 'output', out_file_name)
+            try:
+                num_features = merge_shapefiles(merge_directory, out_file,
+                                                num_cpus=num_cpus,
+                                                source_attributes={'return_per': 'return_period_20'})
+                ok_(num_features == 3)
+                merged = ogr.Open(out_file)
+                layer = merged.GetLayer()
+                ok_(layer.GetFeatureCount() == 3)
+                sub_basin_list = sorted(feature.GetField('sub_basin') for feature in layer)
+                ok_(sub_basin_list == ['watershed_1', 'watershed_1', 'watershed_2'])
+                layer.ResetReading()
+                ok_(layer.GetNextFeature().GetField('return_per') == 'return_period_20')
+                merged = None
+            finally:
+                ogr.GetDriverByName('GPKG' if out_file.endswith('.gpkg') else 'ESRI Shapefile').DeleteDataSource(out_file)
+    finally:
+        rmtree(merge_directory)
+
+def test_mosaic_rasters():
+    """
+    Checks the VRT and Cloud Optimized GeoTIFF of the sub-basin rasters
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    mosaic_directory = os.path.join(main_tests_folder, 'output', 'mosaic')
+    os.makedirs(mosaic_directory)
+    try:
+        spatial_reference = osr.SpatialReference()
+        spatial_reference.ImportFromEPSG(4326)
+        for sub_basin_index in range(2):
+            flood_raster = gdal.GetDriverByName('GTiff').Create(os.path.join(mosaic_directory,
+                                                                             'flood_map_raster_ws_{0}.tif'.format(sub_basin_index)),
+                                                                40, 30, 1, gdal.GDT_Byte)
+            flood_raster.SetGeoTransform((sub_basin_index * 40 * 0.01, 0.01, 0, 0, 0, -0.01))
+            flood_raster.SetProjection(spatial_reference.ExportToWkt())
+            flood_raster.GetRasterBand(1).SetNoDataValue(0)
+            flood_raster.GetRasterBand(1).WriteArray(np.full((30, 40), sub_basin_index + 1, dtype=np.uint8))
+            flood_raster = None
+
+        out_vrt_file = os.path.join(mosaic_directory, 'flood_map.vrt')
+        out_cog_file = os.path.join(mosaic_directory, 'flood_map.tif')
+        raster_list = mosaic_rasters(mosaic_directory, out_vrt_file, out_cog_file=out_cog_file,
+                                     num_cpus=2, block_size=16)
+        ok_(len(raster_list) == 2)
+        for mosaic_file in (out_vrt_file, out_cog_file):
+            mosaic = gdal.Open(mosaic_file)
+            ok_(mosaic.RasterXSize == 80 and mosaic.RasterYSize == 30)
+            mosaic_array = mosaic.GetRasterBand(1).ReadAsArray()
+            ok_((mosaic_array[:, :40] == 1).all() and (mosaic_array[:, 40:] == 2).all())
+        ok_(mosaic.GetRasterBand(1).GetOverviewCount() == 3)
+        ok_(mosaic.GetRasterBand(1).GetBlockSize() == [16, 16])
+        mosaic = None
+    finally:
+        rmtree(mosaic_directory)
+
+def test_polygonize_rasters():
+    """
+    Checks that polygons split by the blocks are dissolved
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    polygonize_directory = os.path.join(main_tests_folder, 'output', 'polygonize')
+    os.makedirs(polygonize_directory)
+    try:
+        spatial_reference = osr.SpatialReference()
+        spatial_reference.ImportFromEPSG(4326)
+        flood_array = np.zeros((30, 40), dtype=np.uint8)
+        #crosses the blocks
+        flood_array[5:25, 5:35] = 1
+        #inside one block
+        flood_array[27:29, 1:3] = 1
+        flood_raster = gdal.GetDriverByName('GTiff').Create(os.path.join(polygonize_directory,
+                                                                         'flood_map_raster_ws_sb.tif'),
+                                                            40, 30, 1, gdal.GDT_Byte)
+        flood_raster.SetGeoTransform((0, 0.01, 0, 0, 0, -0.01))
+        flood_raster.SetProjection(spatial_reference.ExportToWkt())
+        flood_raster.GetRasterBand(1).SetNoDataValue(0)
+        flood_raster.GetRasterBand(1).WriteArray(flood_array)
+        flood_raster = None
+
+        out_file_list = polygonize_rasters(polygonize_directory, num_cpus=2, block_size=16)
+        ok_(out_file_list == [os.path.join(polygonize_directory, 'ws_sb.shp')])
+        polygons = ogr.Open(out_file_list[0])
+        layer = polygons.GetLayer()
+        ok_(layer.GetFeatureCount() == 2)
+        area_list = sorted(round(feature.GetGeometryRef().GetArea() / 0.0001) for feature in layer)
+        ok_(area_list == [4, 600])
+        polygons = None
+    finally:
+        rmtree(polygonize_directory)
+
+def test_output_manifest():
+    """
+    Checks the output manifest and merging the shapefiles listed in it
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    manifest_directory = os.path.join(main_tests_folder, 'output', 'manifest')
+    os.makedirs(manifest_directory)
+    try:
+        spatial_reference = osr.SpatialReference()
+        spatial_reference.ImportFromEPSG(4326)
+        flood_map_raster = os.path.join(manifest_directory, 'flood_map_raster_ws_sb.tif')
+        flood_raster = gdal.GetDriverByName('GTiff').Create(flood_map_raster, 40, 30, 1, gdal.GDT_Byte)
+        flood_raster.SetGeoTransform((1, 0.01, 0, 2, 0, -0.01))
+        flood_raster.SetProjection(spatial_reference.ExportToWkt())
+        flood_raster.GetRasterBand(1).SetNoDataValue(0)
+        flood_array = np.zeros((30, 40), dtype=np.uint8)
+        flood_array[5:10, 5:15] = 1
+        flood_raster.GetRasterBand(1).WriteArray(flood_array)
+        flood_raster = None
+        shapefile = os.path.join(manifest_directory, 'ws_sb.shp')
+        _write_polygon_shapefile(shapefile, ["POLYGON ((0 0,1 0,1 1,0 0))",
+                                             "POLYGON ((2 2,3 2,3 3,2 2))"])
+        #listed in the manifest, but not in the directory
+        empty_shapefile = os.path.join(manifest_directory, 'empty', 'ws_empty.shp')
+        os.makedirs(os.path.dirname(empty_shapefile))
+        _write_polygon_shapefile(empty_shapefile, [])
+
+        output_manifest = write_output_manifest(os.path.join(manifest_directory, 'output_manifest_ws_sb.json'),
+                                                flood_map_raster=flood_map_raster,
+                                                shapefile=shapefile,
+                                                input_directory=manifest_directory)
+        write_output_manifest(os.path.join(manifest_directory, 'output_manifest_ws_empty.json'),
+                              shapefile=empty_shapefile)
+        raster_info = output_manifest['outputs']['flood_map']
+        ok_(raster_info['pixel_count'] == 1200 and raster_info['valid_pixel_count'] == 50)
+        ok_(np.allclose(raster_info['extent'], [1, 1.4, 1.7, 2]))
+        ok_(raster_info['epsg'] == "EPSG:4326")
+        shapefile_info = output_manifest['outputs']['shapefile']
+        ok_(shapefile_info['feature_count'] == 2)
+        ok_(set(['.dbf', '.prj', '.shp', '.shx']) <= set(os.path.splitext(part)[1] for part in shapefile_info['parts']))
+        ok_(shapefile_info['size'] == sum(os.path.getsize(part) for part in shapefile_info['parts']))
+
+        output_manifest_list = find_output_manifests(manifest_directory)
+        ok_(len(output_manifest_list) == 2)
+        ok_(get_shapefile_layergroup_bounds([shapefile]) == \
+            get_shapefile_layergroup_bounds(shapefile_info_list=[shapefile_info]))
+        out_file = os.path.join(manifest_directory, 'merged.gpkg')
+        ok_(merge_shapefiles(manifest_directory, out_file,
+                             output_manifest_list=output_manifest_list) == 2)
+    finally:
+        rmtree(manifest_directory)
+
+def test_tile_dem_stitch_tile_rasters():
+    """
+    Checks tiling a DEM with halos and stitching the tile rasters back
+    with the largest value where the halos overlap
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    tile_directory = os.path.join(main_tests_folder, 'output', 'tiles')
+    os.makedirs(tile_directory)
+    try:
+        spatial_reference = osr.SpatialReference()
+        spatial_reference.ImportFromEPSG(4326)
+        dem_file = os.path.join(tile_directory, 'dem.tif')
+        dem_raster = gdal.GetDriverByName('GTiff').Create(dem_file, 50, 40, 1, gdal.GDT_Float32)
+        dem_raster.SetGeoTransform((0, 0.01, 0, 0, 0, -0.01))
+        dem_raster.SetProjection(spatial_reference.ExportToWkt())
+        dem_raster.GetRasterBand(1).SetNoDataValue(-9999)
+        dem_array = np.arange(2000, dtype=np.float32).reshape((40, 50))
+        #no data outside of the halos
+        dem_array[26:, 31:] = -9999
+        dem_raster.GetRasterBand(1).WriteArray(dem_array)
+        dem_raster = None
+
+        watershed_folder = os.path.join(tile_directory, 'watershed')
+        tile_folder_list = tile_dem(dem_file, watershed_folder, target_tile_cells=25*25,
+                                    halo_cells=3, dem_extension="tif", num_cpus=2)
+        ok_(sorted(os.path.basename(tile_folder) for tile_folder in tile_folder_list) == \
+            ['tile_0_0', 'tile_0_1', 'tile_1_0', 'tile_1_1'])
+        tile_raster = gdal.Open(os.path.join(watershed_folder, 'tile_0_1', 'tile_0_1.tif'))
+        ok_(tile_raster.RasterXSize == 28 and tile_raster.RasterYSize == 23)
+        ok_(np.array_equal(tile_raster.GetRasterBand(1).ReadAsArray(), dem_array[:23, 22:]))
+        tile_raster = None
+
+        #the flood depth of each tile is its DEM plus the tile number
+        output_directory = os.path.join(tile_directory, 'output')
+        os.makedirs(output_directory)
+        for tile_number, tile_folder in enumerate(sorted(tile_folder_list)):
+            tile_raster = gdal.Open(os.path.join(tile_folder, "{0}.tif".format(os.path.basename(tile_folder))))
+            tile_array = tile_raster.GetRasterBand(1).ReadAsArray()
+            tile_array[tile_array != -9999] += tile_number
+            depth_raster = gdal.GetDriverByName('GTiff').CreateCopy(os.path.join(output_directory,
+                                                                                 'flood_depth_raster_watershed_{0}.tif'.format(os.path.basename(tile_folder))),
+                                                                    tile_raster)
+            depth_raster.GetRasterBand(1).WriteArray(tile_array)
+            depth_raster = None
+            tile_raster = None
+
+        out_raster_file = os.path.join(tile_directory, 'flood_depth.tif')
+        ok_(stitch_tile_rasters(os.path.join(watershed_folder, DEM_TILE_INDEX_FILE),
+                                output_directory, out_raster_file, raster_type='flood_depth',
+                                num_cpus=2) == 4)
+        out_raster = gdal.Open(out_raster_file)
+        ok_(out_raster.GetGeoTransform() == (0, 0.01, 0, 0, 0, -0.01))
+        out_array = out_raster.GetRasterBand(1).ReadAsArray()
+        out_raster = None
+        ok_(out_array[0, 0] == dem_array[0, 0])
+        #halo of tile_0_1 (number 1) over tile_0_0
+        ok_(out_array[0, 24] == dem_array[0, 24] + 1)
+        #halos of tile_1_0 (number 2) and tile_1_1 (number 3) over the tiles above
+        ok_(out_array[18, 10] == dem_array[18, 10] + 2)
+        ok_(out_array[19, 24] == dem_array[19, 24] + 3)
+        ok_(out_array[30, 10] == dem_array[30, 10] + 2)
+        ok_((out_array[26:, 31:] == -9999).all())
+    finally:
+        rmtree(tile_directory)
+
+def test_shapefile_publisher():
+    """
+    Checks that failed uploads are retried and the layer groups
+    are created once all of their uploads are done
+    """
+    attempt_counts = {}
+    group_uploads = {}
+    def upload_function(resource_name, shapefile_list):
+        attempt_counts[resource_name] = attempt_counts.get(resource_name, 0) + 1
+        if resource_name.endswith('-1') and attempt_counts[resource_name] < 3:
+            raise IOError("503 Service Unavailable")
+        if resource_name.endswith('-2'):
+            raise IOError("500 Internal Server Error")
+    def group_function(group_name, upload_list):
+        group_uploads[group_name] = sorted(upload_list)
+
+    shapefile_publisher = ShapefilePublisher(upload_function, group_function, num_threads=3,
+                                             max_queue_size=2, max_retries=2, retry_delay=0.01)
+    for job_index in range(4):
+        resource_name = "ws-floodmap-return_period_20-{0}".format(job_index)
+        shapefile_publisher.submit("ws-floodmap-return_period_20", resource_name,
+                                   "{0}.shp".format(resource_name), [])
+    ok_(not group_uploads)
+    shapefile_publisher.finish_group("ws-floodmap-return_period_20")
+    shapefile_publisher.finish_group("ws-floodmap-return_period_10")
+    failed_upload_list = shapefile_publisher.close()
+
+    ok_(attempt_counts["ws-floodmap-return_period_20-1"] == 3)
+    ok_(attempt_counts["ws-floodmap-return_period_20-2"] == 3)
+    ok_(failed_upload_list == [("ws-floodmap-return_period_20-2", "500 Internal Server Error")])
+    ok_(shapefile_publisher.num_uploads == 3)
+    ok_([resource_name for resource_name, shapefile in group_uploads["ws-floodmap-return_period_20"]] == \
+        ["ws-floodmap-return_period_20-0", "ws-floodmap-return_period_20-1", "ws-floodmap-return_period_20-3"])
+    ok_(group_uploads["ws-floodmap-return_period_10"] == [])
+
+def test_get_shapefile_layergroup_bounds_mixed_epsg():
+    """
+    Checks that shapefiles with different or unknown projections
+    do not fail the layer group bounds
+    """
+    bounds = get_shapefile_layergroup_bounds(shapefile_info_list=[
+                                             {'extent': [0, 1, 2, 3], 'epsg': None},
+                                             {'extent': None, 'epsg': "EPSG:4326"},
+                                             {'extent': [-1, 0.5, 2.5, 4], 'epsg': "EPSG:4326"}])
+    ok_(bounds == ['-1', '1', '2', '4', "EPSG:None"])
+
+def test_imap_bounded():
+    """
+    Checks that the jobs return in order with a bounded number
+    sent to the pool at once
+    """
+    pool = multiprocessing.Pool(2)
+    try:
+        ok_(list(imap_bounded(pool, abs, range(0, -20, -1), 3)) == list(range(20)))
+        ok_(list(imap_bounded(pool, abs, [], 3)) == [])
+    finally:
+        pool.close()
+        pool.join()
@@ -8,13 +8,37 @@
 ##
 
 from filecmp import cmp as fcmp
+from glob import glob
+import multiprocessing
+from netCDF4 import Dataset
 from nose.tools import ok_
+import numpy as np
 import numpy.testing as npt
 import os
 from osgeo import gdal
-from shutil import copy
+from shutil import copy, rmtree
 
 from AutoRoutePy.prepare import AutoRoutePrepare
+from AutoRoutePy.prepare.partition_streams import StreamNetworkIndex, rtree_index
+from AutoRoutePy.prepare.prepare import StreamIDIndex
+from AutoRoutePy.prepare.prepare_multiprocess import (prepare_autoroute_streamflow_multiprocess_worker,
+                                                      prepare_autoroute_streamflow_single_folder,
+                                                      rename_elevation_dem)
+from AutoRoutePy.prepare.stream_info import (create_stream_info_table,
+                                             get_stream_info_scenario_file,
+                                             read_stream_info_table,
+                                             read_stream_info_text_file,
+                                             sync_stream_info_text_file,
+                                             write_stream_info_table)
+from AutoRoutePy.prepare.tile_dem import get_tile_windows
+from AutoRoutePy.prepare.streamflow import (DEFAULT_MAX_MEMORY_BYTES,
+                                            get_ecmwf_streamflow,
+                                            get_ensemble_statistic,
+                                            get_peak_flow,
+                                            get_return_period_flow,
+                                            get_river_index_list,
+                                            read_ecmwf_ensemble,
+                                            read_return_period_flow)
 
 def test_rasterize_stream_shapefile():
     """
@@ -83,7 +107,308 @@ def test_append_slope_to_stream_info_file():
         pass
 
 
+def test_stream_id_index():
+    """
+    Checks grouping stream info rows by stream id
+    """
+    streamid_index = StreamIDIndex([5, 3, 5, 9, 3, 3, 7])
+
+    npt.assert_array_equal(streamid_index.streamid_list_unique, [3, 5, 7, 9])
+    npt.assert_array_equal(streamid_index.row_order, [1, 4, 5, 0, 2, 6, 3])
+    npt.assert_array_equal(streamid_index.expand([1, 2, 3, 4]), [2, 1, 2, 4, 1, 1, 3])
+    npt.assert_array_equal(streamid_index.get_unique_index([9, 1, 3, 100]), [3, -1, 0, -1])
+
+    row_index_list, source_index_list = streamid_index.get_rows_for_streamids([3, 1, 5, 9, 3])
+    npt.assert_array_equal(row_index_list, [1, 4, 5, 0, 2, 3, 1, 4, 5])
+    npt.assert_array_equal(source_index_list, [0, 0, 0, 2, 2, 3, 4, 4, 4])
+
+def test_stream_info_cache():
+    """
+    Checks writing the stream info text file from the binary cache
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    
+    original_data_path = os.path.join(main_tests_folder, 'original')
+    output_data_path = os.path.join(main_tests_folder, 'output')
+
+    stream_info_file = os.path.join(output_data_path, 'stream_info.txt')
+    stream_info_cache_file = os.path.join(output_data_path, 'stream_info.npz')
+    copy(os.path.join(original_data_path, 'stream_info.txt'), stream_info_file)
+
+    stream_info_table = read_stream_info_table(stream_info_file)
+    ok_(len(stream_info_table) == 764)
+    stream_info_table['Slope'] = 0.00015936
+    stream_info_table['Slope'][stream_info_table['StreamID'] == 18469764] = 0.00028688
+    write_stream_info_table(stream_info_file, stream_info_table, write_text=False)
+    #text file is only updated when synced
+    ok_(fcmp(os.path.join(original_data_path, 'stream_info.txt'), stream_info_file))
+    npt.assert_array_equal(read_stream_info_table(stream_info_file)['Slope'],
+                           stream_info_table['Slope'])
+
+    sync_stream_info_text_file(stream_info_file)
+    solution_table = read_stream_info_table(os.path.join(original_data_path,
+                                                         'stream_info_solution.txt'))
+    synced_table = read_stream_info_table(stream_info_file)
+    npt.assert_array_equal(synced_table['Slope'], stream_info_table['Slope'])
+    npt.assert_array_equal(synced_table['DEM_1D_Index'], stream_info_table['DEM_1D_Index'])
+    npt.assert_array_equal(solution_table['Slope'][solution_table['StreamID'] == 18469766],
+                           synced_table['Slope'][synced_table['StreamID'] == 18469766])
+
+    for remove_file in (stream_info_file, stream_info_cache_file):
+        try:
+            os.remove(remove_file)
+        except OSError:
+            pass
+
+def test_get_peak_flow():
+    """
+    Checks streaming the peak flow from a RAPID Qout file
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    output_data_path = os.path.join(main_tests_folder, 'output')
+
+    qout_file = os.path.join(output_data_path, 'Qout_peak_flow.nc')
+    river_id_array = np.arange(50) * 3 + 100
+    streamflow_array = np.random.rand(40, 50)
+    qout_nc = Dataset(qout_file, 'w')
+    qout_nc.createDimension('time', 40)
+    qout_nc.createDimension('rivid', 50)
+    qout_nc.createVariable('rivid', 'i4', ('rivid',))[:] = river_id_array
+    qout_nc.createVariable('Qout', 'f8', ('time', 'rivid'))[:] = streamflow_array
+    qout_nc.close()
+
+    river_id_list = [103, 5, 100 + 3*49, 100 + 3*20]
+    river_index_list = get_river_index_list(river_id_array, river_id_list)
+    npt.assert_array_equal(river_index_list, [1, -1, 49, 20])
+
+    #memory limit forces reading a few time steps at a time
+    for max_memory_bytes in (100, 1000, 1e9):
+        peak_flow_list, peak_time_index_list = get_peak_flow(qout_file,
+                                                             river_id_list,
+                                                             max_memory_bytes=max_memory_bytes,
+                                                             return_peak_time_index=True)
+        npt.assert_almost_equal(peak_flow_list, [streamflow_array[:, 1].max(), 0,
+                                                 streamflow_array[:, 49].max(),
+                                                 streamflow_array[:, 20].max()])
+        npt.assert_array_equal(peak_time_index_list, [streamflow_array[:, 1].argmax(), -1,
+                                                      streamflow_array[:, 49].argmax(),
+                                                      streamflow_array[:, 20].argmax()])
+
+    try:
+        os.remove(qout_file)
+    except OSError:
+        pass
+
+def test_return_period_flow():
+    """
+    Checks looking up the return period flow
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    output_data_path = os.path.join(main_tests_folder, 'output')
+
+    return_period_file = os.path.join(output_data_path, 'return_periods_test.nc')
+    return_period_nc = Dataset(return_period_file, 'w')
+    return_period_nc.createDimension('rivid', 4)
+    return_period_nc.createVariable('rivid', 'i4', ('rivid',))[:] = [40, 10, 30, 20]
+    return_period_nc.createVariable('return_period_20', 'f8', ('rivid',))[:] = [4.0, 1.0, 3.0, 2.0]
+    return_period_nc.createVariable('return_period_10', 'f8', ('rivid',))[:] = [8.0, 5.0, 7.0, 6.0]
+    return_period_nc.close()
+
+    return_period_river_id_array, return_period_flow_array = \
+        read_return_period_flow(return_period_file, 'return_period_20')
+    npt.assert_almost_equal(get_return_period_flow([20, 5, 40, 10],
+                                                   return_period_river_id_array,
+                                                   return_period_flow_array),
+                            [2.0, 0, 4.0, 1.0])
+
+    #one stream info file for each return period
+    stream_info_file = os.path.join(output_data_path, 'stream_info_scenarios.txt')
+    stream_info_table = create_stream_info_table(3)
+    stream_info_table['StreamID'] = [20, 20, 5]
+    write_stream_info_table(stream_info_file, stream_info_table)
+    prepare_autoroute_streamflow_single_folder(2, output_data_path, stream_info_file, "",
+                                               return_period_file,
+                                               ['return_period_20', 'return_period_10'],
+                                               "", None, None, 'COMID', "", "")
+    for return_period, flow_list in (('return_period_20', [2.0, 2.0, 0]),
+                                     ('return_period_10', [6.0, 6.0, 0])):
+        scenario_stream_info_file = get_stream_info_scenario_file(stream_info_file, return_period)
+        npt.assert_almost_equal(read_stream_info_text_file(scenario_stream_info_file)['Flow'],
+                                flow_list)
+    ok_(np.isnan(read_stream_info_text_file(stream_info_file)['Flow']).all())
+
+    for remove_file in glob(os.path.join(output_data_path, 'stream_info_scenarios*')) \
+                       + [return_period_file]:
+        try:
+            os.remove(remove_file)
+        except OSError:
+            pass
+
+def test_prepare_streamflow_worker_text_file():
+    """
+    Checks that the streamflow worker only writes the flow to the
+    stream info text file when asked to (i.e. for HTCondor)
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    output_data_path = os.path.join(main_tests_folder, 'output')
+
+    return_period_file = os.path.join(output_data_path, 'return_periods_worker.nc')
+    return_period_nc = Dataset(return_period_file, 'w')
+    return_period_nc.createDimension('rivid', 2)
+    return_period_nc.createVariable('rivid', 'i4', ('rivid',))[:] = [10, 20]
+    return_period_nc.createVariable('return_period_20', 'f8', ('rivid',))[:] = [1.0, 2.0]
+    return_period_nc.close()
+
+    stream_info_file = os.path.join(output_data_path, 'stream_info_worker.txt')
+    for write_stream_info_text in (False, True):
+        stream_info_table = create_stream_info_table(3)
+        stream_info_table['StreamID'] = [20, 20, 10]
+        write_stream_info_table(stream_info_file, stream_info_table)
+        prepare_autoroute_streamflow_multiprocess_worker((2, output_data_path, stream_info_file, "",
+                                                          return_period_file, 'return_period_20',
+                                                          "", None, None, 'COMID', "", "",
+                                                          "worker_test", output_data_path,
+                                                          DEFAULT_MAX_MEMORY_BYTES, None,
+                                                          write_stream_info_text))
+        text_flow_array = read_stream_info_text_file(stream_info_file)['Flow']
+        if write_stream_info_text:
+            npt.assert_almost_equal(text_flow_array, [2.0, 2.0, 1.0])
+        else:
+            ok_(np.isnan(text_flow_array).all())
+        npt.assert_almost_equal(read_stream_info_table(stream_info_file)['Flow'], [2.0, 2.0, 1.0])
+
+    for remove_file in glob(os.path.join(output_data_path, 'stream_info_worker*')) \
+                       + glob(os.path.join(output_data_path, 'worker_test-*.log')) \
+                       + [return_period_file]:
+        try:
+            os.remove(remove_file)
+        except OSError:
+            pass
+
+def test_ecmwf_ensemble_statistic():
+    """
+    Checks the ECMWF ensemble statistics with the high resolution member
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    output_data_path = os.path.join(main_tests_folder, 'output')
+
+    river_id_array = np.array([10, 20, 30])
+    low_res_array = np.random.rand(2, 3, 61)
+    high_res_array = np.random.rand(3, 125)
+    prediction_files = []
+    for ensemble_index, streamflow_array in ((1, low_res_array[0]),
+                                             (2, low_res_array[1]),
+                                             (52, high_res_array)):
+        prediction_file = os.path.join(output_data_path,
+                                       'Qout_test_{0}.nc'.format(ensemble_index))
+        qout_nc = Dataset(prediction_file, 'w')
+        qout_nc.createDimension('time', streamflow_array.shape[1])
+        qout_nc.createDimension('rivid', 3)
+        qout_nc.createVariable('rivid', 'i4', ('rivid',))[:] = river_id_array
+        qout_nc.createVariable('Qout', 'f8', ('rivid', 'time'))[:] = streamflow_array
+        qout_nc.close()
+        prediction_files.append(prediction_file)
+
+    ensemble_array = read_ecmwf_ensemble(prediction_files, [30, 5, 10])
+    ok_(ensemble_array.shape == (3, 3, 61))
+    npt.assert_almost_equal(ensemble_array[0, 0], low_res_array[0, 2])
+    ok_(np.isnan(ensemble_array[1]).all())
+    high_res_series = np.concatenate([high_res_array[0, :90:6],
+                                      high_res_array[0, 90:109:2],
+                                      high_res_array[0, 109:]])
+    npt.assert_almost_equal(ensemble_array[2, 2, :41], high_res_series)
+    ok_(np.isnan(ensemble_array[2, 2, 41:]).all())
+
+    series = np.concatenate([np.vstack([low_res_array[:, 0, :41], high_res_series]).mean(axis=0),
+                             low_res_array[:, 0, 41:].mean(axis=0)])
+    npt.assert_almost_equal(get_ensemble_statistic(ensemble_array, 'mean', 'max'),
+                            [np.nanmean(ensemble_array[0], axis=0).max(), 0, series.max()])
+    series_max = np.concatenate([np.vstack([low_res_array[:, 0, :41], high_res_series]).max(axis=0),
+                                 low_res_array[:, 0, 41:].max(axis=0)])
+    npt.assert_almost_equal(get_ensemble_statistic(ensemble_array, 'max', 'mean_plus_std'),
+                            [np.nanmax(ensemble_array[0], axis=0).mean() + \
+                             np.nanmax(ensemble_array[0], axis=0).std(),
+                             0, series_max.mean() + series_max.std()])
+
+    #read in blocks of rivers and in parallel
+    pool = multiprocessing.Pool(2)
+    for max_memory_bytes, member_pool in ((1, None), (1e9, pool)):
+        npt.assert_almost_equal(get_ecmwf_streamflow(prediction_files, [30, 5, 10], 'mean', 'max',
+                                                     pool=member_pool,
+                                                     max_memory_bytes=max_memory_bytes),
+                                get_ensemble_statistic(ensemble_array, 'mean', 'max'))
+    pool.close()
+    pool.join()
+
+    for prediction_file in prediction_files:
+        try:
+            os.remove(prediction_file)
+        except OSError:
+            pass
+
+def test_rename_elevation_dem():
+    """
+    Checks renaming the DEM to elevation can be run again after it was interrupted
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    original_data_path = os.path.join(main_tests_folder, 'original')
+    sub_folder = os.path.join(main_tests_folder, 'output', 'rename.dem')
+    os.makedirs(sub_folder)
+    try:
+        for dem_file in ('elevation.asc', 'elevation.prj', 'elevation.asc.aux.xml'):
+            copy(os.path.join(original_data_path, dem_file),
+                 os.path.join(sub_folder, dem_file.replace('elevation', 'dem_30m')))
+        #interrupted after renaming the projection file
+        os.rename(os.path.join(sub_folder, 'dem_30m.prj'),
+                  os.path.join(sub_folder, 'elevation.prj'))
+
+        elevation_dem_file = rename_elevation_dem(sub_folder, 'asc')
+        ok_(elevation_dem_file == os.path.join(sub_folder, 'elevation.asc'))
+        ok_(sorted(os.listdir(sub_folder)) == ['elevation.asc', 'elevation.asc.aux.xml', 'elevation.prj'])
+        ok_(rename_elevation_dem(sub_folder, 'asc') == elevation_dem_file)
+        ok_(fcmp(elevation_dem_file, os.path.join(original_data_path, 'elevation.asc')))
+    finally:
+        rmtree(sub_folder)
+
+def test_get_tile_windows():
+    """
+    Checks that the tiles cover the grid once and the halos overlap
+    """
+    tile_window_list = get_tile_windows(1000, 450, target_tile_cells=200*200, halo_cells=7)
+    ok_(len(tile_window_list) == 5 * 3)
+    coverage_array = np.zeros((450, 1000), dtype=int)
+    halo_coverage_array = np.zeros((450, 1000), dtype=int)
+    for tile_row, tile_col, core_window, halo_window in tile_window_list:
+        x_offset, y_offset, x_size, y_size = core_window
+        ok_(x_size == 200 and y_size == 150)
+        coverage_array[y_offset:y_offset + y_size, x_offset:x_offset + x_size] += 1
+        halo_x_offset, halo_y_offset, halo_x_size, halo_y_size = halo_window
+        ok_(halo_x_offset == max(0, x_offset - 7) and halo_y_offset == max(0, y_offset - 7))
+        ok_(halo_x_offset + halo_x_size == min(1000, x_offset + x_size + 7))
+        halo_coverage_array[halo_y_offset:halo_y_offset + halo_y_size,
+                            halo_x_offset:halo_x_offset + halo_x_size] += 1
+    ok_((coverage_array == 1).all())
+    #cells near an inside edge are in the halo of the neighbor
+    ok_(halo_coverage_array[0, 195] == 2 and halo_coverage_array[145, 195] == 4)
+    ok_(get_tile_windows(10, 10, target_tile_cells=1000)[0][2:] == ((0, 0, 10, 10), (0, 0, 10, 10)))
+
+def test_stream_network_index():
+    """
+    Checks that the reaches with a bounding box on the tile are found
+    with and without rtree
+    """
+    #envelopes are (min x, max x, min y, max y)
+    envelope_list = [(0, 1, 0, 1), (2, 3, 2, 3), (0.5, 2.5, 0.5, 0.6), (5, 6, -1, 0), (-3, -2, -3, -2)]
+    fid_list = [10, 11, 12, 13, 14]
+    use_rtree_list = [False, True] if rtree_index is not None else [False]
+    for use_rtree in use_rtree_list:
+        stream_network_index = StreamNetworkIndex(fid_list, envelope_list, use_rtree)
+        npt.assert_array_equal(stream_network_index.query((0.8, 2.1, 0.2, 2.0)), [10, 11, 12])
+        npt.assert_array_equal(stream_network_index.query((4, 7, -0.5, 0.5)), [13])
+        npt.assert_array_equal(stream_network_index.query((10, 11, 10, 11)), [])
+    ok_(len(StreamNetworkIndex([], []).query((0, 1, 0, 1))) == 0)
+
         
 if __name__ == '__main__':
     import nose
-    nose.main()
\ No newline at end of file
+    nose.main()
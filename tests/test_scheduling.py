@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+##
+##  test_scheduling.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##
+
+import multiprocessing
+from nose.tools import ok_, raises
+import os
+import sys
+from time import sleep, time
+
+from AutoRoutePy.checkpoint import JobCheckpoint
+from AutoRoutePy.instrumentation import (INSTRUMENTATION_EVENTS_FILE_ENV,
+                                         disable_instrumentation,
+                                         enable_instrumentation,
+                                         is_instrumentation_enabled,
+                                         read_events,
+                                         span,
+                                         write_prometheus_textfile)
+from AutoRoutePy.ledger import JobLedger
+from AutoRoutePy.run.run_multiprocess import run_autoroute_multiprocess
+from AutoRoutePy.scheduling import (JobBudget,
+                                    JobResourceMonitor,
+                                    MultiprocessPipeline,
+                                    get_job_cost_list,
+                                    get_job_order)
+
+def _square(value):
+    """
+    Pipeline test job
+    """
+    if value < 0:
+        raise ValueError("negative value")
+    return value * value
+
+def _unpicklable_result(value):
+    """
+    Pipeline test job with a result that cannot be sent back
+    """
+    return lambda: value
+
+def _timed_sleep(seconds):
+    """
+    Pipeline test job returning when it started and ended
+    """
+    time_start = time()
+    sleep(seconds)
+    return time_start, time()
+
+def test_job_order():
+    """
+    Checks ordering jobs with the largest first
+    """
+    estimated_cost_list = [10, 40, 20, 40]
+    ok_(get_job_order(estimated_cost_list) == [0, 1, 2, 3])
+    ok_(get_job_order(estimated_cost_list, "largest_first") == [1, 3, 2, 0])
+
+    #historical runtimes are used where available
+    job_cost_list = get_job_cost_list(['a', 'b', 'c', 'd'], estimated_cost_list,
+                                      {'b': 4.0, 'c': 100.0})
+    ok_(job_cost_list[1] == 4.0 and job_cost_list[2] == 100.0)
+    ok_(get_job_order(job_cost_list, "largest_first") == [3, 2, 0, 1])
+
+@raises(Exception)
+def test_job_order_invalid():
+    """
+    Checks an invalid job order
+    """
+    get_job_order([1, 2], "smallest_first")
+
+def test_multiprocess_pipeline():
+    """
+    Checks that jobs are submitted after the job they depend on
+    """
+    pool = multiprocessing.Pool(2)
+    pipeline = MultiprocessPipeline(pool, 2)
+    for value in range(3):
+        pipeline.submit("first", _square, value,
+                        [("second", _square, value + 10)])
+    results = list(pipeline.results())
+    pool.close()
+    pool.join()
+
+    ok_(sorted(job_output for stage_name, job_output in results \
+               if stage_name == "first") == [0, 1, 4])
+    ok_(sorted(job_output for stage_name, job_output in results \
+               if stage_name == "second") == [100, 121, 144])
+    #each second stage job comes after its first stage job
+    for value in range(3):
+        ok_(results.index(("first", value * value)) < results.index(("second", (value + 10)**2)))
+    pipeline.print_report()
+
+@raises(Exception)
+def test_multiprocess_pipeline_failure():
+    """
+    Checks that a failed job raises an exception
+    """
+    pool = multiprocessing.Pool(1)
+    pipeline = MultiprocessPipeline(pool, 1)
+    pipeline.submit("first", _square, -1, [("second", _square, 1)])
+    try:
+        list(pipeline.results())
+    finally:
+        pool.terminate()
+
+def test_multiprocess_pipeline_unpicklable_result():
+    """
+    Checks that a job with a result that cannot be pickled fails
+    instead of leaving the results waiting
+    """
+    if sys.version_info[0] < 3:
+        #no error callback in python 2
+        return
+    pool = multiprocessing.Pool(1)
+    pipeline = MultiprocessPipeline(pool, 1)
+    pipeline.submit("first", _unpicklable_result, 1, [("second", _square, 2)])
+    try:
+        list(pipeline.results())
+        ok_(False)
+    except Exception as ex:
+        ok_("first job failed" in str(ex))
+    finally:
+        pool.terminate()
+    ok_(pipeline.is_finished())
+
+def test_multiprocess_pipeline_memory_budget():
+    """
+    Checks that jobs only run together when they fit in the memory budget
+    """
+    pool = multiprocessing.Pool(3)
+    pipeline = MultiprocessPipeline(pool, 3, memory_budget=100)
+    #the large job does not fit in the budget, so it runs alone
+    for stage_name, job_memory in (("a", 60), ("b", 60), ("large", 150), ("c", 30), ("d", 30)):
+        pipeline.submit(stage_name, _timed_sleep, 0.2, job_memory=job_memory)
+    results = dict(pipeline.results())
+    pool.close()
+    pool.join()
+
+    ok_(len(results) == 5)
+    def overlap(first_job, second_job):
+        return results[first_job][0] < results[second_job][1] and \
+               results[second_job][0] < results[first_job][1]
+    ok_(not overlap("a", "b"))
+    ok_(not overlap("b", "large"))
+    ok_(not overlap("large", "c"))
+    #small jobs share the budget
+    ok_(overlap("c", "d"))
+    pipeline.print_report()
+
+def test_multiprocess_pipeline_shared_job_budget():
+    """
+    Checks that pipelines sharing a job budget do not run more jobs
+    together than the cpus or the memory budget allow
+    """
+    job_budget = JobBudget(2, memory_budget=100)
+    pool_list = [multiprocessing.Pool(2), multiprocessing.Pool(2)]
+    pipeline_list = [MultiprocessPipeline(pool, 2, job_budget=job_budget) for pool in pool_list]
+    for job_index in range(3):
+        pipeline_list[0].submit("a{0}".format(job_index), _timed_sleep, 0.2, job_memory=40)
+        pipeline_list[1].submit("b{0}".format(job_index), _timed_sleep, 0.2, job_memory=40)
+    results = {}
+    for pipeline in pipeline_list:
+        results.update(dict(pipeline.results()))
+    for pool in pool_list:
+        pool.close()
+        pool.join()
+
+    ok_(len(results) == 6)
+    #at most two jobs (80 of the 100 memory budget) run at any time
+    for job_start, job_end in results.values():
+        num_running = len([other_start for other_start, other_end in results.values() \
+                           if other_start <= job_start < other_end])
+        ok_(num_running <= 2)
+    ok_(job_budget.max_memory_admitted == 80)
+    ok_(job_budget.num_admitted == 0)
+
+def test_job_resource_monitor():
+    """
+    Checks that the peak memory of a job does not include the memory
+    the process had before the job
+    """
+    worker_memory = bytearray(b"x") * (200 * 1024 * 1024)
+    with JobResourceMonitor(sample_interval=0.05) as job_resources:
+        job_memory = bytearray(b"x") * (50 * 1024 * 1024)
+        sleep(0.2)
+    if job_resources.peak_memory is None:
+        #psutil not installed
+        return
+    ok_(50 * 1024 * 1024 <= job_resources.peak_memory < 150 * 1024 * 1024)
+    del worker_memory, job_memory
+
+def test_job_ledger():
+    """
+    Checks recording jobs in the ledger and planning from their history
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    ledger_file = os.path.join(main_tests_folder, 'output', 'job_ledger.sqlite')
+    try:
+        with JobLedger(ledger_file) as job_ledger:
+            for job_name, wall_time, peak_memory in (('a', 10, 100), ('a', 30, 300),
+                                                     ('a', 20, 200), ('b', 5, 50)):
+                job_ledger.record_job("AutoRoute simulation", job_name, 0, wall_time,
+                                      peak_memory=peak_memory)
+            job_ledger.record_job("AutoRoute simulation", 'b', 0, 500,
+                                  status="failed", error="ERROR")
+
+        with JobLedger(ledger_file) as job_ledger:
+            #failed jobs are not part of the history
+            ok_(job_ledger.get_job_runtime_history("AutoRoute simulation") == {'a': 20.0, 'b': 5.0})
+            ok_(job_ledger.get_job_memory_history("AutoRoute simulation") == {'a': 300, 'b': 50})
+            ok_(job_ledger.get_job_runtime_history("AutoRoute prepare") == {})
+
+            #job c is scaled from its cost with the seconds per cost of a and b
+            job_plan = job_ledger.plan("AutoRoute simulation", ['a', 'b', 'c'], 2,
+                                       estimated_cost_list=[20, 5, 40],
+                                       estimated_memory_list=[0, 0, 1000])
+            ok_(job_plan['busy_time'] == 65.0)
+            ok_(job_plan['wall_time'] == 40.0)
+            ok_(job_plan['peak_memory'] == 1300)
+            ok_(job_plan['num_jobs_with_history'] == 2)
+
+            #the pipeline records the jobs with job info
+            pool = multiprocessing.Pool(1)
+            pipeline = MultiprocessPipeline(pool, 1, ledger=job_ledger)
+            pipeline.submit("AutoRoute prepare", _square, 3,
+                            job_info={'job_name': 'c', 'num_dem_cells': 9})
+            list(pipeline.results())
+            pool.close()
+            pool.join()
+            ok_(list(job_ledger.get_job_runtime_history("AutoRoute prepare")) == ['c'])
+    finally:
+        os.remove(ledger_file)
+
+def test_job_checkpoint():
+    """
+    Checks resuming only the jobs that are not complete
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    output_data_path = os.path.join(main_tests_folder, 'output')
+    checkpoint_file = os.path.join(output_data_path, 'job_manifest.json')
+    output_file_list = [os.path.join(output_data_path, 'job_output_{0}.txt'.format(job_index)) \
+                        for job_index in range(3)]
+    try:
+        for output_file in output_file_list:
+            with open(output_file, 'w') as output_handle:
+                output_handle.write("output\n")
+        job_checkpoint = JobCheckpoint(checkpoint_file)
+        for job_index, output_file in enumerate(output_file_list):
+            job_checkpoint.record_job("run", str(job_index), output_file_list=[output_file])
+        job_checkpoint.record_job("run", "3", status="failed", error="ERROR")
+        #truncated output
+        with open(output_file_list[1], 'w') as output_handle:
+            output_handle.write("out")
+        os.remove(output_file_list[2])
+
+        job_checkpoint = JobCheckpoint(checkpoint_file, resume=True)
+        ok_(job_checkpoint.is_job_complete("run", "0", output_file_list[:1]))
+        ok_(not job_checkpoint.is_job_complete("run", "0", output_file_list[:2]))
+        ok_(not job_checkpoint.is_job_complete("run", "1", output_file_list[1:2]))
+        ok_(not job_checkpoint.is_job_complete("run", "2", output_file_list[2:]))
+        ok_(not job_checkpoint.is_job_complete("run", "3", []))
+        ok_(not job_checkpoint.is_job_complete("prepare", "0", output_file_list[:1]))
+        #a new run starts a new manifest
+        ok_(not JobCheckpoint(checkpoint_file).is_job_complete("run", "0", output_file_list[:1]))
+    finally:
+        for remove_file in output_file_list + [checkpoint_file]:
+            if os.path.exists(remove_file):
+                os.remove(remove_file)
+
+def test_instrumentation():
+    """
+    Checks the events of the instrumentation spans
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    events_file = os.path.join(main_tests_folder, 'output', 'events.jsonl')
+    prometheus_file = os.path.join(main_tests_folder, 'output', 'autoroutepy.prom')
+    try:
+        #nothing is written when disabled
+        with span("rasterize_stream_shapefile", "basin-1") as stage_span:
+            stage_span.set(num_streams=1)
+        ok_(not os.path.exists(events_file))
+
+        enable_instrumentation(events_file)
+        with span("rasterize_stream_shapefile", "basin-1") as stage_span:
+            stage_span.set(num_streams=2)
+        try:
+            with span("autoroute_run", "basin-1"):
+                raise ValueError("bad input")
+        except ValueError:
+            pass
+        with span("autoroute_run", "basin-2"):
+            pass
+
+        event_list = read_events(events_file)
+        ok_([event['stage'] for event in event_list] == ["rasterize_stream_shapefile",
+                                                         "autoroute_run", "autoroute_run"])
+        ok_(event_list[0]['sub_basin'] == "basin-1")
+        ok_(event_list[0]['num_streams'] == 2)
+        ok_(event_list[0]['duration'] >= 0)
+        ok_(event_list[1]['status'] == "failed")
+        ok_(event_list[1]['error'] == "bad input")
+
+        write_prometheus_textfile(events_file, prometheus_file)
+        with open(prometheus_file) as prometheus_handle:
+            prometheus_lines = prometheus_handle.read().splitlines()
+        ok_('autoroutepy_stage_runs_total{stage="autoroute_run"} 2' in prometheus_lines)
+        ok_('autoroutepy_stage_failures_total{stage="autoroute_run"} 1' in prometheus_lines)
+    finally:
+        disable_instrumentation()
+        for output_file in (events_file, prometheus_file):
+            if os.path.exists(output_file):
+                os.remove(output_file)
+
+def test_instrumentation_restored():
+    """
+    Checks that the events file of the caller is restored after
+    a run with its own events file
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    output_folder = os.path.join(main_tests_folder, 'output')
+    caller_events_file = os.path.join(output_folder, 'caller_events.jsonl')
+    run_events_file = os.path.join(output_folder, 'run_events.jsonl')
+    for previous_events_file in ("", caller_events_file):
+        if previous_events_file:
+            enable_instrumentation(previous_events_file)
+        try:
+            run_autoroute_multiprocess(output_folder, output_folder, output_folder,
+                                       job_order="invalid",
+                                       instrumentation_events_file=run_events_file)
+        except Exception as ex:
+            ok_("Invalid job order" in str(ex))
+        else:
+            ok_(False)
+        ok_(is_instrumentation_enabled() == bool(previous_events_file))
+        ok_(os.environ.get(INSTRUMENTATION_EVENTS_FILE_ENV, "") == previous_events_file)
+    disable_instrumentation()
+
+        
+if __name__ == '__main__':
+    import nose
+    nose.main()